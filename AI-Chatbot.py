@@ -1,25 +1,39 @@
 import pygame
 import sys
-import openai
-import json
+import bisect
 import os
-import re
-
-# Set up OpenAI API Key
+import time
+
+from chat_core import MODELS, ChatEngine
+from chat_layout import BUBBLE_PADDING_X, LayoutCache, MessageFonts, MessageIndex
+from chat_search import parse_query
+from chat_worker import ChatDelta
+from model_compare import Comparison, ModelMetrics, uncached_client
+from profiler import profiler
+from redraw import RedrawScheduler
+from render_cache import BubbleCache, TextCache
+from text_input import TextBuffer, TextView
+
+# Set up OpenAI API Key (read from the environment by the engine)
 from dotenv import load_dotenv
 
 dotenv_path = os.path.expanduser("~/Downloads/.env")
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # Initialize Pygame
 pygame.init()
 screen = pygame.display.set_mode((1000, 600))
 WIDTH, HEIGHT = screen.get_width(), screen.get_height()
 
+# Regions of the window that are repainted independently
+SIDEBAR_RECT = pygame.Rect(0, 0, 300, HEIGHT)
+MESSAGES_RECT = pygame.Rect(300, 0, WIDTH - 300, HEIGHT)  # bubbles also show below the input box
+INPUT_RECT = pygame.Rect(310, HEIGHT - 70, WIDTH - 340, 50)
+HUD_RECT = pygame.Rect(WIDTH - 300, 10, 290, 180)
+
 # Constants
-CHAT_FOLDER = "chats"
 BUTTON_HEIGHT = 40
 FONT_SIZE = 18
+BUBBLE_CACHE_BYTES = 64 * 1024 * 1024  # memory budget for pre-rendered message bubbles
 scroll_offset = 0
 target_scroll_offset = 0
 scroll_speed = 10
@@ -28,22 +42,65 @@ scroll_speed = 10
 message_scroll_offset = 0
 message_target_scroll_offset = 0
 
+mouse_x, mouse_y = 0, 0  # read at the start of every frame, used for hover effects
+
 settings_panel_active = False
-user_input = ""
 show_name_dialog = False
 dialog_input_text = ""
 
-# For the system instructions
-system_instructions = ""  # The user can customize this in settings
+# For the system instructions (engine.system_instructions is kept in step with the editor)
 editing_instructions = False  # Whether the user is currently editing the instruction text
 
-
-MODELS = ["gpt-4o", "gpt-4o-mini", "o1", "o1-mini"]
-current_model = "gpt-4o-mini"  # default model
+# For searching all chats (Ctrl+F)
+search_panel_active = False
+search_query = ""
+search_results = []  # None while the search index is busy; the search is tried again shortly
+search_retry_at = 0
+SEARCH_RESULTS = 6  # matches listed in the search panel
+
+# Model comparison: Ctrl+Enter sends the typed message to the models ticked
+# under Compare in the settings (all of them if none are) and shows the
+# replies side by side; every reply's timings go to model_metrics.jsonl
+compare_models = set()
+comparison = None
+compare_panel_active = False
+compare_summary = {}
+compare_layouts = {}  # model -> MessageLayout of its reply so far
+compare_scroll = 0
+model_metrics = ModelMetrics()
+COMPARE_PANEL_RECT = pygame.Rect(30, 30, WIDTH - 60, HEIGHT - 60)
+
+
+STREAM_RESPONSES = True  # show replies word by word as they are generated
+
+# URL of a chat_server.py to use instead of the local chats folder and API key
+CHAT_SERVER = os.getenv("CHATBOT_SERVER")
+
+# Frame profiler: F3 toggles the HUD, F4 writes a Chrome trace of the recorded spans.
+# Setting CHATBOT_PROFILE to a file name records from startup and writes the trace there on exit.
+PROFILE_TRACE = os.getenv("CHATBOT_PROFILE")
+profiler.enabled = bool(PROFILE_TRACE)
+show_profiler_hud = False
 
 # Font initialization
 FONT = pygame.font.SysFont("Arial", FONT_SIZE)
 TITLE_FONT = pygame.font.SysFont("Arial", FONT_SIZE + 4, bold=True)
+HUD_FONT = pygame.font.SysFont("Arial", FONT_SIZE - 4)
+
+# Messages: body text, markdown headings and code blocks
+MESSAGE_FONTS = MessageFonts(FONT, pygame.font.SysFont("Arial", FONT_SIZE + 2, bold=True),
+                             pygame.font.SysFont("Consolas,Menlo,DejaVu Sans Mono,Courier New", FONT_SIZE - 2))
+
+# The chat input (Shift+Enter for a new line) grows upwards to INPUT_MAX_ROWS rows, then scrolls
+INPUT_MAX_ROWS = 6
+input_buffer = TextBuffer()
+input_view = TextView(input_buffer, FONT, INPUT_RECT.width - 30, INPUT_MAX_ROWS)
+INPUT_AREA_HEIGHT = INPUT_MAX_ROWS * FONT.get_linesize() + 30
+INPUT_AREA_RECT = pygame.Rect(INPUT_RECT.x, INPUT_RECT.bottom - INPUT_AREA_HEIGHT, INPUT_RECT.width, INPUT_AREA_HEIGHT)
+
+# The system instructions box in the settings panel
+instructions_buffer = TextBuffer()
+instructions_view = TextView(instructions_buffer, FONT, 480, max(1, 40 // FONT.get_linesize()))
 
 # Themes
 THEMES = {
@@ -90,61 +147,107 @@ THEMES = {
 }
 current_theme = THEMES["neon_nights"]
 
-# Ensure Chat Directory Exists
-if not os.path.exists(CHAT_FOLDER):
-    os.makedirs(CHAT_FOLDER)
+# Conversation state, storage and the request path (CHATBOT_RESPONSE_CACHE
+# "on" replays identical requests from disk, "offline" never calls the API)
+if CHAT_SERVER:
+    from chat_remote import RemoteChatEngine
+    engine = RemoteChatEngine(CHAT_SERVER, stream=STREAM_RESPONSES)
+else:
+    engine = ChatEngine(stream=STREAM_RESPONSES)
+
+    # Keep the search (and recall) index up to date in the background
+    engine.start_index_refresh()
 
 ############################
 # Helper Functions
 ############################
 
-def sanitize_filename(filename):
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
-
-def get_all_chats():
-    chat_files = [f for f in os.listdir(CHAT_FOLDER) if f.endswith(".json")]
-    return sorted(chat_files)
-
-def create_new_chat(chat_name):
-    sanitized_name = sanitize_filename(chat_name)
-    new_chat_path = os.path.join(CHAT_FOLDER, f"{sanitized_name}.json")
-    if os.path.exists(new_chat_path):
-        raise ValueError(f"Chat '{chat_name}' already exists.")
-    with open(new_chat_path, "w") as f:
-        json.dump([], f)
-    return new_chat_path
-
-def load_chat(file_name):
-    chat_path = os.path.join(CHAT_FOLDER, file_name)
-    with open(chat_path, "r") as f:
-        history = json.load(f)
-        # Filter out invalid messages
-        valid_history = [
-            msg for msg in history
-            if isinstance(msg, dict) and 'role' in msg and 'content' in msg
-        ]
-    print(f"Loaded chat '{file_name}' with {len(valid_history)} messages.")  # Debug print
-    return valid_history, chat_path
-
-def save_chat(chat_history, chat_path):
-    with open(chat_path, "w") as f:
-        json.dump(chat_history, f, indent=4)
+def open_chat(file_name):
+    """Makes file_name the active chat, scrolled to its latest message."""
+    global message_scroll_offset, message_target_scroll_offset
+    engine.open_chat(file_name)
+    # Clamped to the bottom of the list by the main loop
+    message_scroll_offset = message_target_scroll_offset = -10**9
+
+def open_chat_at(file_name, position):
+    """Makes file_name the active chat, scrolled so message number position is at the top."""
+    global message_scroll_offset, message_target_scroll_offset
+    engine.open_chat_at(file_name, position)
+    message_index.sync(engine.chat_history, MESSAGE_FONTS, WIDTH - 350)
+    top = message_index.offsets[bisect.bisect_left(message_index.positions, position - engine.history_start)]
+    message_scroll_offset = message_target_scroll_offset = -top
+
+def load_older_messages():
+    """
+    Pages in the messages just above the loaded window (the user scrolled to
+    its top). The scroll position is shifted by the height of what was added
+    so the view doesn't jump.
+    """
+    global message_scroll_offset, message_target_scroll_offset
+    added = engine.load_older_messages()
+    message_index.sync(engine.chat_history, MESSAGE_FONTS, WIDTH - 350)
+    shift = message_index.offsets[bisect.bisect_left(message_index.positions, added)]
+    message_scroll_offset -= shift
+    message_target_scroll_offset -= shift
+
+def load_newer_messages():
+    """Pages in the messages just below the loaded window, scrolling up by the height of any dropped above it."""
+    global message_scroll_offset, message_target_scroll_offset
+    message_index.sync(engine.chat_history, MESSAGE_FONTS, WIDTH - 350)
+    dropped = engine.load_newer_messages()
+    # message_index still describes the window before the drop
+    shift = message_index.offsets[bisect.bisect_left(message_index.positions, dropped)]
+    message_scroll_offset += shift
+    message_target_scroll_offset += shift
+
+def send_message(text):
+    """Sends text from the open chat, first jumping to its latest messages if scrolled back."""
+    if not engine.is_at_latest():
+        open_chat(os.path.basename(engine.active_chat_path))
+    engine.send_message(text)
+
+def apply_delta(delta):
+    """Adds a piece of a streamed reply, re-wrapping only what changed."""
+    change = engine.apply_delta(delta)
+    if change is None:
+        return
+    i, replaced = change
+    if replaced:
+        message_index.invalidate(i)
+    else:
+        message_index.update_tail(i)
 
-# Initialize Chat
-active_chat_path = None
-all_chats = get_all_chats()
+def apply_result(result):
+    """Delivers a finished request; a reply that replaced its placeholder is laid out again."""
+    i = engine.apply_result(result)
+    if i is not None:
+        message_index.invalidate(i)
 
-if not all_chats:
-    # If no chats exist, create a default one
-    active_chat_path = create_new_chat("New Chat")
-    chat_history = []
-else:
-    # Load the most recently listed chat
-    chat_history, active_chat_path = load_chat(all_chats[-1])
+# Initialize Chat
+engine.open_latest_chat()
+message_scroll_offset = message_target_scroll_offset = -10**9  # clamped to the bottom by the main loop
 
 # A place to store the clickable rectangles for each chat
 chat_buttons = []
 
+# (rect, SearchHit) of each result shown in the search panel
+search_buttons = []
+
+# Pre-rendered background gradients (cleared on theme switch)
+background_cache = {}
+
+# Parsed and laid out blocks and bubble sizes for each message, shared by measuring and drawing
+message_layouts = LayoutCache()
+
+# Prefix sums of bubble heights, so only on-screen messages are visited
+message_index = MessageIndex(message_layouts)
+
+# Off-screen bubble surfaces, reused until evicted
+bubble_cache = BubbleCache(BUBBLE_CACHE_BYTES)
+
+# Rendered sidebar labels
+text_cache = TextCache()
+
 ############################
 # Drawing Functions
 ############################
@@ -152,16 +255,36 @@ chat_buttons = []
 def draw_rounded_rect(surface, color, rect, radius=10):
     pygame.draw.rect(surface, color, rect, border_radius=radius)
 
-def draw_gradient(surface, colors, rect):
+def render_gradient_surface(colors, size):
+    """
+    Renders a vertical gradient into a new surface of the given size.
+    Only one pixel column is interpolated; it is then stretched to full width.
+    """
     if len(colors) < 2:
         colors = [colors[0], colors[0]]
     color1, color2 = colors
-    for y in range(rect.height):
-        ratio = y / rect.height
+    width, height = size
+    column = pygame.Surface((1, height))
+    for y in range(height):
+        ratio = y / height
         r = int(color1[0] + (color2[0] - color1[0]) * ratio)
         g = int(color1[1] + (color2[1] - color1[1]) * ratio)
         b = int(color1[2] + (color2[2] - color1[2]) * ratio)
-        pygame.draw.line(surface, (r, g, b), (rect.x, rect.y + y), (rect.x + rect.width, rect.y + y))
+        column.set_at((0, y), (r, g, b))
+    return pygame.transform.scale(column, (width, height)).convert()
+
+def draw_gradient(surface, colors, rect):
+    """
+    Blits the gradient for colors/rect size, rendering it only the first time.
+    Cached surfaces are keyed by the colors and the (width, height) of rect.
+    """
+    rect = pygame.Rect(rect)
+    key = (tuple(tuple(c) for c in colors), rect.width, rect.height)
+    gradient = background_cache.get(key)
+    if gradient is None:
+        gradient = render_gradient_surface(colors, rect.size)
+        background_cache[key] = gradient
+    surface.blit(gradient, rect.topleft)
 
 def render_sidebar():
     """
@@ -170,7 +293,7 @@ def render_sidebar():
     
     Scrolling in the sidebar is handled by scroll_offset & target_scroll_offset.
     """
-    global scroll_offset, target_scroll_offset, active_chat_path, chat_buttons
+    global chat_buttons
     
     chat_buttons = []
 
@@ -182,7 +305,7 @@ def render_sidebar():
     is_hover = new_chat_rect[0] <= mouse_x <= new_chat_rect[0]+280 and new_chat_rect[1] <= mouse_y <= new_chat_rect[1]+BUTTON_HEIGHT
     btn_color = current_theme["button_hover"] if is_hover else current_theme["button"]
     draw_rounded_rect(screen, btn_color, new_chat_rect, 15)
-    screen.blit(FONT.render("New Chat", True, current_theme["text"]), (new_chat_rect[0] + 90, new_chat_rect[1] + 10))
+    screen.blit(text_cache.render(FONT, "New Chat", current_theme["text"]), (new_chat_rect[0] + 90, new_chat_rect[1] + 10))
 
     # Chat List with Scroll
     y_start = 70
@@ -190,135 +313,91 @@ def render_sidebar():
     chat_height = 35
     spacing = 45
     
-    # We will clamp the scroll_offset so user can't scroll infinitely
-    total_chat_space = len(get_all_chats()) * spacing
-    visible_area = HEIGHT - 70 - 100  # from y=70 to y=HEIGHT-100 approx
-
-    max_offset = 0
-    min_offset = -(total_chat_space - visible_area) if total_chat_space > visible_area else 0
-    
-    # Smoothly move scroll_offset toward target_scroll_offset
-    scroll_offset += (target_scroll_offset - scroll_offset) / scroll_speed
+    chats = engine.index.chats
 
-    # Now clamp the actual scroll_offset to avoid overshoot
-    if scroll_offset > max_offset:
-        scroll_offset = max_offset
-    if scroll_offset < min_offset:
-        scroll_offset = min_offset
+    # Only the chats that land on screen are drawn (and clickable)
+    first = max(0, int((-y_start - scroll_offset) // spacing))
+    last = min(len(chats), int((HEIGHT - y_start - scroll_offset) // spacing) + 1)
+    active_name = os.path.basename(engine.active_chat_path)
 
-    list_y_offset = y_start + scroll_offset
-    
-    for chat_file in get_all_chats():
-        chat_rect = (x_pos, list_y_offset, 280, chat_height)
-        is_active = (os.path.basename(active_chat_path) == chat_file)
+    for i in range(first, last):
+        chat = chats[i]
+        chat_rect = (x_pos, y_start + scroll_offset + i * spacing, 280, chat_height)
+        is_active = (active_name == chat.name)
         bg_color = current_theme["button_hover"] if is_active else current_theme["button"]
         
         draw_rounded_rect(screen, bg_color, chat_rect, 8)
-        screen.blit(FONT.render(chat_file[:-5], True, current_theme["text"]), (chat_rect[0] + 10, chat_rect[1] + 8))
+        screen.blit(text_cache.render(FONT, chat.title, current_theme["text"]), (chat_rect[0] + 10, chat_rect[1] + 8))
         
-        chat_buttons.append((chat_rect, chat_file))
-        
-        list_y_offset += spacing
+        chat_buttons.append((chat_rect, chat.name))
 
     # Settings Button
     settings_rect = (10, HEIGHT-60, 280, 40)
     is_hover = settings_rect[0] <= mouse_x <= settings_rect[0]+280 and settings_rect[1] <= mouse_y <= settings_rect[1]+40
     btn_color = current_theme["button_hover"] if is_hover else current_theme["button"]
     draw_rounded_rect(screen, btn_color, settings_rect, 15)
-    screen.blit(FONT.render("Settings", True, current_theme["text"]), (settings_rect[0] + 100, settings_rect[1] + 10))
+    screen.blit(text_cache.render(FONT, "Settings", current_theme["text"]), (settings_rect[0] + 100, settings_rect[1] + 10))
+
+def update_sidebar_scroll():
+    """
+    Moves scroll_offset one step toward target_scroll_offset, clamped to the
+    length of the chat list. Returns True while it is still moving.
+    """
+    global scroll_offset, target_scroll_offset
+
+    # We will clamp the scroll_offset so user can't scroll infinitely
+    total_chat_space = len(engine.index.chats) * 45
+    visible_area = HEIGHT - 70 - 100  # from y=70 to y=HEIGHT-100 approx
+
+    max_offset = 0
+    min_offset = -(total_chat_space - visible_area) if total_chat_space > visible_area else 0
+    target_scroll_offset = min(max(target_scroll_offset, min_offset), max_offset)
+
+    # Smoothly move scroll_offset toward target_scroll_offset
+    previous = scroll_offset
+    scroll_offset += (target_scroll_offset - scroll_offset) / scroll_speed
+    if abs(target_scroll_offset - scroll_offset) < 0.5:
+        scroll_offset = target_scroll_offset
+    return scroll_offset != previous
 
 def get_total_message_height():
     """
     Returns the total pixel height needed to render all messages (for scrolling).
-    We'll replicate the logic in render_messages to measure the heights
-    without actually drawing.
+    Only messages appended since the last call are laid out.
     """
-    total_height = 0
-    max_width = WIDTH - 350
-    
-    for msg in chat_history:
-        if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
-            continue
-        role = msg["role"]
-        if role not in ["user", "assistant"]:
-            continue
-        
-        words = msg["content"].split()
-        lines = []
-        current_line = []
-        
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            if FONT.size(test_line)[0] <= max_width:
-                current_line.append(word)
-            else:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-        if current_line:
-            lines.append(' '.join(current_line))
-        
-        line_height = FONT.get_linesize()
-        bubble_height = len(lines) * line_height + 20
-        total_height += bubble_height + 10  # Add spacing below bubble
-    return total_height
+    message_index.sync(engine.chat_history, MESSAGE_FONTS, WIDTH - 350)
+    return message_index.total_height
 
 def render_messages():
     """
     Render messages as rounded-corner text bubbles that match the theme.
     Now it includes message_scroll_offset so we can scroll up/down if messages
     exceed the visible area.
+
+    Only the messages that intersect the screen are drawn; the first one is
+    found by bisecting message_index.offsets.
     """
     # The area for messages is from x=300 to the right edge, and from y=0 to y=HEIGHT-80 (above input box).
-    y_offset = 20 + message_scroll_offset  
-    max_width = WIDTH - 350
-    
-    for msg in chat_history:
-        if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
-            continue
-        role = msg["role"]
-        if role not in ["user", "assistant"]:
-            continue
-
-        is_user = (role == "user")
+    y_start = 20 + message_scroll_offset
+    text_color = current_theme["text"]
 
+    message_index.sync(engine.chat_history, MESSAGE_FONTS, WIDTH - 350)
+    for i in message_index.visible_range(-y_start, HEIGHT - y_start):
+        msg = engine.chat_history[message_index.positions[i]]
+        is_user = (msg["role"] == "user")
         bubble_color = current_theme["user_bubble"] if is_user else current_theme["assistant_bubble"]
-        text_color = current_theme["text"]
-        
-        # Word-wrap
-        words = msg["content"].split()
-        lines = []
-        current_line = []
-        
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            if FONT.size(test_line)[0] <= max_width:
-                current_line.append(word)
-            else:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-        if current_line:
-            lines.append(' '.join(current_line))
-        
-        line_height = FONT.get_linesize()
-        bubble_height = len(lines) * line_height + 20
-        line_widths = [FONT.size(l)[0] for l in lines]
-        bubble_width = max(line_widths) + 40
+
+        layout = message_index.entries[i]
+        y_offset = y_start + message_index.offsets[i]
         
         if is_user:
-            x_pos = WIDTH - bubble_width - 20
+            x_pos = WIDTH - layout.bubble_width - 20
         else:
             x_pos = 320
         
-        bubble_rect = (x_pos, y_offset, bubble_width, bubble_height)
-        draw_rounded_rect(screen, bubble_color, bubble_rect, 10)
-        
-        text_y = y_offset + 10
-        for line in lines:
-            text_surf = FONT.render(line, True, text_color)
-            screen.blit(text_surf, (x_pos + 10, text_y))
-            text_y += line_height
-        
-        y_offset += bubble_height + 10
+        # A reply still streaming in won't look the same again, but its finished lines will
+        bubble_cache.draw_bubble(screen, (x_pos, y_offset), msg["content"], layout, MESSAGE_FONTS,
+                                 bubble_color, text_color, streaming="pending" in msg, text_cache=text_cache)
 
 def render_settings_panel():
     """
@@ -340,18 +419,18 @@ def render_settings_panel():
     draw_rounded_rect(screen, current_theme["sidebar"], panel_rect, 15)
 
     # Title
-    title = TITLE_FONT.render("Settings", True, current_theme["text"])
+    title = text_cache.render(TITLE_FONT, "Settings", current_theme["text"])
     screen.blit(title, (panel_x + (panel_w // 2 - title.get_width() // 2), panel_y + 20))
 
     # Close button
     close_btn_rect = pygame.Rect(panel_x + panel_w - 70, panel_y + 10, 60, 30)
     draw_rounded_rect(screen, current_theme["button"], close_btn_rect, 8)
-    close_text = FONT.render("Close", True, current_theme["text"])
+    close_text = text_cache.render(FONT, "Close", current_theme["text"])
     screen.blit(close_text, (close_btn_rect.x + 5, close_btn_rect.y + 5))
 
     # Theming
     y_offset = panel_y + 60
-    section_title = FONT.render("Theme Selector:", True, current_theme["text"])
+    section_title = text_cache.render(FONT, "Theme Selector:", current_theme["text"])
     screen.blit(section_title, (panel_x + 30, y_offset))
     y_offset += 30
 
@@ -360,29 +439,38 @@ def render_settings_panel():
         is_hover = btn_rect[0] <= mouse_x <= btn_rect[0] + 200 and btn_rect[1] <= mouse_y <= btn_rect[1] + 35
         btn_color = current_theme["button_hover"] if is_hover else current_theme["button"]
         draw_rounded_rect(screen, btn_color, btn_rect, 8)
-        text = FONT.render(theme_name.replace("_", " ").title(), True, current_theme["text"])
+        text = text_cache.render(FONT, theme_name.replace("_", " ").title(), current_theme["text"])
         screen.blit(text, (btn_rect[0] + 10, btn_rect[1] + 5))
         y_offset += 45
 
     # Model selection
     y_offset += 10
-    section_title = FONT.render("Model Selector:", True, current_theme["text"])
+    section_title = text_cache.render(FONT, "Model Selector:", current_theme["text"])
     screen.blit(section_title, (panel_x + 30, y_offset))
+    section_title = text_cache.render(FONT, "Compare (Ctrl+Enter):", current_theme["text"])
+    screen.blit(section_title, (panel_x + 270, y_offset))
     y_offset += 30
 
     for model in MODELS:
         btn_rect = (panel_x + 50, y_offset, 200, 35)
         is_hover = btn_rect[0] <= mouse_x <= btn_rect[0] + 200 and btn_rect[1] <= mouse_y <= btn_rect[1] + 35
         # If it's the current model, highlight differently
-        btn_color = current_theme["button_hover"] if model == current_model else current_theme["button"]
+        btn_color = current_theme["button_hover"] if model == engine.model else current_theme["button"]
         draw_rounded_rect(screen, btn_color, btn_rect, 8)
-        text = FONT.render(model, True, current_theme["text"])
+        text = text_cache.render(FONT, model, current_theme["text"])
+        screen.blit(text, (btn_rect[0] + 10, btn_rect[1] + 5))
+
+        # Whether the model takes part in comparisons
+        btn_rect = (panel_x + 270, y_offset, 110, 35)
+        btn_color = current_theme["button_hover"] if model in compare_models else current_theme["button"]
+        draw_rounded_rect(screen, btn_color, btn_rect, 8)
+        text = text_cache.render(FONT, "[x] Compare" if model in compare_models else "[ ] Compare", current_theme["text"])
         screen.blit(text, (btn_rect[0] + 10, btn_rect[1] + 5))
         y_offset += 45
 
     # System Instructions
     y_offset += 20
-    section_title = FONT.render("System Instructions:", True, current_theme["text"])
+    section_title = text_cache.render(FONT, "System Instructions:", current_theme["text"])
     screen.blit(section_title, (panel_x + 30, y_offset))
     y_offset += 30
 
@@ -390,11 +478,12 @@ def render_settings_panel():
     box_color = current_theme["button_hover"] if editing_instructions else current_theme["button"]
     draw_rounded_rect(screen, box_color, instruction_rect, 8)
 
-    inst_surf = FONT.render(system_instructions, True, current_theme["text"])
-    screen.blit(inst_surf, (instruction_rect.x + 10, instruction_rect.y + 10))
+    if not editing_instructions and instructions_buffer.text != engine.system_instructions:
+        instructions_buffer.set_text(engine.system_instructions)
+    draw_text_view(instructions_view, instruction_rect.x + 10, instruction_rect.y + 10, editing_instructions)
 
-    if not system_instructions and not editing_instructions:
-        hint_surf = FONT.render("(Click here to edit instructions)", True, (180, 180, 180))
+    if not engine.system_instructions and not editing_instructions:
+        hint_surf = text_cache.render(FONT, "(Click here to edit instructions)", (180, 180, 180))
         screen.blit(hint_surf, (instruction_rect.x + 10, instruction_rect.y + 10))
 
 def render_name_dialog():
@@ -411,230 +500,603 @@ def render_name_dialog():
     dialog_rect = (dx, dy, 400, 200)
     draw_rounded_rect(screen, current_theme["dialog"], dialog_rect, 15)
     
-    title = TITLE_FONT.render("Name Your Chat", True, current_theme["text"])
+    title = text_cache.render(TITLE_FONT, "Name Your Chat", current_theme["text"])
     screen.blit(title, (dx + 100, dy + 20))
     
     input_rect = pygame.Rect(dx + 50, dy + 70, 300, 40)
     draw_rounded_rect(screen, current_theme["button"], input_rect, 8)
-    screen.blit(FONT.render(dialog_input_text, True, current_theme["text"]), (input_rect.x + 10, input_rect.y + 10))
+    screen.blit(text_cache.render(FONT, dialog_input_text, current_theme["text"]), (input_rect.x + 10, input_rect.y + 10))
     
     ok_rect = pygame.Rect(dx + 100, dy + 140, 80, 35)
     draw_rounded_rect(screen, current_theme["button"], ok_rect, 8)
-    screen.blit(FONT.render("OK", True, current_theme["text"]), (ok_rect.x + 25, ok_rect.y + 8))
+    screen.blit(text_cache.render(FONT, "OK", current_theme["text"]), (ok_rect.x + 25, ok_rect.y + 8))
     
     cancel_rect = pygame.Rect(dx + 220, dy + 140, 80, 35)
     draw_rounded_rect(screen, current_theme["button"], cancel_rect, 8)
-    screen.blit(FONT.render("Cancel", True, current_theme["text"]), (cancel_rect.x + 10, cancel_rect.y + 8))
+    screen.blit(text_cache.render(FONT, "Cancel", current_theme["text"]), (cancel_rect.x + 10, cancel_rect.y + 8))
+
+def draw_text_view(view, x, y, show_cursor):
+    """
+    Draws the visible rows of an editor with its top left at (x, y). Each
+    row comes from the text cache, so only rows that changed are rendered.
+    """
+    view.update()
+    line_height = view.font.get_linesize()
+    lines = view.buffer.lines
+    for i in range(view.scroll, view.scroll + view.visible_rows()):
+        number, start, end = view.row(i)
+        if end > start:
+            row_y = y + (i - view.scroll) * line_height
+            screen.blit(text_cache.render(view.font, lines[number][start:end], current_theme["text"]), (x, row_y))
+    if show_cursor:
+        row = view.cursor_row()
+        if view.scroll <= row < view.scroll + view.max_rows:
+            cursor_x = x + view.cursor_x()
+            cursor_y = y + (row - view.scroll) * line_height
+            pygame.draw.line(screen, current_theme["text"], (cursor_x, cursor_y), (cursor_x, cursor_y + line_height - 2), 2)
+    if view.row_count > view.max_rows:
+        # Scroll bar along the right edge
+        track = view.max_rows * line_height
+        thumb = max(10, track * view.max_rows // view.row_count)
+        thumb_y = y + (track - thumb) * view.scroll // (view.row_count - view.max_rows)
+        pygame.draw.rect(screen, current_theme["button_hover"], (x + view.width + 6, thumb_y, 4, thumb), border_radius=2)
+
+def input_box_rect():
+    """The chat input box, grown upwards to fit its text (up to INPUT_MAX_ROWS rows)."""
+    input_view.update()
+    height = max(INPUT_RECT.height, input_view.visible_rows() * FONT.get_linesize() + 30)
+    return pygame.Rect(INPUT_RECT.x, INPUT_RECT.bottom - height, INPUT_RECT.width, height)
 
 def render_input_box():
-    input_rect = (310, HEIGHT - 70, WIDTH - 340, 50)
+    input_rect = input_box_rect()
     draw_rounded_rect(screen, current_theme["sidebar"], input_rect, 15)
-    screen.blit(FONT.render(user_input, True, current_theme["text"]), (input_rect[0]+15, input_rect[1]+15))
+    typing = not (settings_panel_active or search_panel_active or compare_panel_active or show_name_dialog)
+    draw_text_view(input_view, input_rect.x + 15, input_rect.y + 15, typing)
 
+def draw_frame(clip):
+    """Repaints every layer that overlaps clip, without touching anything outside it."""
+    screen.set_clip(clip)
 
-##############################################
-# Main Loop
-##############################################
-
-clock = pygame.time.Clock()
-running = True
-
-while running:
-    mouse_x, mouse_y = pygame.mouse.get_pos()
-    screen.fill((0, 0, 0))
-    
     # Main Background
-    draw_gradient(screen, current_theme["background"], pygame.Rect(0, 0, WIDTH, HEIGHT))
+    with profiler.span("gradient"):
+        draw_gradient(screen, current_theme["background"], pygame.Rect(0, 0, WIDTH, HEIGHT))
     
     # Sidebar
-    render_sidebar()
-    
-    # Compute the total message height to clamp scrolling
-    total_msg_height = get_total_message_height()
-    visible_height = HEIGHT - 80  # the message area is above the input box
-    
-    # Smoothly approach the target offset for messages
-    message_scroll_offset += (message_target_scroll_offset - message_scroll_offset) / scroll_speed
-    
-    # Now clamp it
-    if total_msg_height <= visible_height:
-        message_scroll_offset = 0
-        message_target_scroll_offset = 0
-    else:
-        max_offset = 0
-        min_offset = -(total_msg_height - visible_height)
-        if message_scroll_offset > max_offset:
-            message_scroll_offset = max_offset
-        if message_scroll_offset < min_offset:
-            message_scroll_offset = min_offset
+    if clip.colliderect(SIDEBAR_RECT):
+        with profiler.span("sidebar"):
+            render_sidebar()
     
     # Messages
-    render_messages()
+    if clip.colliderect(MESSAGES_RECT):
+        with profiler.span("messages"):
+            render_messages()
     
     # Input Box
-    render_input_box()
+    if clip.colliderect(INPUT_AREA_RECT):
+        with profiler.span("input box"):
+            render_input_box()
     
     # Settings Panel
     if settings_panel_active:
-        render_settings_panel()
+        with profiler.span("settings panel"):
+            render_settings_panel()
+    
+    # Search Panel
+    if search_panel_active:
+        render_search_panel()
+
+    # Model Comparison
+    if compare_panel_active:
+        with profiler.span("compare panel"):
+            render_compare_panel()
     
     # Chat Naming Dialog
     if show_name_dialog:
         render_name_dialog()
-    
-    # Event Handling
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            if active_chat_path:
-                save_chat(chat_history, active_chat_path)
-            running = False
-
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            if show_name_dialog:
-                dx = WIDTH//2 - 200
-                dy = HEIGHT//2 - 100
-                ok_rect = pygame.Rect(dx + 100, dy + 140, 80, 35)
-                cancel_rect = pygame.Rect(dx + 220, dy + 140, 80, 35)
-                
-                if ok_rect.collidepoint(mouse_x, mouse_y):
-                    # OK button
-                    try:
-                        new_name = dialog_input_text.strip() or "New Chat"
-                        active_chat_path = create_new_chat(new_name)
-                        chat_history = []
+
+    # Profiler HUD
+    if show_profiler_hud and clip.colliderect(HUD_RECT):
+        render_profiler_hud()
+
+    screen.set_clip(None)
+
+def render_search_panel():
+    """
+    A search box over all saved chats, with the best matches listed below it.
+    Populates search_buttons[] with the rect of each match; clicking one opens
+    its chat at that message.
+    """
+    global search_buttons
+    search_buttons = []
+
+    panel_w = 600
+    panel_h = 500
+    panel_x = WIDTH//2 - panel_w//2
+    panel_y = HEIGHT//2 - panel_h//2
+    draw_rounded_rect(screen, current_theme["sidebar"], (panel_x, panel_y, panel_w, panel_h), 15)
+
+    title = text_cache.render(TITLE_FONT, "Search Chats", current_theme["text"])
+    screen.blit(title, (panel_x + (panel_w // 2 - title.get_width() // 2), panel_y + 20))
+
+    input_rect = pygame.Rect(panel_x + 30, panel_y + 60, panel_w - 60, 40)
+    draw_rounded_rect(screen, current_theme["button"], input_rect, 8)
+    screen.blit(text_cache.render(FONT, search_query, current_theme["text"]), (input_rect.x + 10, input_rect.y + 10))
+
+    y_offset = panel_y + 115
+    if search_results is None:
+        screen.blit(text_cache.render(FONT, "Indexing chats...", current_theme["text"]), (panel_x + 40, y_offset))
+    elif search_query.strip() and not search_results:
+        screen.blit(text_cache.render(FONT, "No matches", current_theme["text"]), (panel_x + 40, y_offset))
+
+    words = [word for phrase in parse_query(search_query) for word in phrase]
+    for hit in search_results or ():
+        rect = pygame.Rect(panel_x + 30, y_offset, panel_w - 60, 55)
+        is_hover = rect.collidepoint(mouse_x, mouse_y)
+        draw_rounded_rect(screen, current_theme["button_hover"] if is_hover else current_theme["button"], rect, 8)
+
+        heading = f"{os.path.splitext(hit.chat)[0]}  (message {hit.message + 1})"
+        screen.blit(text_cache.render(FONT, heading, current_theme["text"]), (rect.x + 10, rect.y + 6))
+        snippet = text_cache.render(HUD_FONT, hit.snippet(words), current_theme["text"])
+        screen.blit(snippet, (rect.x + 10, rect.y + 30), pygame.Rect(0, 0, rect.width - 20, snippet.get_height()))
+
+        search_buttons.append((rect, hit))
+        y_offset += 62
+
+def run_search():
+    """Updates search_results for the current search_query."""
+    global search_results, search_retry_at
+    search_results = engine.search_chats(search_query, SEARCH_RESULTS) if search_query.strip() else []
+    search_retry_at = time.perf_counter() + 0.25
+
+def open_search_hit(hit):
+    """Closes the search panel and shows the matching message."""
+    global search_panel_active
+    engine.leave_active_chat()
+    open_chat_at(hit.chat, hit.message)
+    search_panel_active = False
+
+def start_comparison(text):
+    """Sends text to the models to compare and opens the panel their replies are shown in."""
+    global comparison, compare_panel_active, compare_summary, compare_scroll
+    if CHAT_SERVER:
+        print("Model comparison needs a local API key; it isn't available with CHATBOT_SERVER")
+        return
+    models = [model for model in MODELS if model in compare_models] or MODELS
+    try:
+        requests = engine.compare_requests(text, models)
+        comparison = Comparison(uncached_client(engine.client), requests, model_metrics, text)
+        compare_summary = model_metrics.summary()
+    except Exception as e:
+        print(f"Error starting comparison: {e}")
+        return
+    compare_layouts.clear()
+    compare_scroll = 0
+    compare_panel_active = True
+
+def render_compare_panel():
+    """
+    The replies of the models being compared in side-by-side columns, each
+    with its time to first token, total time and tokens so far, and the
+    model's latency percentiles over the whole metrics log.
+    """
+    panel = COMPARE_PANEL_RECT
+    draw_rounded_rect(screen, current_theme["sidebar"], panel, 15)
+    prompt = " ".join(comparison.prompt.split())
+    title = text_cache.render(TITLE_FONT, f"Compare: {prompt[:60]}" + ("..." if len(prompt) > 60 else ""),
+                              current_theme["text"])
+    screen.blit(title, (panel.x + 20, panel.y + 15))
+
+    columns = len(comparison.replies)
+    column_w = (panel.width - 20 * (columns + 1)) // columns
+    top = panel.y + 55
+    for n, reply in enumerate(comparison.replies):
+        x = panel.x + 20 + n * (column_w + 20)
+        screen.blit(text_cache.render(FONT, reply.model, current_theme["text"]), (x, top))
+
+        if reply.error:
+            status = f"error: {reply.error}"
+        elif reply.ttft is None:
+            status = "finished" if reply.done else "waiting..."
+        else:
+            status = f"first {reply.ttft * 1000:.0f} ms"
+            if reply.latency is not None:
+                status += f", total {reply.latency * 1000:.0f} ms"
+            if reply.usage and reply.usage.get("completion_tokens") is not None:
+                status += f", {reply.usage['completion_tokens']} tok"
+        stats = compare_summary.get(reply.model)
+        if stats and stats["latency_p50"] is not None:
+            history = f"p50 {stats['latency_p50']:.0f} / p95 {stats['latency_p95']:.0f} ms ({stats['requests']} runs)"
+        else:
+            history = "no earlier runs"
+        for i, line in enumerate((status, history)):
+            # Not cached: the status changes while the reply streams in
+            surface = HUD_FONT.render(line, True, current_theme["text"])
+            screen.blit(surface, (x, top + 28 + i * (HUD_FONT.get_linesize() + 2)), (0, 0, column_w, surface.get_height()))
+
+        if not reply.text:
+            continue
+        layout = compare_layouts.get(reply.model)
+        if layout is None:
+            layout = message_layouts.get(reply.text, MESSAGE_FONTS, column_w - BUBBLE_PADDING_X)
+        elif layout.content != reply.text:
+            layout = message_layouts.extend(layout, reply.text, MESSAGE_FONTS, column_w - BUBBLE_PADDING_X)
+        compare_layouts[reply.model] = layout
+        bubble_top = top + 80
+        column = pygame.Rect(x, bubble_top, column_w, panel.bottom - 15 - bubble_top)
+        clip = screen.get_clip()
+        screen.set_clip(column.clip(clip))
+        bubble_cache.draw_bubble(screen, (x, bubble_top - compare_scroll), reply.text, layout, MESSAGE_FONTS,
+                                 current_theme["assistant_bubble"], current_theme["text"],
+                                 streaming=not reply.done, text_cache=text_cache)
+        screen.set_clip(clip)
+
+def render_profiler_hud():
+    """Frame rate, frame time percentiles and the most expensive spans of recent frames."""
+    fps, p50, p99, spans = profiler.stats()
+    hud = pygame.Surface(HUD_RECT.size, pygame.SRCALPHA)
+    hud.fill((0, 0, 0, 180))
+    lines = [f"{fps:.0f} fps   frame p50 {p50:.1f} ms   p99 {p99:.1f} ms"]
+    lines += [f"{name}: {ms:.2f} ms" for name, ms in spans]
+    lines.append(f"text: {text_cache.describe()}")
+    lines.append(f"bubbles: {bubble_cache.describe()}")
+    y = 8
+    for line in lines:
+        # Not cached: these numbers change every time the HUD is drawn
+        hud.blit(HUD_FONT.render(line, True, (255, 255, 255)), (10, y))
+        y += HUD_FONT.get_linesize() + 2
+    screen.blit(hud, HUD_RECT.topleft)
+
+def hover_state():
+    """
+    What the mouse is over, as far as hover highlighting goes. The main loop
+    repaints when this changes rather than on every mouse move.
+    """
+    if settings_panel_active or search_panel_active:
+        # The panels highlight the button under the mouse
+        return ("panel", mouse_x, mouse_y)
+    if show_name_dialog:
+        return None
+    over_new_chat = 10 <= mouse_x <= 290 and 10 <= mouse_y <= 10 + BUTTON_HEIGHT
+    over_settings = 10 <= mouse_x <= 290 and HEIGHT - 60 <= mouse_y <= HEIGHT - 20
+    return (over_new_chat, over_settings)
+
+
+##############################################
+# Main Loop
+##############################################
+
+clock = pygame.time.Clock()
+redraw = RedrawScheduler(screen.get_rect())
+
+def main():
+    """Runs the window until it is closed."""
+    global mouse_x, mouse_y, scroll_offset, target_scroll_offset
+    global message_scroll_offset, message_target_scroll_offset
+    global settings_panel_active, show_name_dialog, dialog_input_text
+    global editing_instructions, current_theme
+    global show_profiler_hud, search_panel_active, search_query
+    global compare_panel_active, compare_summary, compare_scroll
+
+    running = True
+    last_hover = None
+    hud_updated = 0
+    last_input_top = INPUT_RECT.top
+
+    profiler.frame_start()
+    while running:
+        mouse_x, mouse_y = pygame.mouse.get_pos()
+
+        # Replies that arrived since the last frame
+        with profiler.span("poll replies"):
+            for result in engine.poll():
+                if isinstance(result, ChatDelta):
+                    apply_delta(result)
+                else:
+                    apply_result(result)
+                redraw.mark(MESSAGES_RECT)
+
+        # Progress of the model comparison
+        if comparison is not None and comparison.poll():
+            if comparison.done:
+                compare_summary = model_metrics.summary()
+            if compare_panel_active:
+                redraw.mark(COMPARE_PANEL_RECT)
+
+        # A search made while the index was busy
+        if search_panel_active and search_results is None and time.perf_counter() >= search_retry_at:
+            run_search()
+            redraw.mark()
+
+        # Chats created or removed by someone else
+        with profiler.span("list chats"):
+            if engine.index.refresh():
+                redraw.mark(SIDEBAR_RECT)
+
+        if update_sidebar_scroll():
+            redraw.animate(SIDEBAR_RECT)
+
+        # Compute the total message height to clamp scrolling
+        with profiler.span("layout"):
+            total_msg_height = get_total_message_height()
+        input_top = input_box_rect().top
+        visible_height = input_top - 10  # the message area is above the input box
+        if input_top != last_input_top:
+            # The input box grew or shrank; if the latest message was in view, keep it there
+            if message_target_scroll_offset <= -(total_msg_height - (last_input_top - 10)) + 1:
+                message_scroll_offset -= last_input_top - input_top
+                message_target_scroll_offset -= last_input_top - input_top
+            last_input_top = input_top
+            redraw.mark(MESSAGES_RECT)
+
+        # Smoothly approach the target offset for messages
+        previous_offset = message_scroll_offset
+        message_scroll_offset += (message_target_scroll_offset - message_scroll_offset) / scroll_speed
+
+        # Now clamp it (the target too, so overscrolling doesn't have to be undone)
+        if total_msg_height <= visible_height:
+            message_scroll_offset = 0
+            message_target_scroll_offset = 0
+        else:
+            max_offset = 0
+            min_offset = -(total_msg_height - visible_height)
+            message_scroll_offset = min(max(message_scroll_offset, min_offset), max_offset)
+            message_target_scroll_offset = min(max(message_target_scroll_offset, min_offset), max_offset)
+        if abs(message_target_scroll_offset - message_scroll_offset) < 0.5:
+            message_scroll_offset = message_target_scroll_offset
+        if message_scroll_offset != previous_offset:
+            redraw.animate(MESSAGES_RECT)
+
+        # Page older/newer messages in when scrolled to either end of the loaded window
+        if message_target_scroll_offset >= 0 and engine.history_start > 0:
+            with profiler.span("page in"):
+                load_older_messages()
+            redraw.mark(MESSAGES_RECT)
+        elif (total_msg_height <= visible_height or message_target_scroll_offset <= min_offset) and not engine.is_at_latest():
+            with profiler.span("page in"):
+                load_newer_messages()
+            redraw.mark(MESSAGES_RECT)
+
+        # Hover highlighting
+        hover = hover_state()
+        if hover != last_hover:
+            redraw.mark(None if settings_panel_active or search_panel_active else SIDEBAR_RECT)
+            last_hover = hover
+
+        # Keep the HUD's numbers current
+        if show_profiler_hud and time.perf_counter() - hud_updated > 0.5:
+            redraw.mark(HUD_RECT)
+            hud_updated = time.perf_counter()
+
+        # Repaint only what changed
+        dirty_rects = redraw.take()
+        with profiler.span("draw"):
+            for rect in dirty_rects:
+                draw_frame(rect)
+        if dirty_rects:
+            with profiler.span("display update"):
+                pygame.display.update(dirty_rects)
+
+        # Event Handling (sleeps here while there is nothing to animate, which isn't counted as frame time)
+        profiler.frame_end()
+        events = redraw.wait_events(clock)
+        profiler.frame_start()
+        for event in events:
+            if event.type in (pygame.WINDOWEXPOSED, pygame.WINDOWRESTORED, pygame.WINDOWFOCUSGAINED):
+                redraw.mark()
+
+            if event.type == pygame.QUIT:
+                engine.close()
+                if PROFILE_TRACE:
+                    count = profiler.export_chrome_trace(PROFILE_TRACE)
+                    print(f"Wrote {count} spans to {PROFILE_TRACE}")
+                running = False
+
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                # A click can open/close panels or switch chats or themes
+                redraw.mark()
+                if show_name_dialog:
+                    dx = WIDTH//2 - 200
+                    dy = HEIGHT//2 - 100
+                    ok_rect = pygame.Rect(dx + 100, dy + 140, 80, 35)
+                    cancel_rect = pygame.Rect(dx + 220, dy + 140, 80, 35)
+
+                    if ok_rect.collidepoint(mouse_x, mouse_y):
+                        # OK button
+                        try:
+                            new_name = dialog_input_text.strip() or "New Chat"
+                            engine.new_chat(new_name)
+                            show_name_dialog = False
+                            dialog_input_text = ""
+                            print(f"Created new chat: {engine.active_chat_path}")
+                        except Exception as e:
+                            print(f"Error creating chat: {e}")
+
+                    elif cancel_rect.collidepoint(mouse_x, mouse_y):
+                        # Cancel button
                         show_name_dialog = False
                         dialog_input_text = ""
-                        print(f"Created new chat: {active_chat_path}")
-                    except Exception as e:
-                        print(f"Error creating chat: {e}")
-                
-                elif cancel_rect.collidepoint(mouse_x, mouse_y):
-                    # Cancel button
-                    show_name_dialog = False
-                    dialog_input_text = ""
-
-            elif settings_panel_active:
-                # Coordinates for the bigger settings panel
-                panel_w = 600
-                panel_h = 600
-                panel_x = WIDTH//2 - panel_w//2
-                panel_y = HEIGHT//2 - panel_h//2
-
-                # Close button
-                close_btn_rect = pygame.Rect(panel_x + panel_w - 70, panel_y + 10, 60, 30)
-                if close_btn_rect.collidepoint(mouse_x, mouse_y):
-                    settings_panel_active = False
-                    break
-
-                # The instructions text box
-                instruction_rect = pygame.Rect(panel_x + 50,
-                                               panel_y + 60 + (len(THEMES)*45 + 30) + 10 + (len(MODELS)*45 + 30) + 20 + 30,
-                                               500, 60)
-                if instruction_rect.collidepoint(mouse_x, mouse_y):
-                    editing_instructions = True
-                else:
-                    editing_instructions = False
-
-                # Themes
-                y_offset = panel_y + 60 + 30
-                for theme_name in THEMES:
-                    btn_rect = pygame.Rect(panel_x + 50, y_offset, 200, 35)
-                    if btn_rect.collidepoint(mouse_x, mouse_y):
-                        current_theme = THEMES[theme_name]
-                    y_offset += 45
-
-                # Models
-                y_offset += 10
-                y_offset += 30
-                for model in MODELS:
-                    btn_rect = pygame.Rect(panel_x + 50, y_offset, 200, 35)
-                    if btn_rect.collidepoint(mouse_x, mouse_y):
-                        current_model = model
-                    y_offset += 45
-
-            else:
-                # Check "New Chat"
-                if 10 <= mouse_x <= 290 and 10 <= mouse_y <= 50:
-                    show_name_dialog = True
-                
-                # Check "Settings"
-                elif 10 <= mouse_x <= 290 and HEIGHT - 60 <= mouse_y <= HEIGHT - 20:
-                    settings_panel_active = not settings_panel_active
-
-                # Check each chat button
-                else:
-                    for (rect, chat_file) in chat_buttons:
-                        if pygame.Rect(rect).collidepoint(mouse_x, mouse_y):
+
+                elif compare_panel_active:
+                    if not COMPARE_PANEL_RECT.collidepoint(mouse_x, mouse_y):
+                        compare_panel_active = False
+
+                elif search_panel_active:
+                    # Open the clicked match, or close the panel on a click outside it
+                    panel_rect = pygame.Rect(WIDTH//2 - 300, HEIGHT//2 - 250, 600, 500)
+                    for (rect, hit) in search_buttons:
+                        if rect.collidepoint(mouse_x, mouse_y):
                             try:
-                                save_chat(chat_history, active_chat_path)
-                                chat_history, active_chat_path = load_chat(chat_file)
+                                open_search_hit(hit)
                             except Exception as e:
-                                print(f"Error loading chat: {e}")
+                                print(f"Error opening search result: {e}")
                             break
+                    else:
+                        if not panel_rect.collidepoint(mouse_x, mouse_y):
+                            search_panel_active = False
+
+                elif settings_panel_active:
+                    # Coordinates for the bigger settings panel
+                    panel_w = 600
+                    panel_h = 600
+                    panel_x = WIDTH//2 - panel_w//2
+                    panel_y = HEIGHT//2 - panel_h//2
+
+                    # Close button
+                    close_btn_rect = pygame.Rect(panel_x + panel_w - 70, panel_y + 10, 60, 30)
+                    if close_btn_rect.collidepoint(mouse_x, mouse_y):
+                        settings_panel_active = False
+                        break
+
+                    # The instructions text box
+                    instruction_rect = pygame.Rect(panel_x + 50,
+                                                   panel_y + 60 + (len(THEMES)*45 + 30) + 10 + (len(MODELS)*45 + 30) + 20 + 30,
+                                                   500, 60)
+                    if instruction_rect.collidepoint(mouse_x, mouse_y):
+                        editing_instructions = True
+                    else:
+                        editing_instructions = False
+
+                    # Themes
+                    y_offset = panel_y + 60 + 30
+                    for theme_name in THEMES:
+                        btn_rect = pygame.Rect(panel_x + 50, y_offset, 200, 35)
+                        if btn_rect.collidepoint(mouse_x, mouse_y) and current_theme is not THEMES[theme_name]:
+                            current_theme = THEMES[theme_name]
+                            background_cache.clear()
+                        y_offset += 45
+
+                    # Models
+                    y_offset += 10
+                    y_offset += 30
+                    for model in MODELS:
+                        btn_rect = pygame.Rect(panel_x + 50, y_offset, 200, 35)
+                        if btn_rect.collidepoint(mouse_x, mouse_y):
+                            engine.model = model
+                        compare_rect = pygame.Rect(panel_x + 270, y_offset, 110, 35)
+                        if compare_rect.collidepoint(mouse_x, mouse_y):
+                            compare_models.symmetric_difference_update([model])
+                        y_offset += 45
 
-        elif event.type == pygame.KEYDOWN:
-            if show_name_dialog:
-                if event.key == pygame.K_RETURN:
-                    pass
-                elif event.key == pygame.K_BACKSPACE:
-                    dialog_input_text = dialog_input_text[:-1]
                 else:
-                    dialog_input_text += event.unicode
-
-            elif settings_panel_active and editing_instructions:
-                # Editing system instructions (single-line)
-                if event.key == pygame.K_BACKSPACE:
-                    system_instructions = system_instructions[:-1]
-                elif event.key == pygame.K_RETURN:
-                    editing_instructions = False
-                else:
-                    system_instructions += event.unicode
+                    # Check "New Chat"
+                    if 10 <= mouse_x <= 290 and 10 <= mouse_y <= 50:
+                        show_name_dialog = True
+
+                    # Check "Settings"
+                    elif 10 <= mouse_x <= 290 and HEIGHT - 60 <= mouse_y <= HEIGHT - 20:
+                        settings_panel_active = not settings_panel_active
+
+                    # Place the cursor in the chat input
+                    elif event.button == 1 and input_box_rect().collidepoint(mouse_x, mouse_y):
+                        input_rect = input_box_rect()
+                        input_view.click(mouse_x - input_rect.x - 15, mouse_y - input_rect.y - 15)
+
+                    # Check each chat button
+                    else:
+                        for (rect, chat_file) in chat_buttons:
+                            if pygame.Rect(rect).collidepoint(mouse_x, mouse_y):
+                                try:
+                                    engine.leave_active_chat()
+                                    open_chat(chat_file)
+                                except Exception as e:
+                                    print(f"Error loading chat: {e}")
+                                break
+
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                show_profiler_hud = not show_profiler_hud
+                profiler.enabled = show_profiler_hud or bool(PROFILE_TRACE)
+                text_cache.reset_stats()
+                bubble_cache.reset_stats()
+                redraw.mark(HUD_RECT)
+
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                trace_path = PROFILE_TRACE or time.strftime("trace-%Y%m%d-%H%M%S.json")
+                count = profiler.export_chrome_trace(trace_path)
+                print(f"Wrote {count} spans to {trace_path}")
+
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_f and event.mod & pygame.KMOD_CTRL:
+                if not show_name_dialog:
+                    search_panel_active = not search_panel_active
+                    settings_panel_active = False
+                    compare_panel_active = False
+                    redraw.mark()
 
-            else:
-                # Chat input
-                if event.key == pygame.K_RETURN:
-                    if user_input.strip():
-                        chat_history.append({"role": "user", "content": user_input})
+            elif event.type == pygame.KEYDOWN:
+                if show_name_dialog or settings_panel_active or search_panel_active or compare_panel_active:
+                    redraw.mark()
+                else:
+                    redraw.mark(MESSAGES_RECT if event.key == pygame.K_RETURN else INPUT_AREA_RECT)
+
+                if show_name_dialog:
+                    if event.key == pygame.K_RETURN:
+                        pass
+                    elif event.key == pygame.K_BACKSPACE:
+                        dialog_input_text = dialog_input_text[:-1]
+                    else:
+                        dialog_input_text += event.unicode
+
+                elif compare_panel_active:
+                    if event.key == pygame.K_ESCAPE:
+                        compare_panel_active = False
+
+                elif search_panel_active:
+                    if event.key == pygame.K_ESCAPE:
+                        search_panel_active = False
+                    elif event.key == pygame.K_RETURN:
+                        if search_results:
+                            try:
+                                open_search_hit(search_results[0])
+                            except Exception as e:
+                                print(f"Error opening search result: {e}")
+                    else:
+                        if event.key == pygame.K_BACKSPACE:
+                            search_query = search_query[:-1]
+                        else:
+                            search_query += event.unicode
+                        run_search()
+
+                elif settings_panel_active and editing_instructions:
+                    # Editing system instructions (Enter finishes, Shift+Enter starts a new line)
+                    if event.key in (pygame.K_RETURN, pygame.K_ESCAPE) and not event.mod & pygame.KMOD_SHIFT:
+                        editing_instructions = False
+                    elif instructions_view.handle_key(event):
+                        engine.system_instructions = instructions_buffer.text
 
-                        # Build the complete message set for the API
-                        messages_to_send = []
-                        if system_instructions.strip():
-                            messages_to_send.append({"role": "system", "content": system_instructions})
+                else:
+                    # Chat input (Enter sends, Shift+Enter starts a new line, Ctrl+Enter compares models)
+                    if event.key == pygame.K_RETURN and event.mod & pygame.KMOD_CTRL:
+                        if input_buffer.text.strip():
+                            start_comparison(input_buffer.text)
+                            redraw.mark()
+                    elif event.key == pygame.K_RETURN and not event.mod & pygame.KMOD_SHIFT:
+                        text = input_buffer.text
+                        if text.strip():
+                            send_message(text)
+                            input_buffer.clear()
+                    else:
+                        input_view.handle_key(event)
+
+            elif event.type == pygame.MOUSEWHEEL:
+                # Decide if the user is scrolling the sidebar or the message area
+                if compare_panel_active:
+                    # Scroll the compared replies together
+                    tallest = max((layout.bubble_height for layout in compare_layouts.values()), default=0)
+                    compare_scroll = min(max(0, compare_scroll - event.y * 30), max(0, tallest - 100))
+                    redraw.mark(COMPARE_PANEL_RECT)
+                elif mouse_x < 300:
+                    # Mouse in sidebar region
+                    target_scroll_offset += event.y * 30
+                elif input_box_rect().collidepoint(mouse_x, mouse_y) and not settings_panel_active:
+                    # Mouse over the chat input
+                    input_view.scroll_by(-event.y)
+                    redraw.mark(INPUT_AREA_RECT)
+                else:
+                    # Mouse in message area
+                    message_target_scroll_offset += event.y * 30
 
-                        for msg in chat_history:
-                            if "role" in msg and "content" in msg:
-                                messages_to_send.append(msg)
+    pygame.quit()
 
-                        # Attempt calling the chosen model. If it fails, show error
-                        try:
-                            response = openai.ChatCompletion.create(
-                                model=current_model,
-                                messages=messages_to_send
-                            )
-                            ai_response = response.choices[0].message['content']
-                            chat_history.append({"role": "assistant", "content": ai_response})
-                        except Exception as e:
-                            print(f"API Error: {e}")
-                            chat_history.append({"role": "assistant", "content": "Error getting response"})
 
-                        user_input = ""
-                
-                elif event.key == pygame.K_BACKSPACE:
-                    user_input = user_input[:-1]
-                else:
-                    user_input += event.unicode
-
-        elif event.type == pygame.MOUSEWHEEL:
-            # Decide if the user is scrolling the sidebar or the message area
-            if mouse_x < 300:
-                # Mouse in sidebar region
-                target_scroll_offset += event.y * 30
-            else:
-                # Mouse in message area
-                message_target_scroll_offset += event.y * 30
-
-    pygame.display.flip()
-    clock.tick(30)
-
-pygame.quit()
-sys.exit()
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -0,0 +1,204 @@
+"""
+Runs a file of prompts through the chat completions API.
+
+Each input line is a JSON object with a "prompt" (or a full "messages"
+list) and optionally an "id"; lines without an id are identified by their
+line number. Requests use the same model budgets, rate limits and system
+instructions handling as the GUI and run with bounded concurrency. Each
+result is appended to the output file as soon as it finishes, so the
+output is in completion order:
+
+    {"id": ..., "model": ..., "reply": ..., "latency_ms": ...,
+     "prompt_tokens": ..., "completion_tokens": ...}
+
+latency_ms includes any wait for the model's rate limit in MODEL_RATE_LIMITS.
+Failed items get an "error" instead of a "reply". Running again with the
+same output file skips the items that already succeeded, so an
+interrupted batch picks up where it stopped:
+
+    python batch_runner.py prompts.jsonl results.jsonl --model gpt-4o --concurrency 8
+
+Point OPENAI_BASE_URL (or --base-url) at mock_api.py to try it offline.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from chat_core import DEFAULT_MODEL, MODEL_TOKEN_BUDGETS, MODELS, make_client
+from context_window import ContextManager
+
+
+def read_items(path):
+    """Yields (id, item) for each prompt in the input file. Blank lines are skipped."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                print(f"Skipping line {line_number}: {e}", file=sys.stderr)
+                continue
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if not isinstance(item, dict) or not ("prompt" in item or "messages" in item):
+                print(f"Skipping line {line_number}: no prompt or messages", file=sys.stderr)
+                continue
+            yield item.get("id", line_number), item
+
+
+def finished_ids(path):
+    """Ids of the items that already succeeded in an earlier run's output file."""
+    done = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short when the last run was interrupted
+                if isinstance(record, dict) and "error" not in record:
+                    done.add(json.dumps(record.get("id")))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class BatchRunner:
+    def __init__(self, client, model=DEFAULT_MODEL, system_instructions="", concurrency=8):
+        self.client = client
+        self.model = model
+        self.system_instructions = system_instructions
+        self.concurrency = concurrency
+        self.context = ContextManager(MODEL_TOKEN_BUDGETS)
+        self._context_lock = threading.Lock()  # ContextManager's token cache isn't thread-safe
+
+    def build_messages(self, item, model):
+        history = item.get("messages") or [{"role": "user", "content": item["prompt"]}]
+        system_instructions = item.get("system", self.system_instructions)
+        with self._context_lock:
+            messages = self.context.build(model, history, system_instructions)
+            return messages, self.context.last_stats.sent_tokens
+
+    def run_item(self, item_id, item):
+        """Sends one item and returns its output record."""
+        model = item.get("model", self.model)
+        record = {"id": item_id, "model": model}
+        try:
+            messages, estimated_prompt_tokens = self.build_messages(item, model)
+            start = time.perf_counter()
+            if hasattr(self.client, "complete_with_usage"):
+                reply, usage = self.client.complete_with_usage(model, messages)
+            else:
+                reply, usage = self.client.complete(model, messages), None
+            record["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        except Exception as e:
+            record["error"] = str(e)
+            return record
+
+        record["reply"] = reply
+        if usage:
+            record["prompt_tokens"] = usage.get("prompt_tokens")
+            record["completion_tokens"] = usage.get("completion_tokens")
+        else:
+            # Counted locally when the server doesn't report usage
+            with self._context_lock:
+                record["prompt_tokens"] = estimated_prompt_tokens
+                record["completion_tokens"] = self.context.count_text(reply)
+        return record
+
+    def run(self, items, output_path, resume=True):
+        """
+        Runs every item not already finished in output_path, appending each
+        record as it completes. Returns the records written by this run.
+        """
+        done = finished_ids(output_path) if resume else set()
+        records = []
+        skipped = 0
+
+        mode = "a" if resume else "w"
+        with open(output_path, mode, encoding="utf-8") as out:
+            if resume and out.tell() > 0:
+                out.write("\n")  # in case the last run stopped mid-line; blank lines are ignored
+            pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch")
+            running = set()
+            try:
+                for item_id, item in items:
+                    if json.dumps(item_id) in done:
+                        skipped += 1
+                        continue
+                    # Keep a bounded number queued so huge inputs aren't read into memory at once
+                    if len(running) >= self.concurrency * 2:
+                        finished, running = wait(running, return_when=FIRST_COMPLETED)
+                        self._write(out, finished, records)
+                    running.add(pool.submit(self.run_item, item_id, item))
+                while running:
+                    finished, running = wait(running, return_when=FIRST_COMPLETED)
+                    self._write(out, finished, records)
+            except KeyboardInterrupt:
+                # Requests already in flight are abandoned; their items run again on resume
+                pool.shutdown(wait=False, cancel_futures=True)
+                print("Interrupted; run again with the same output file to resume.", file=sys.stderr)
+                raise
+            finally:
+                self.skipped = skipped
+            pool.shutdown()
+        return records
+
+    @staticmethod
+    def _write(out, futures, records):
+        for future in futures:
+            record = future.result()
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            records.append(record)
+        out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the chat API")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--model", default=DEFAULT_MODEL, choices=MODELS)
+    parser.add_argument("--system", default="", help="system instructions sent with every prompt")
+    parser.add_argument("--system-file", help="read the system instructions from a file")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--base-url", help="API base URL (default: OPENAI_BASE_URL or the OpenAI API)")
+    parser.add_argument("--response-cache", choices=["off", "on", "offline"], help="see CHATBOT_RESPONSE_CACHE")
+    parser.add_argument("--no-resume", action="store_true", help="overwrite the output instead of resuming")
+    args = parser.parse_args()
+
+    system_instructions = args.system
+    if args.system_file:
+        with open(args.system_file, "r", encoding="utf-8") as f:
+            system_instructions = f.read()
+
+    client, _ = make_client(base_url=args.base_url, response_cache=args.response_cache, pool_size=args.concurrency)
+    runner = BatchRunner(client, args.model, system_instructions, args.concurrency)
+    start = time.perf_counter()
+    try:
+        records = runner.run(read_items(args.input), args.output, resume=not args.no_resume)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    elapsed = time.perf_counter() - start
+
+    failed = sum(1 for record in records if "error" in record)
+    latencies = [record["latency_ms"] for record in records if "latency_ms" in record]
+    print(f"{len(records) - failed} done, {failed} failed, {runner.skipped} already done, in {elapsed:.1f}s"
+          + (f" ({len(records) / elapsed:.1f}/s)" if elapsed > 0 and records else ""))
+    if latencies:
+        print(f"Latency p50 {percentile(latencies, 0.5):.0f} ms, p99 {percentile(latencies, 0.99):.0f} ms")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Headless benchmarks for the chat window.
+
+Loads AI-Chatbot.py under SDL's dummy video driver inside a scratch folder,
+fills it with synthetic chats and times the drawing, layout and storage
+functions the main loop relies on. Results are written as JSON so runs can
+be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+--compare exits with status 1 if any timing got slower by more than
+--threshold (20% by default).
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+from chat_core import PAGE_SIZE
+from chat_storage import CHAT_EXTENSION
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(REPO_DIR, "AI-Chatbot.py")
+
+WORDS = ("the a of to and in is it you that for on with as this was are be at have not "
+         "python pygame window message scroll render layout bubble chat model token "
+         "assistant user question answer function variable example because however").split()
+
+# Timings below this are mostly noise and never count as regressions
+NOISE_FLOOR_MS = 0.05
+
+
+def synthetic_messages(count, rng):
+    """Alternating user/assistant messages with a spread of lengths, including some very long words."""
+    messages = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.6:
+            length = rng.randint(3, 20)
+        elif kind < 0.9:
+            length = rng.randint(20, 120)
+        else:
+            length = rng.randint(120, 600)
+        words = [rng.choice(WORDS) for _ in range(length)]
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), "https://example.com/" + "x" * rng.randint(40, 200))
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": " ".join(words)})
+    return messages
+
+
+def summarize(samples):
+    """Millisecond statistics of a list of durations in seconds."""
+    ordered = sorted(samples)
+    n = len(ordered)
+    return {
+        "n": n,
+        "first_ms": samples[0] * 1000,
+        "mean_ms": sum(ordered) / n * 1000,
+        "p50_ms": ordered[n // 2] * 1000,
+        "p95_ms": ordered[min(n - 1, int(n * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def load_app():
+    """Imports AI-Chatbot.py as a module without starting its main loop."""
+    spec = importlib.util.spec_from_file_location("chatbot", APP_PATH)
+    app = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(app)
+    return app
+
+
+############################
+# Benchmarks
+############################
+
+def bench_storage(app, name, messages, repeat):
+    path = os.path.join(app.engine.folder, name)
+    size = os.path.getsize(path)
+    results = {}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        samples = [timed(app.engine.load_chat, name) for _ in range(repeat)]
+    results["load_chat"] = summarize(samples)
+    results["load_chat"]["messages"] = min(len(messages), PAGE_SIZE)
+
+    samples = [timed(app.engine.store.read, path) for _ in range(max(1, repeat // 4))]
+    results["read_all"] = summarize(samples)
+    results["read_all"]["messages_per_s"] = len(messages) / (sum(samples) / len(samples))
+    results["read_all"]["mb_per_s"] = size / (1024 * 1024) / (sum(samples) / len(samples))
+
+    # Appending a batch of new messages, including the fsync
+    history = list(messages)
+    rng = random.Random(len(messages))
+    batch = 50
+    samples = []
+    for _ in range(max(1, repeat // 4)):
+        history.extend(synthetic_messages(batch, rng))
+        start = time.perf_counter()
+        app.engine.save_chat(history, path)
+        app.engine.store.flush()
+        samples.append(time.perf_counter() - start)
+    results["save_chat"] = summarize(samples)
+    results["save_chat"]["messages_per_s"] = batch / (sum(samples) / len(samples))
+    return results
+
+
+def bench_layout(app, messages, repeat):
+    results = {}
+
+    # Nothing laid out yet, as when a chat is first opened
+    samples = []
+    for _ in range(3):
+        app.message_layouts.clear()
+        app.engine.chat_history = list(messages)
+        samples.append(timed(app.get_total_message_height))
+    results["total_height_cold"] = summarize(samples)
+
+    samples = [timed(app.get_total_message_height) for _ in range(repeat)]
+    results["total_height_warm"] = summarize(samples)
+
+    # One new message per call, as while chatting
+    rng = random.Random(len(messages))
+    samples = []
+    for msg in synthetic_messages(repeat, rng):
+        app.engine.chat_history.append(msg)
+        samples.append(timed(app.get_total_message_height))
+    results["total_height_append"] = summarize(samples)
+    return results
+
+
+def bench_messages(app, messages, frames):
+    app.engine.chat_history = list(messages)
+    total_height = app.get_total_message_height()
+    visible_height = app.HEIGHT - 80
+    bottom = -max(0, total_height - visible_height)
+    results = {}
+
+    # Scrolling from the top of the chat to the bottom, so bubbles keep coming into view
+    app.bubble_cache.clear()
+    samples = []
+    for frame in range(frames):
+        app.message_scroll_offset = bottom * frame / max(1, frames - 1)
+        samples.append(timed(app.render_messages))
+    results["render_messages_scroll"] = summarize(samples)
+
+    # Sitting at the bottom, every bubble already rendered
+    app.message_scroll_offset = bottom
+    samples = [timed(app.render_messages) for _ in range(frames)]
+    results["render_messages_static"] = summarize(samples)
+
+    samples = [timed(app.draw_frame, app.screen.get_rect()) for _ in range(frames)]
+    results["full_frame"] = summarize(samples)
+    return results
+
+
+def bench_sidebar(app, frames):
+    app.engine.index.refresh()
+    count = len(app.engine.index.chats)
+    max_scroll = max(0, count * 45 - (app.HEIGHT - 170))
+    app.text_cache.clear()
+    samples = []
+    for frame in range(frames):
+        app.scroll_offset = -max_scroll * frame / max(1, frames - 1)
+        samples.append(timed(app.render_sidebar))
+    app.scroll_offset = 0
+    return {"chats": count, "render_sidebar": summarize(samples)}
+
+
+def run(sizes, frames, repeat, sidebar_chats, seed):
+    rng = random.Random(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            app = load_app()
+            try:
+                for i in range(sidebar_chats):
+                    app.engine.create_chat(f"Chat {i}")
+
+                for size in sizes:
+                    messages = synthetic_messages(size, rng)
+                    name = f"bench_{size}{CHAT_EXTENSION}"
+                    app.engine.store.compact(os.path.join(app.engine.folder, name), messages)
+                    app.engine.index.mark_dirty()
+                    print(f"{size} messages...", file=sys.stderr)
+
+                    entry = {}
+                    entry.update(bench_layout(app, messages, repeat))
+                    entry.update(bench_messages(app, messages, frames))
+                    entry.update(bench_storage(app, name, messages, repeat))
+                    results[f"messages_{size}"] = entry
+
+                results["sidebar"] = bench_sidebar(app, frames)
+            finally:
+                app.engine.chat_history = []  # the synthetic messages aren't part of the open chat
+                app.engine.close()
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+############################
+# Reporting
+############################
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timings(results, prefix=""):
+    """Yields (name, p50 in ms) for every timing in results."""
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if "p50_ms" in value:
+                yield prefix + key, value["p50_ms"]
+            else:
+                yield from timings(value, prefix + key + ".")
+
+
+def compare(old, new, threshold):
+    """Prints the change in every timing and returns the names of those that regressed."""
+    old_timings = dict(timings(old["results"]))
+    regressions = []
+    for name, new_ms in timings(new["results"]):
+        old_ms = old_timings.get(name)
+        if old_ms is None:
+            continue
+        ratio = new_ms / old_ms if old_ms else float("inf")
+        flag = ""
+        if ratio > 1 + threshold and new_ms > NOISE_FLOOR_MS:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:50} {old_ms:10.3f} -> {new_ms:10.3f} ms  ({ratio:5.2f}x){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,1000,50000", help="comma-separated message counts of the synthetic chats")
+    parser.add_argument("--frames", type=int, default=120, help="frames rendered per drawing benchmark")
+    parser.add_argument("--repeat", type=int, default=40, help="calls per layout/storage benchmark")
+    parser.add_argument("--sidebar-chats", type=int, default=200, help="extra empty chats listed in the sidebar")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown (fraction of p50) counted as a regression")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "sizes": sizes,
+            "frames": args.frames,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "results": run(sizes, args.frames, args.repeat, args.sidebar_chats, args.seed),
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} timings regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+    else:
+        for name, ms in timings(report["results"]):
+            print(f"{name:50} {ms:10.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Compressed archive format for chats that are rarely opened.
+
+An archived chat (<chat>.jsonl.z next to where <chat>.jsonl was) holds the
+same JSONL lines, cut into blocks of about BLOCK_BYTES that are compressed
+separately, followed by an index of where each block starts and which
+message it starts with:
+
+    MAGIC | block 0 | block 1 | ... | block offsets | first messages | trailer
+
+The file is memory-mapped, so reading a page of messages decompresses only
+the blocks it falls in; nothing else is read from disk. ChatStore opens
+archives transparently and turns a chat back into JSONL the first time a
+message is added to it.
+
+Archive the chats nobody has touched for a month:
+
+    python chat_archive.py --older-than 30
+"""
+
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+
+ARCHIVE_SUFFIX = ".z"
+MAGIC = b"CHATARC1"
+TRAILER = struct.Struct("<QQQ8s")  # index offset, block count, message count, magic
+BLOCK_BYTES = 64 * 1024  # uncompressed size a block is cut at
+CACHED_BLOCKS = 8
+
+
+def write_archive(path, lines, level=6):
+    """
+    Atomically writes the encoded message lines (bytes ending in a newline)
+    to an archive at path. Returns the number of messages written.
+    """
+    offsets = array("Q")
+    firsts = array("Q")
+    count = 0
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            block, block_size = [], 0
+
+            def write_block():
+                offsets.append(f.tell())
+                firsts.append(count - len(block))
+                f.write(zlib.compress(b"".join(block), level))
+
+            for line in lines:
+                block.append(line)
+                block_size += len(line)
+                count += 1
+                if block_size >= BLOCK_BYTES:
+                    write_block()
+                    block, block_size = [], 0
+            if block:
+                write_block()
+
+            index_offset = f.tell()
+            offsets.append(index_offset)  # the end of the last block
+            f.write(offsets.tobytes())
+            f.write(firsts.tobytes())
+            f.write(TRAILER.pack(index_offset, len(firsts), count, MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return count
+
+
+def read_count(path):
+    """Number of messages in the archive at path, read from its trailer alone."""
+    with open(path, "rb") as f:
+        f.seek(-TRAILER.size, os.SEEK_END)
+        _, _, count, magic = TRAILER.unpack(f.read(TRAILER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a chat archive")
+    return count
+
+
+class ChatArchive:
+    """Random access to the messages of an archive through a memory map."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, block_count, self.count, magic = TRAILER.unpack(self._map[-TRAILER.size:])
+        if magic != MAGIC or self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a chat archive")
+        index_end = index_offset + (2 * block_count + 1) * 8
+        index = array("Q")
+        index.frombytes(self._map[index_offset:index_end])
+        self._offsets = index[:block_count + 1]
+        self._firsts = index[block_count + 1:]
+        self._blocks = OrderedDict()  # block number -> its lines, most recently used last
+
+    def _block(self, number):
+        lines = self._blocks.get(number)
+        if lines is None:
+            data = zlib.decompress(self._map[self._offsets[number]:self._offsets[number + 1]])
+            lines = self._blocks[number] = data.splitlines()
+            if len(self._blocks) > CACHED_BLOCKS:
+                self._blocks.popitem(last=False)
+        else:
+            self._blocks.move_to_end(number)
+        return lines
+
+    def read_lines(self, start, end):
+        """The encoded lines of messages start..end (exclusive)."""
+        end = min(end, self.count)
+        if start >= end:
+            return []
+        lines = []
+        number = bisect.bisect_right(self._firsts, start) - 1
+        while number < len(self._firsts) and self._firsts[number] < end:
+            first = self._firsts[number]
+            block = self._block(number)
+            lines.extend(block[max(0, start - first):end - first])
+            number += 1
+        return lines
+
+    def close(self):
+        self._blocks.clear()
+        self._map.close()
+
+
+def main():
+    from chat_core import CHAT_FOLDER
+    from chat_storage import ChatStore
+
+    parser = argparse.ArgumentParser(description="Compress chats that haven't been used for a while")
+    parser.add_argument("--folder", default=CHAT_FOLDER, help="folder of the saved chats")
+    parser.add_argument("--older-than", type=float, default=30, metavar="DAYS",
+                        help="archive chats last changed more than this many days ago")
+    parser.add_argument("--restore", metavar="CHAT", help="turn an archived chat (e.g. 'Notes.jsonl') back into JSONL")
+    args = parser.parse_args()
+
+    store = ChatStore(args.folder)
+    try:
+        if args.restore:
+            store.unarchive(os.path.join(args.folder, args.restore))
+            print(f"Restored {args.restore}")
+            return
+        start = time.perf_counter()
+        before, after, names = store.archive_cold_chats(args.older_than * 86400)
+        print(f"Archived {len(names)} chats in {time.perf_counter() - start:.1f}s: "
+              f"{before / (1024 * 1024):.1f} MB -> {after / (1024 * 1024):.1f} MB")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
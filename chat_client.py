@@ -0,0 +1,193 @@
+"""
+Chat completion clients.
+
+A client needs a complete(model, messages) method returning the reply text,
+and a stream(model, messages) method yielding it in pieces as they arrive,
+so the request path can be driven by a stub in place of the API.
+"""
+
+import json
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class APIError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def iter_sse_deltas(lines, usage=None):
+    """
+    Yields the content deltas of a chat completion server-sent event stream.
+    lines is any iterable of the raw stream's lines (str or bytes). If
+    usage is a dict, the token usage in the stream's last chunk (sent when
+    the request asks for it) is copied into it.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return
+        chunk = json.loads(data)
+        if usage is not None and chunk.get("usage"):
+            usage.update(chunk["usage"])
+        choices = chunk.get("choices") or []
+        if choices:
+            content = choices[0].get("delta", {}).get("content")
+            if content:
+                yield content
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes one token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HTTPChatClient:
+    """
+    Calls the chat completions endpoint over one pooled HTTP session.
+
+    Requests for each model go through a token bucket built from
+    rate_limits (requests per minute). Responses with a retryable status
+    (429, 5xx) and connection errors are retried with jittered exponential
+    backoff, waiting for Retry-After instead when the server sends it. The
+    latency of every successful call is recorded per model.
+    """
+
+    def __init__(self, api_key, base_url=DEFAULT_BASE_URL, rate_limits=None, default_rate_limit=60,
+                 pool_size=10, timeout=120, max_retries=4, backoff_base=0.5, backoff_max=30.0):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.rate_limits = rate_limits or {}
+        self.default_rate_limit = default_rate_limit
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latencies = {}  # model -> recent call latencies in seconds
+        self.retries = 0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def complete(self, model, messages):
+        return self.complete_with_usage(model, messages)[0]
+
+    def complete_with_usage(self, model, messages):
+        """Like complete(), but also returns the token usage the server reported (or None)."""
+        start = time.perf_counter()
+        response = self._post(model, {"model": model, "messages": messages})
+        body = response.json()
+        content = body["choices"][0]["message"]["content"]
+        self._record(model, time.perf_counter() - start)
+        return content, body.get("usage")
+
+    def stream(self, model, messages):
+        start = time.perf_counter()
+        response = self._post(model, {"model": model, "messages": messages, "stream": True}, stream=True)
+        with response:
+            yield from iter_sse_deltas(response.iter_lines())
+        self._record(model, time.perf_counter() - start)
+
+    def stream_with_usage(self, model, messages, usage):
+        """Like stream(), and fills the usage dict with the token usage the server reports at the end."""
+        start = time.perf_counter()
+        payload = {"model": model, "messages": messages, "stream": True, "stream_options": {"include_usage": True}}
+        response = self._post(model, payload, stream=True)
+        with response:
+            yield from iter_sse_deltas(response.iter_lines(), usage)
+        self._record(model, time.perf_counter() - start)
+
+    def latency_stats(self, model):
+        """Returns (count, p50, p99) of the recorded latencies for model, in seconds."""
+        with self._lock:
+            samples = sorted(self.latencies.get(model, ()))
+        if not samples:
+            return 0, None, None
+        return len(samples), samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+    def close(self):
+        self.session.close()
+
+    def _bucket(self, model):
+        with self._lock:
+            bucket = self._buckets.get(model)
+            if bucket is None:
+                per_minute = self.rate_limits.get(model, self.default_rate_limit)
+                bucket = self._buckets[model] = TokenBucket(per_minute / 60.0, max(1, per_minute // 10))
+            return bucket
+
+    def _record(self, model, seconds):
+        with self._lock:
+            self.latencies.setdefault(model, deque(maxlen=1000)).append(seconds)
+
+    def _backoff(self, attempt, response=None):
+        """Seconds to wait before retry number attempt (0-based)."""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _post(self, model, payload, stream=False):
+        url = f"{self.base_url}/chat/completions"
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        bucket = self._bucket(model)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = self.session.post(url, json=payload, headers=headers, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise APIError(f"Request failed: {e}")
+                delay = self._backoff(attempt)
+            else:
+                if response.status_code < 400:
+                    return response
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    raise APIError(f"HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+                delay = self._backoff(attempt, response)
+                response.close()
+            attempt += 1
+            self.retries += 1
+            time.sleep(delay)
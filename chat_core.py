@@ -0,0 +1,519 @@
+"""
+The chat engine, without the window.
+
+ChatEngine owns the saved chats, the open chat's loaded window of
+messages and the path a message takes to the API and back. The pygame
+front end (AI-Chatbot.py) draws its state and forwards user actions to it;
+a command-line tool or a service can drive it the same way.
+
+Nothing here imports pygame. The HTTP client (and with it requests), the
+request worker threads, tiktoken, the search index and the recall index
+(and with it numpy) are only set up when first used, so importing this
+module and opening a chat stays cheap.
+"""
+
+import os
+import re
+import threading
+
+from chat_index import ChatIndex
+from chat_search import ChatSearch
+from chat_storage import CHAT_EXTENSION, ChatStore
+from context_window import ContextManager
+from profiler import profiler
+
+CHAT_FOLDER = "chats"
+RESPONSE_CACHE_FOLDER = "response_cache"
+PAGE_SIZE = 100  # messages read from disk at a time when opening or scrolling a chat
+MAX_LOADED_MESSAGES = 1000  # messages of the open chat kept in memory
+
+MODELS = ["gpt-4o", "gpt-4o-mini", "o1", "o1-mini"]
+DEFAULT_MODEL = "gpt-4o-mini"
+
+# Prompt tokens each request may use; older turns beyond this are summarized
+MODEL_TOKEN_BUDGETS = {
+    "gpt-4o": 16000,
+    "gpt-4o-mini": 32000,
+    "o1": 16000,
+    "o1-mini": 32000,
+}
+
+# Requests per minute allowed for each model
+MODEL_RATE_LIMITS = {
+    "gpt-4o": 60,
+    "gpt-4o-mini": 120,
+    "o1": 20,
+    "o1-mini": 60,
+}
+
+# Estimated USD per million (prompt, completion) tokens, for comparing the cost of models
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "o1": (15.00, 60.00),
+    "o1-mini": (1.10, 4.40),
+}
+
+# Shown in place of the assistant's reply while its request is in flight
+PENDING_TEXT = "Assistant is typing..."
+
+# Messages recalled from other chats per request, and how similar they must be (cosine)
+RECALL_HITS = 3
+RECALL_MIN_SCORE = 0.35
+
+# How often the background thread picks up chats changed by someone else
+INDEX_REFRESH_SECONDS = 30
+
+
+def make_client(api_key=None, base_url=None, response_cache=None, pool_size=10):
+    """
+    Returns (client, response cache or None) for the chat completions API.
+    api_key and base_url default to the OPENAI_API_KEY and OPENAI_BASE_URL
+    environment variables. response_cache is "off", "on" (replay identical
+    requests from disk) or "offline" (never call the API), defaulting to
+    CHATBOT_RESPONSE_CACHE. Imports the HTTP stack, so call it only when
+    a client is needed.
+    """
+    from chat_client import HTTPChatClient
+    api_key = api_key if api_key is not None else os.getenv("OPENAI_API_KEY")
+    base_url = base_url or os.getenv("OPENAI_BASE_URL")
+    mode = response_cache or os.getenv("CHATBOT_RESPONSE_CACHE", "off")
+
+    kwargs = {"base_url": base_url} if base_url else {}
+    client = HTTPChatClient(api_key, rate_limits=MODEL_RATE_LIMITS, pool_size=pool_size, **kwargs)
+    cache = None
+    if mode in ("on", "offline"):
+        from response_cache import CachedChatClient, ResponseCache
+        cache = ResponseCache(RESPONSE_CACHE_FOLDER)
+        client = CachedChatClient(client, cache, offline=(mode == "offline"))
+    return client, cache
+
+
+def sanitize_filename(filename):
+    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+
+
+class ChatEngine:
+    def __init__(self, folder=CHAT_FOLDER, api_key=None, base_url=None, response_cache=None,
+                 stream=True, client=None, pool_size=10, recall=None):
+        """
+        api_key, base_url, response_cache and pool_size configure the API
+        client as in make_client(). client replaces it, e.g. with a stub.
+        recall is "on" to send similar messages from other chats along with
+        each request (see chat_recall), defaulting to CHATBOT_RECALL.
+        """
+        self.folder = folder
+        self.api_key = api_key
+        self.base_url = base_url
+        self.response_cache_mode = response_cache
+        self.pool_size = pool_size
+        self.stream = stream  # deliver replies piece by piece as they are generated
+        self.model = DEFAULT_MODEL
+        self.system_instructions = ""
+        self.recall_enabled = (recall or os.getenv("CHATBOT_RECALL", "off")) == "on"
+
+        os.makedirs(folder, exist_ok=True)
+        # Append-only storage for the chats (older .json chats are converted once)
+        self.store = ChatStore(folder)
+        self.store.migrate_legacy_chats()
+        # Listing of the chat folder, re-read only when it changes
+        self.index = ChatIndex(folder)
+        # Word index over every saved message
+        self.search = ChatSearch(self.store, folder)
+        # Decides which turns fit into each request
+        self.context = ContextManager(MODEL_TOKEN_BUDGETS)
+
+        # The open chat: chat_history is the loaded part, starting at message history_start
+        self.active_chat_path = None
+        self.chat_history = []
+        self.history_start = 0
+        # request id -> [chat path, message number] where a reply whose placeholder was dropped belongs
+        self._reply_positions = {}
+
+        self.response_cache = None
+        self._client = client
+        self._worker = None
+        self._recall = None
+        self._recall_lock = threading.Lock()
+        self._index_thread = None
+        self._indexes_stale = threading.Event()
+        self._closing = False
+
+    @property
+    def client(self):
+        """The chat completion client, created on first use."""
+        if self._client is None:
+            self._client, self.response_cache = make_client(self.api_key, self.base_url, self.response_cache_mode,
+                                                         self.pool_size)
+        return self._client
+
+    @property
+    def worker(self):
+        """The background threads requests run on, started with the first request."""
+        if self._worker is None:
+            from chat_worker import RequestWorker
+            self._worker = RequestWorker(self.client)
+        return self._worker
+
+    @property
+    def recall(self):
+        """The vector index of every saved message, created on first use (None if numpy is missing)."""
+        with self._recall_lock:
+            if self._recall is None and self.recall_enabled:
+                try:
+                    from chat_recall import ChatRecall
+                except ImportError:
+                    print("Recall needs numpy; sending requests without it")
+                    self.recall_enabled = False
+                    return None
+                self._recall = ChatRecall(self.store, self.folder)
+            return self._recall
+
+    ############################
+    # Saved chats
+    ############################
+
+    def chats(self):
+        return self.index.names()
+
+    def chat_path(self, file_name):
+        return os.path.join(self.folder, file_name)
+
+    def create_chat(self, chat_name):
+        sanitized_name = sanitize_filename(chat_name)
+        new_chat_path = self.chat_path(f"{sanitized_name}{CHAT_EXTENSION}")
+        if os.path.exists(new_chat_path) or self.store.is_archived(new_chat_path):
+            raise ValueError(f"Chat '{chat_name}' already exists.")
+        self.store.create(new_chat_path)
+        self.index.mark_dirty()
+        return new_chat_path
+
+    def load_chat(self, file_name):
+        """Reads only the most recent PAGE_SIZE messages; older ones are paged in on scroll."""
+        chat_path = self.chat_path(file_name)
+        # Invalid messages are filtered out by the store
+        valid_history = self.store.read_tail(chat_path, PAGE_SIZE)
+        print(f"Loaded chat '{file_name}' with {len(valid_history)} messages.")  # Debug print
+        self.index.update(file_name)
+        return valid_history, chat_path
+
+    def save_chat(self, chat_history, chat_path, start=0):
+        """
+        Queues the messages that aren't on disk yet for appending. chat_history
+        is the part of the chat beginning at message number start.
+        Placeholders for replies that haven't arrived yet are not saved.
+        """
+        saved_history = [msg for msg in chat_history if "pending" not in msg]
+        self.store.save(chat_path, saved_history, start)
+        self.index.update(os.path.basename(chat_path))
+        self.mark_indexes_stale()
+
+    def archive_cold_chats(self, max_age_days=30):
+        """
+        Compresses the chats not changed for max_age_days (see chat_archive).
+        They stay listed and readable; the open chat is never archived.
+        """
+        before, after, names = self.store.archive_cold_chats(max_age_days * 86400, exclude=(self.active_chat_path,))
+        if names:
+            self.index.mark_dirty()
+            print(f"Archived {len(names)} chats: {before / (1024 * 1024):.1f} MB -> {after / (1024 * 1024):.1f} MB")
+        return names
+
+    def search_chats(self, query, limit=20):
+        """SearchHits for query, or None while the index is busy (see ChatSearch.search)."""
+        with profiler.span("search"):
+            return self.search.search(query, limit)
+
+    def refresh_indexes(self):
+        """Brings the search index (and the recall index, if used) up to date; slow the first time."""
+        self.search.refresh()
+        if self.recall is not None:
+            self.recall.refresh()
+
+    def start_index_refresh(self):
+        """
+        Starts the thread that keeps the indexes up to date: they are built
+        (or loaded) at once, then refreshed whenever a chat is saved here and
+        every INDEX_REFRESH_SECONDS for changes made by other clients.
+        Queries never refresh an index themselves, so they never wait for this.
+        """
+        if self._index_thread is None:
+            self._index_thread = threading.Thread(target=self._refresh_indexes_loop, name="search-index", daemon=True)
+            self._index_thread.start()
+
+    def mark_indexes_stale(self):
+        """Has the background thread refresh the indexes now instead of at its next interval."""
+        self._indexes_stale.set()
+
+    def _refresh_indexes_loop(self):
+        while not self._closing:
+            self._indexes_stale.clear()
+            try:
+                self.refresh_indexes()
+            except Exception as e:
+                print(f"Error refreshing the search indexes: {e}")
+            self._indexes_stale.wait(INDEX_REFRESH_SECONDS)
+
+    def recall_messages(self, text, chat_path):
+        """
+        (role, text) of the messages in other chats most similar to text,
+        for ContextManager.build(). A recalled question comes with the reply
+        that followed it. Nothing is recalled while the index is being
+        built on another thread.
+        """
+        recall = self._recall  # created (and built) by refresh_indexes(); nothing to find before that
+        if recall is None:
+            return []
+        with profiler.span("recall"):
+            hits = recall.search(text, RECALL_HITS, exclude=(os.path.basename(chat_path),),
+                                 min_score=RECALL_MIN_SCORE, wait=False)
+            recalled = []
+            seen = set()  # (chat, position) of the messages already included
+            for hit in hits:
+                if (hit.chat, hit.message) in seen:
+                    continue
+                messages = self.store.read_range(self.chat_path(hit.chat), hit.message, hit.message + 2)
+                if len(messages) == 2 and messages[0]["role"] == "user" and messages[1]["role"] == "assistant":
+                    seen.add((hit.chat, hit.message + 1))
+                else:
+                    messages = messages[:1]
+                recalled += [(msg["role"], msg["content"]) for msg in messages]
+                seen.add((hit.chat, hit.message))
+            return recalled
+
+    ############################
+    # The open chat
+    ############################
+
+    def open_chat(self, file_name):
+        """Makes file_name the active chat, with its latest messages loaded."""
+        self.detach_pending()
+        self.chat_history, self.active_chat_path = self.load_chat(file_name)
+        self.history_start = max(0, self.store.stored_count(self.active_chat_path) - PAGE_SIZE)
+
+    def open_chat_at(self, file_name, position):
+        """Makes file_name the active chat, with the messages around message number position loaded."""
+        self.detach_pending()
+        self.active_chat_path = self.chat_path(file_name)
+        self.history_start = max(0, position - PAGE_SIZE // 2)
+        self.chat_history = self.store.read_range(self.active_chat_path, self.history_start,
+                                                  self.history_start + PAGE_SIZE)
+        self.index.update(file_name)
+
+    def open_latest_chat(self):
+        """Opens the last chat in the folder, creating one if there are none."""
+        all_chats = self.chats()
+        if not all_chats:
+            self.active_chat_path = self.create_chat("New Chat")
+            self.chat_history = []
+            self.history_start = 0
+        else:
+            self.open_chat(all_chats[-1])
+
+    def new_chat(self, chat_name):
+        """Creates a chat and switches to it."""
+        new_chat_path = self.create_chat(chat_name)
+        self.leave_active_chat()
+        self.detach_pending()
+        self.active_chat_path = new_chat_path
+        self.chat_history = []
+        self.history_start = 0
+        return new_chat_path
+
+    def persist_active_chat(self):
+        """
+        Queues the newly settled messages of the open chat: those after the
+        ones already stored, up to the first reply that is still in flight.
+        Stopping there keeps the file in the same order as chat_history.
+        """
+        start = self.store.stored_count(self.active_chat_path) - self.history_start
+        if start < 0 or start > len(self.chat_history):
+            return
+        end = start
+        while end < len(self.chat_history) and "pending" not in self.chat_history[end]:
+            end += 1
+        if end > start:
+            self.store.append(self.active_chat_path, self.chat_history[start:end])
+            self.mark_indexes_stale()
+
+    def is_at_latest(self):
+        """True if the loaded window of the open chat reaches its last stored message."""
+        return self.history_start + len(self.chat_history) >= self.store.stored_count(self.active_chat_path)
+
+    def load_older_messages(self):
+        """
+        Pages in the messages just above the loaded window. To bound memory
+        the newest messages are dropped again once more than
+        MAX_LOADED_MESSAGES are loaded. Returns how many were added at the front.
+        """
+        new_start = max(0, self.history_start - PAGE_SIZE)
+        older = self.store.read_range(self.active_chat_path, new_start, self.history_start)
+        history = older + self.chat_history
+        excess = len(history) - MAX_LOADED_MESSAGES
+        if excess > 0 and not any("pending" in msg for msg in history[-excess:]):
+            history = history[:-excess]
+        self.chat_history, self.history_start = history, new_start
+        return len(older)
+
+    def load_newer_messages(self):
+        """
+        Pages in the messages just below the loaded window, dropping the
+        oldest ones over the limit. Returns how many were dropped from the front.
+        """
+        end = self.history_start + len(self.chat_history)
+        newer = self.store.read_range(self.active_chat_path, end, end + PAGE_SIZE)
+        excess = max(0, len(self.chat_history) + len(newer) - MAX_LOADED_MESSAGES)
+        self.chat_history = self.chat_history[excess:] + newer
+        self.history_start += excess
+        return excess
+
+    def leave_active_chat(self):
+        """
+        Saves the open chat before switching away from it. Requests that were
+        not sent yet are cancelled; ones already in flight are left to finish
+        and land in this chat's file via apply_result().
+        """
+        if self._worker is not None:
+            for request_id in self._worker.cancel_queued(self.active_chat_path):
+                i = self.find_pending(request_id)
+                if i is not None:
+                    del self.chat_history[i]
+        self.save_chat(self.chat_history, self.active_chat_path, self.history_start)
+
+    def detach_pending(self):
+        """
+        Records where in the file each reply still in flight belongs (right
+        after the message it answers) before the open chat's placeholders are
+        dropped, so apply_result() can put the reply there.
+        """
+        position = self.history_start
+        for msg in self.chat_history:
+            if "pending" in msg:
+                self._reply_positions[msg["pending"]] = [self.active_chat_path, position]
+            else:
+                position += 1
+
+    ############################
+    # Requests
+    ############################
+
+    def send_message(self, text):
+        """
+        Appends the user's message to the active chat and queues the API request
+        on the background worker. A placeholder reply carrying the request id
+        stands in for the answer until apply_result() fills it in.
+        Returns the request id.
+        """
+        if not self.is_at_latest():
+            self.open_chat(os.path.basename(self.active_chat_path))
+        self.chat_history.append({"role": "user", "content": text})
+        self.persist_active_chat()
+
+        # Build the message set for the API, trimmed to the model's token budget
+        history = [msg for msg in self.chat_history if "role" in msg and "content" in msg and "pending" not in msg]
+        recalled = self.recall_messages(text, self.active_chat_path)
+        with profiler.span("build context"):
+            messages_to_send = self.context.build(self.model, history, self.system_instructions, recalled)
+
+        request_id = self.worker.submit(self.active_chat_path, self.model, messages_to_send, stream=self.stream)
+        self.chat_history.append({"role": "assistant", "content": PENDING_TEXT, "pending": request_id})
+        return request_id
+
+    def compare_requests(self, text, models):
+        """
+        Returns model -> the messages send_message(text) would send it, for
+        comparing models on text (model_compare.Comparison). The chat itself
+        is left as it is.
+        """
+        history = [msg for msg in self.chat_history if "role" in msg and "content" in msg and "pending" not in msg]
+        history.append({"role": "user", "content": text})
+        recalled = self.recall_messages(text, self.active_chat_path)
+        return {model: self.context.build(model, history, self.system_instructions, recalled) for model in models}
+
+    def poll(self):
+        """Returns the ChatDeltas and ChatResults that arrived since the last call."""
+        return self._worker.poll() if self._worker is not None else []
+
+    def find_pending(self, request_id):
+        for i in range(len(self.chat_history) - 1, -1, -1):
+            if self.chat_history[i].get("pending") == request_id:
+                return i
+        return None
+
+    def apply_delta(self, delta):
+        """
+        Appends a piece of a streamed reply to its placeholder in the open chat.
+        Pieces for other chats are ignored; their full reply follows as a result.
+        Returns the position of the message in chat_history and whether the
+        placeholder text was replaced (rather than added to), or None.
+        """
+        if delta.chat_path != self.active_chat_path:
+            return None
+        i = self.find_pending(delta.request_id)
+        if i is None:
+            return None
+        msg = self.chat_history[i]
+        if msg["content"] == PENDING_TEXT:
+            msg["content"] = delta.text
+            return i, True
+        msg["content"] += delta.text
+        return i, False
+
+    def apply_result(self, result):
+        """
+        Delivers a finished request to the chat that issued it: the placeholder
+        in the open chat is replaced, and a reply whose placeholder is gone (the
+        user left or reloaded the chat) is inserted into the chat's file right
+        after the message it answers. Returns the position in chat_history of
+        the first message that changed, or None.
+        """
+        if result.error is not None:
+            print(f"API Error: {result.error}")
+            reply = {"role": "assistant", "content": "Error getting response"}
+        else:
+            reply = {"role": "assistant", "content": result.content}
+
+        if result.chat_path == self.active_chat_path:
+            i = self.find_pending(result.request_id)
+            if i is not None:
+                self.chat_history[i] = reply
+                self.persist_active_chat()
+                return i
+
+        path, position = self._reply_positions.pop(result.request_id, (result.chat_path, None))
+        if position is None:
+            position = self.store.stored_count(path)
+        try:
+            self.store.insert(path, position, [reply])
+            self.index.update(os.path.basename(path))
+            self.mark_indexes_stale()
+        except Exception as e:
+            print(f"Error saving reply to {path}: {e}")
+            return None
+        for entry in self._reply_positions.values():
+            if entry[0] == path and entry[1] >= position:
+                entry[1] += 1
+
+        if path != self.active_chat_path:
+            return None
+        i = position - self.history_start
+        if i < 0:
+            self.history_start += 1
+        elif i <= len(self.chat_history):
+            # The chat was reopened while the request was in flight
+            self.chat_history.insert(i, reply)
+            return i
+        return None
+
+    def close(self):
+        """Saves the open chat and the search index, and stops the background threads."""
+        if self.active_chat_path:
+            self.save_chat(self.chat_history, self.active_chat_path, self.history_start)
+        self._closing = True
+        self._indexes_stale.set()
+        if self._worker is not None:
+            self._worker.stop()
+        self.search.save(wait=False)
+        self.store.close()
+        if self.response_cache is not None:
+            print(f"Response cache: {self.response_cache.stats()}")
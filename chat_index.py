@@ -0,0 +1,150 @@
+"""
+In-memory index of the saved chats in the chat folder.
+
+The folder is listed once and re-listed only when asked to (after a chat is
+created, loaded or saved) or when the folder's own mtime changes, which is
+checked at most once per check_interval seconds. This keeps the sidebar
+from hitting the filesystem on every frame.
+"""
+
+import json
+import os
+import time
+
+from chat_archive import ARCHIVE_SUFFIX, read_count
+from chat_storage import CHAT_EXTENSION
+
+
+class ChatInfo:
+    """Metadata about one saved chat file. path is the file on disk, which is an archive for archived chats."""
+
+    __slots__ = ("name", "path", "modified", "size", "_message_count")
+
+    def __init__(self, name, path, modified, size):
+        self.name = name
+        self.path = path
+        self.modified = modified
+        self.size = size
+        self._message_count = None
+
+    @property
+    def title(self):
+        return os.path.splitext(self.name)[0]
+
+    @property
+    def message_count(self):
+        """Number of messages in the chat, read from disk the first time it is asked for."""
+        if self._message_count is None:
+            try:
+                if self.path.endswith(ARCHIVE_SUFFIX):
+                    self._message_count = read_count(self.path)
+                    return self._message_count
+                with open(self.path, "rb") as f:
+                    if self.name.endswith(CHAT_EXTENSION):
+                        self._message_count = sum(1 for line in f if line.strip())
+                    else:
+                        history = json.load(f)
+                        self._message_count = len(history) if isinstance(history, list) else 0
+            except (OSError, ValueError):
+                self._message_count = 0
+        return self._message_count
+
+
+class ChatIndex:
+    def __init__(self, folder, extension=CHAT_EXTENSION, check_interval=1.0):
+        self.folder = folder
+        self.extension = extension
+        self.check_interval = check_interval
+        self.chats = []
+        self._by_name = {}
+        self._folder_mtime = None
+        self._last_check = 0.0
+        self._dirty = True
+
+    def __len__(self):
+        self.refresh()
+        return len(self.chats)
+
+    def names(self):
+        self.refresh()
+        return [chat.name for chat in self.chats]
+
+    def get(self, name):
+        self.refresh()
+        return self._by_name.get(name)
+
+    def mark_dirty(self):
+        """Forces the next refresh() to re-list the folder."""
+        self._dirty = True
+
+    def refresh(self):
+        """
+        Re-lists the folder if it was marked dirty or its mtime changed.
+        Returns True if the list of chats was re-read.
+        """
+        now = time.monotonic()
+        if not self._dirty and now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+
+        try:
+            folder_mtime = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            folder_mtime = None
+        if not self._dirty and folder_mtime == self._folder_mtime:
+            return False
+        self._folder_mtime = folder_mtime
+        self._dirty = False
+        self._rescan()
+        return True
+
+    def update(self, name):
+        """Re-reads the metadata of a single chat (e.g. right after saving it)."""
+        path = os.path.join(self.folder, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            try:
+                path += ARCHIVE_SUFFIX
+                st = os.stat(path)
+            except OSError:
+                self.mark_dirty()
+                return
+        chat = self._by_name.get(name)
+        if chat is None:
+            self.mark_dirty()
+            return
+        if (chat.modified, chat.size) != (st.st_mtime, st.st_size):
+            self._by_name[name] = self.chats[self.chats.index(chat)] = ChatInfo(name, path, st.st_mtime, st.st_size)
+
+    def _rescan(self):
+        chats = []
+        by_name = {}
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError:
+            entries = []
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            # Archived chats are listed under the name of the chat file they replaced
+            # (the JSONL file wins while a chat is being archived or restored)
+            name = entry.name
+            if name.endswith(ARCHIVE_SUFFIX):
+                name = name[:-len(ARCHIVE_SUFFIX)]
+                if name in names:
+                    continue
+            if not name.endswith(self.extension):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            chat = self._by_name.get(name)
+            # Keep the old entry (and its cached message count) if the file is unchanged
+            if chat is None or (chat.path, chat.modified, chat.size) != (entry.path, st.st_mtime, st.st_size):
+                chat = ChatInfo(name, entry.path, st.st_mtime, st.st_size)
+            chats.append(chat)
+            by_name[name] = chat
+        chats.sort(key=lambda chat: chat.name)
+        self.chats = chats
+        self._by_name = by_name
@@ -0,0 +1,377 @@
+"""
+Layout for the chat message bubbles.
+
+A message is parsed into markdown blocks (chat_markdown) and each block is
+laid out into positioned runs of text: wrapped paragraph lines, list
+markers, headings and syntax-highlighted code rows. Layouts are computed
+once per (content, max_width, fonts) and cached, so the scroll height
+calculation and the renderer share the same result instead of parsing and
+re-wrapping every message on every frame. Wrapped lines are memoized too,
+so laying out a message again (a streamed reply that grew) only wraps the
+lines that are new.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+
+from chat_markdown import highlight, parse, parse_tail
+
+# Padding around the text inside a bubble (kept in sync with render_messages)
+BUBBLE_PADDING_X = 40
+BUBBLE_PADDING_Y = 20
+LIST_INDENT = 20  # per nesting level
+CODE_PADDING = 6  # around the text inside a code block
+
+
+class MessageFonts:
+    """The fonts message text is set in."""
+
+    __slots__ = ("body", "heading", "code")
+
+    def __init__(self, body, heading, code):
+        self.body = body
+        self.heading = heading
+        self.code = code
+
+
+class BlockLayout:
+    """
+    One block laid out: runs of (x, y, text, font, style) relative to its
+    top left, where style is None for the text color or a
+    chat_markdown.SYNTAX_COLORS key, plus the (x, y, w, h) boxes drawn
+    behind code.
+    """
+
+    __slots__ = ("runs", "boxes", "width", "height")
+
+    def __init__(self, runs, boxes, width, height):
+        self.runs = runs
+        self.boxes = boxes
+        self.width = width
+        self.height = height
+
+
+class MessageLayout:
+    """The laid out blocks of one message, their y positions and the size of its bubble."""
+
+    __slots__ = ("content", "blocks", "parts", "tops", "bubble_width", "bubble_height")
+
+    def __init__(self, content, blocks, parts, spacing):
+        self.content = content
+        self.blocks = blocks
+        self.parts = parts
+        # Blocks are spaced apart, except the items of a list
+        gaps = [0 if a.kind == b.kind == "item" else spacing for a, b in zip(blocks, blocks[1:])]
+        self.tops = list(accumulate((part.height + gap for part, gap in zip(parts, gaps)), initial=0))
+        height = self.tops[-1] + parts[-1].height if parts else 0
+        self.bubble_width = max((part.width for part in parts), default=0) + BUBBLE_PADDING_X
+        self.bubble_height = height + BUBBLE_PADDING_Y
+
+
+class LayoutCache:
+    """
+    LRU cache of MessageLayout objects.
+
+    Word widths are memoized per font and wrapped lines per (line, width,
+    font) as well, so laying out a new message mostly costs one font.size
+    call per produced line.
+    """
+
+    def __init__(self, max_entries=10000, max_lines=20000):
+        self.max_entries = max_entries
+        self.max_lines = max_lines
+        self._layouts = OrderedDict()
+        self._lines = OrderedDict()
+        self._word_widths = {}
+
+    def get(self, content, fonts, max_width):
+        key = (content, max_width, fonts)
+        layout = self._layouts.get(key)
+        if layout is not None:
+            self._layouts.move_to_end(key)
+            return layout
+
+        blocks = parse(content)
+        parts = [self.layout_block(block, fonts, max_width) for block in blocks]
+        layout = MessageLayout(content, blocks, parts, self.block_spacing(fonts))
+        self._store(key, layout)
+        return layout
+
+    def extend(self, layout, content, fonts, max_width):
+        """
+        Lays out content, which is layout.content with more text appended
+        (a streamed reply). Only the last block of the old layout and what
+        follows it are parsed and laid out again; appending text cannot
+        change the blocks before it.
+        """
+        if not content.startswith(layout.content) or not layout.blocks:
+            return self.get(content, fonts, max_width)
+        key = (content, max_width, fonts)
+        cached = self._layouts.get(key)
+        if cached is not None:
+            return cached
+
+        blocks = parse_tail(layout.blocks, content)
+        kept = len(layout.blocks) - 1
+        parts = layout.parts[:kept] + [self.layout_block(block, fonts, max_width) for block in blocks[kept:]]
+        extended = MessageLayout(content, blocks, parts, self.block_spacing(fonts))
+        # The partial layouts of a stream are never needed again
+        self._layouts.pop((layout.content, max_width, fonts), None)
+        self._store(key, extended)
+        return extended
+
+    def _store(self, key, layout):
+        self._layouts[key] = layout
+        if len(self._layouts) > self.max_entries:
+            self._layouts.popitem(last=False)
+
+    def clear(self):
+        self._layouts.clear()
+        self._lines.clear()
+        self._word_widths.clear()
+
+    ############################
+    # Blocks
+    ############################
+
+    @staticmethod
+    def block_spacing(fonts):
+        return fonts.body.get_linesize() // 2
+
+    def layout_block(self, block, fonts, max_width):
+        if block.kind == "code":
+            return self.layout_code(block, fonts.code, max_width)
+        font = fonts.heading if block.kind == "heading" else fonts.body
+        x = 0
+        runs = []
+        if block.kind == "item":
+            indent = min(block.level * LIST_INDENT, max_width // 2)
+            runs.append((indent, 0, block.marker, font, None))
+            x = indent + self.word_width(font, block.marker + " ")
+        line_height = font.get_linesize()
+        width = 0
+        y = 0
+        for line in block.lines:
+            rows, row_widths = self.wrap_line(line, font, max_width - x)
+            for row, row_width in zip(rows, row_widths):
+                runs.append((x, y, row, font, None))
+                width = max(width, x + row_width)
+                y += line_height
+        return BlockLayout(runs, [], width, max(y, line_height))
+
+    def layout_code(self, block, font, max_width):
+        """Code keeps its indentation and is wrapped by character, each row split into highlighted pieces."""
+        line_height = font.get_linesize()
+        runs = []
+        width = 0
+        y = CODE_PADDING
+        for line in block.lines or [""]:
+            for row_width, pieces in self.wrap_code_line(line, font, max_width - 2 * CODE_PADDING):
+                for x, text, style in pieces:
+                    runs.append((CODE_PADDING + x, y, text, font, style))
+                width = max(width, CODE_PADDING + row_width)
+                y += line_height
+        width += CODE_PADDING
+        height = y + CODE_PADDING
+        return BlockLayout(runs, [(0, 0, width, height)], width, height)
+
+    ############################
+    # Lines
+    ############################
+
+    def _cached_line(self, key):
+        rows = self._lines.get(key)
+        if rows is not None:
+            self._lines.move_to_end(key)
+        return rows
+
+    def _store_line(self, key, rows):
+        self._lines[key] = rows
+        if len(self._lines) > self.max_lines:
+            self._lines.popitem(last=False)
+
+    def wrap_line(self, line, font, max_width):
+        """Word-wraps one line of text; memoized, returns (rows, row widths)."""
+        key = ("text", line, max_width, font)
+        result = self._cached_line(key)
+        if result is None:
+            result = self.wrap(line.split(), font, max_width)
+            self._store_line(key, result)
+        return result
+
+    def wrap_code_line(self, line, font, max_width):
+        """
+        Breaks a line of code into rows no wider than max_width, anywhere
+        (code has no good places to break), and highlights it. Returns a
+        list of (row width, pieces) with pieces as (x, text, style). Memoized.
+        """
+        key = ("code", line, max_width, font)
+        rows = self._cached_line(key)
+        if rows is not None:
+            return rows
+
+        # Row boundaries from per-character widths, checked with one measurement per row
+        prefix = list(accumulate((self.word_width(font, ch) for ch in line), initial=0))
+        breaks = [0]
+        while prefix[-1] - prefix[breaks[-1]] > max_width:
+            start = breaks[-1]
+            end = max(start + 1, bisect_right(prefix, prefix[start] + max_width) - 1)
+            while end > start + 1 and font.size(line[start:end])[0] > max_width:
+                end -= 1
+            breaks.append(end)
+        breaks.append(len(line))
+
+        rows = [(prefix[end] - prefix[start], []) for start, end in zip(breaks, breaks[1:])]
+        pos = 0
+        row = 0
+        for text, style in highlight(line):
+            # Pieces that cross a row boundary are split
+            while text:
+                while pos >= breaks[row + 1]:
+                    row += 1
+                take = breaks[row + 1] - pos
+                rows[row][1].append((prefix[pos] - prefix[breaks[row]], text[:take], style))
+                text = text[take:]
+                pos += min(take, len(rows[row][1][-1][1]))
+        self._store_line(key, rows)
+        return rows
+
+    def word_width(self, font, word):
+        widths = self._word_widths.get(font)
+        if widths is None:
+            widths = self._word_widths[font] = {}
+        width = widths.get(word)
+        if width is None:
+            width = widths[word] = font.size(word)[0]
+        return width
+
+    def wrap(self, words, font, max_width):
+        """
+        Greedily breaks words into lines no wider than max_width.
+
+        The break point of each line is found by bisecting the cumulative
+        word widths, then confirmed with a single measurement of the joined
+        line (kerning can make the estimate slightly off). A word that is
+        wider than max_width on its own gets a line to itself.
+        """
+        lines = []
+        line_widths = []
+        if not words:
+            return lines, line_widths
+
+        space = self.word_width(font, " ")
+        # prefix[i] is the width of words[:i], counting one space after each word
+        prefix = [0]
+        for word in words:
+            prefix.append(prefix[-1] + self.word_width(font, word) + space)
+
+        n = len(words)
+        start = 0
+        while start < n:
+            end = bisect_right(prefix, prefix[start] + max_width + space, start + 1) - 1
+            end = max(end, start + 1)
+            line = " ".join(words[start:end])
+            width = font.size(line)[0]
+
+            # Correct the estimate in either direction
+            while end > start + 1 and width > max_width:
+                end -= 1
+                line = " ".join(words[start:end])
+                width = font.size(line)[0]
+            while end < n:
+                longer = " ".join(words[start:end + 1])
+                longer_width = font.size(longer)[0]
+                if longer_width > max_width:
+                    break
+                end, line, width = end + 1, longer, longer_width
+
+            lines.append(line)
+            line_widths.append(width)
+            start = end
+        return lines, line_widths
+
+
+class MessageIndex:
+    """
+    Prefix-sum index over the bubble heights of a chat history.
+
+    offsets[i] is the y position (relative to the top of the message list)
+    of the i-th drawable message, so the total height is a lookup and the
+    first visible message is found with a bisect instead of a full scan.
+    """
+
+    def __init__(self, layouts, spacing=10):
+        self.layouts = layouts
+        self.spacing = spacing
+        self.positions = []  # index into the history of each drawable message
+        self.entries = []    # MessageLayout of each drawable message
+        self.offsets = [0]
+        self._history = None
+        self._scanned = 0
+        self._key = None
+
+    @property
+    def total_height(self):
+        return self.offsets[-1]
+
+    def sync(self, history, fonts, max_width):
+        """
+        Brings the index up to date with history. Messages appended since the
+        last call are laid out and added; anything else (a different list,
+        a shorter list, a new width or fonts) rebuilds the index.
+        """
+        key = (fonts, max_width)
+        if history is not self._history or key != self._key or len(history) < self._scanned:
+            self._history = history
+            self._key = key
+            self.positions = []
+            self.entries = []
+            self.offsets = [0]
+            self._scanned = 0
+
+        for i in range(self._scanned, len(history)):
+            msg = history[i]
+            if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
+                continue
+            if msg["role"] not in ["user", "assistant"]:
+                continue
+            layout = self.layouts.get(msg["content"], fonts, max_width)
+            self.positions.append(i)
+            self.entries.append(layout)
+            self.offsets.append(self.offsets[-1] + layout.bubble_height + self.spacing)
+        self._scanned = len(history)
+
+    def invalidate(self, position):
+        """
+        Forgets history[position:] so the next sync() lays those messages out
+        again. Used when a message is edited in place rather than appended.
+        """
+        if position >= self._scanned:
+            return
+        keep = bisect_left(self.positions, position)
+        del self.positions[keep:]
+        del self.entries[keep:]
+        del self.offsets[keep + 1:]
+        self._scanned = position
+
+    def update_tail(self, position):
+        """
+        Re-lays out history[position] after text was appended to it. When it
+        is the last message only its last block is laid out again and a single
+        offset changes; otherwise the index falls back to invalidate().
+        """
+        history = self._history
+        if not self.positions or self.positions[-1] != position or self._scanned != position + 1:
+            self.invalidate(position)
+            return
+        fonts, max_width = self._key
+        layout = self.layouts.extend(self.entries[-1], history[position]["content"], fonts, max_width)
+        self.entries[-1] = layout
+        self.offsets[-1] = self.offsets[-2] + layout.bubble_height + self.spacing
+
+    def visible_range(self, top, bottom):
+        """Returns the range of entries that intersect the y span [top, bottom)."""
+        first = max(bisect_right(self.offsets, top) - 1, 0)
+        last = bisect_left(self.offsets, bottom, first)
+        return range(first, min(last, len(self.entries)))
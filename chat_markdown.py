@@ -0,0 +1,140 @@
+"""
+Markdown structure of chat messages.
+
+A message is split into a flat list of blocks: paragraphs, headings, list
+items and fenced code blocks. Only this block structure is parsed; inline
+markup (**bold**, `code`, links) stays in the text as written. Line breaks
+inside a paragraph are kept, as chat replies rely on them.
+
+Each block remembers where its source starts, so a reply that is still
+streaming in is re-parsed from its last block onwards (parse_tail) instead
+of from the top. Code lines are split into tokens for syntax highlighting
+by highlight(), which is deliberately simple: one regex, no state carried
+between lines.
+"""
+
+import re
+
+FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})\s*([^`\s]*)")
+HEADING = re.compile(r"^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$")
+LIST_ITEM = re.compile(r"^(\s*)([-*+]|\d{1,9}[.)])\s+(.*)$")
+BULLET = "•"
+
+TOKEN = re.compile(r"""
+    (?P<comment>\#.*|//.*)
+  | (?P<string>"(?:\\.|[^"\\])*"?|'(?:\\.|[^'\\])*'?)
+  | (?P<number>\b(?:0[xX][0-9a-fA-F]+|\d[\d_]*(?:\.\d+)?(?:[eE][+-]?\d+)?)\b)
+  | (?P<word>\b[A-Za-z_]\w*\b)
+""", re.VERBOSE)
+
+# Keywords of the languages replies most often contain (Python, JavaScript, C-like, Go, Rust, shell)
+KEYWORDS = frozenset("""
+    and as assert async await break case catch class const continue def default del do elif else
+    enum except export extends false False final finally fn for from func function go if impl import
+    in interface is lambda let match mut new nil None nonlocal not null or package pass private
+    protected pub public raise return self static struct super switch this throw throws true True
+    try type typeof use var void while with yield fi then done esac echo
+""".split())
+
+SYNTAX_COLORS = {
+    "keyword": (255, 170, 90),
+    "string": (160, 230, 130),
+    "comment": (165, 165, 185),
+    "number": (130, 200, 255),
+}
+
+
+class Block:
+    """
+    One block of a message. kind is "paragraph", "heading", "item" or
+    "code"; lines holds its text (for code, the lines between the fences).
+    level is the heading level or a list item's nesting depth.
+    """
+
+    __slots__ = ("kind", "start", "lines", "level", "marker", "language")
+
+    def __init__(self, kind, start, lines, level=0, marker="", language=""):
+        self.kind = kind
+        self.start = start  # offset of the block's first line in the message
+        self.lines = lines
+        self.level = level
+        self.marker = marker
+        self.language = language
+
+
+def parse(text, offset=0):
+    """The blocks of text; offset is added to the start of each (for parsing the tail of a message)."""
+    blocks = []
+    block = None  # the paragraph or list item the next line can continue
+    fence = None  # the open code block and its fence
+    pos = offset
+    for line in text.split("\n"):
+        start, pos = pos, pos + len(line) + 1
+        line = line.rstrip("\r")
+        if fence is not None:
+            code, marker = fence
+            if line.strip() and line.strip().strip(marker[0]) == "" and len(line.strip()) >= len(marker):
+                fence = None
+            else:
+                code.lines.append(line.expandtabs(4))
+            continue
+        if not line.strip():
+            block = None
+            continue
+
+        match = FENCE.match(line)
+        if match:
+            code = Block("code", start, [], language=match.group(2).lower())
+            blocks.append(code)
+            fence, block = (code, match.group(1)), None
+            continue
+        match = HEADING.match(line)
+        if match:
+            blocks.append(Block("heading", start, [match.group(2)], level=len(match.group(1))))
+            block = None
+            continue
+        match = LIST_ITEM.match(line)
+        if match:
+            marker = match.group(2)
+            block = Block("item", start, [match.group(3)], level=len(match.group(1).expandtabs(4)) // 2,
+                          marker=marker if marker[0].isdigit() else BULLET)
+            blocks.append(block)
+            continue
+        # Paragraph lines follow on from each other; a list item takes indented lines
+        if block is not None and (block.kind == "paragraph" or line[0].isspace()):
+            block.lines.append(line.strip())
+            continue
+        block = Block("paragraph", start, [line.strip()])
+        blocks.append(block)
+    return blocks
+
+
+def parse_tail(blocks, text):
+    """
+    The blocks of text, given the blocks of a shorter text it begins with.
+    Appending can only change the last block (or add new ones after it), so
+    the blocks before it are kept and the rest of text is parsed again.
+    """
+    if not blocks:
+        return parse(text)
+    start = blocks[-1].start
+    return blocks[:-1] + parse(text[start:], start)
+
+
+def highlight(line):
+    """Splits a line of code into (text, style) pieces; style is None for plain text or a SYNTAX_COLORS key."""
+    pieces = []
+    plain_start = 0
+    for match in TOKEN.finditer(line):
+        style = match.lastgroup
+        if style == "word":
+            if match.group() not in KEYWORDS:
+                continue
+            style = "keyword"
+        if match.start() > plain_start:
+            pieces.append((line[plain_start:match.start()], None))
+        pieces.append((match.group(), style))
+        plain_start = match.end()
+    if plain_start < len(line):
+        pieces.append((line[plain_start:], None))
+    return pieces
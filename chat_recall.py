@@ -0,0 +1,380 @@
+"""
+Semantic recall of messages from every saved chat.
+
+Each message is embedded as a hashed n-gram vector: its words and the
+character trigrams of each word are hashed into DIMENSIONS signed buckets,
+weighted by how often they occur, and the vector is normalized. Messages
+that share words (or parts of words, so "install" matches "installing")
+get a high cosine similarity, with no model to download.
+
+The vectors are stored as one float32 matrix in a file next to the chats,
+read through a memory map and searched with a single matrix-vector
+product, so a query over a million messages is a few tens of
+milliseconds. Like the full-text index, chats are re-read only from where
+the last pass stopped, and new vectors are appended to the file; the rest
+of the index is saved in the same JSON-plus-raw-arrays format, never
+pickled.
+
+    python chat_recall.py "how do I read a file line by line"
+"""
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from chat_archive import ARCHIVE_SUFFIX
+from chat_search import SearchHit, read_index_file, tokenize, write_index_file
+from chat_storage import CHAT_EXTENSION
+
+INDEX_VERSION = 3
+DIMENSIONS = 128
+MAX_EMBED_CHARS = 4000  # only the start of very long messages is embedded
+TRIGRAM_WEIGHT = 0.5
+ARCHIVED = -1  # "bytes indexed" of a chat indexed from its archive
+
+STOP_WORDS = frozenset("""
+    a an and are as at be but by can do does for from has have how i if in is it its me my
+    of on or so that the this to was we what when where which who why will with you your
+""".split())
+
+
+class Embedder:
+    """Turns text into hashed n-gram vectors. Hashes are stable across runs (crc32), so vectors can be saved."""
+
+    def __init__(self, dimensions=DIMENSIONS, max_cached=200000):
+        self.dimensions = dimensions
+        self.max_cached = max_cached
+        self._words = {}  # word -> (buckets, signed weights) of the word and its trigrams
+
+    def word_features(self, word):
+        features = self._words.get(word)
+        if features is None:
+            if len(self._words) >= self.max_cached:
+                self._words.clear()
+            buckets, weights = [], []
+            padded = f"<{word}>"
+            for gram, weight in [(word, 1.0)] + [(padded[i:i + 3], TRIGRAM_WEIGHT) for i in range(len(padded) - 2)]:
+                h = zlib.crc32(gram.encode("utf-8"))
+                buckets.append(h % self.dimensions)
+                weights.append(weight if h & 0x80000000 else -weight)
+            features = self._words[word] = (buckets, weights)
+        return features
+
+    def embed(self, texts):
+        """An array of one unit-length float32 row per text (all zeros for text with no words)."""
+        positions, weights = [], []
+        for row, text in enumerate(texts):
+            offset = row * self.dimensions
+            counts = Counter(word for word in tokenize(text[:MAX_EMBED_CHARS]) if word not in STOP_WORDS)
+            for word, count in counts.items():
+                buckets, signed = self.word_features(word)
+                scale = 1 + math.log(count)
+                positions.extend(offset + bucket for bucket in buckets)
+                weights.extend(weight * scale for weight in signed)
+        vectors = np.bincount(np.asarray(positions, dtype=np.int64), weights=np.asarray(weights),
+                              minlength=len(texts) * self.dimensions)
+        vectors = vectors.reshape(len(texts), self.dimensions).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class ChatRecall:
+    def __init__(self, store, folder, index_path=None, dimensions=DIMENSIONS):
+        """store is the ChatStore the chats are read through."""
+        self.store = store
+        self.folder = folder
+        self.index_path = index_path or os.path.join(folder, ".recall_index")
+        self.vectors_path = self.index_path + ".f32"
+        self.embedder = Embedder(dimensions)
+        self.vectors = None  # memory map of the stored vectors, one row per message
+        self.built = False  # set once the first refresh() has finished; searches find nothing before
+        self._loaded = False
+        self._changed = False
+        self._pending = []  # (chat id, position, text) of messages to embed
+        self._lock = threading.RLock()  # refresh() may run on a background thread
+
+    ############################
+    # Index maintenance
+    ############################
+
+    def _reset(self):
+        self.chats = {}                # file name -> [chat id, mtime_ns, bytes indexed, messages indexed, inode]
+        self.chat_names = []           # chat id -> file name
+        self.doc_chat = array("I")     # row -> chat id
+        self.doc_message = array("I")  # row -> position in its chat
+        self.dropped = set()           # ids of chats that were deleted or indexed again
+        self.vectors = None
+        self._truncate(0)
+        self._changed = True
+
+    def load(self):
+        """Loads the saved index, or starts an empty one if there is none (or it's unreadable)."""
+        self._loaded = True
+        try:
+            header, (doc_chat, doc_message) = read_index_file(self.index_path)
+            if header.get("version") != INDEX_VERSION or header.get("dimensions") != self.embedder.dimensions:
+                raise ValueError("old index version")
+            if len(doc_chat) != len(doc_message):
+                raise ValueError("index file is inconsistent")
+            if os.path.getsize(self.vectors_path) < self._row_bytes() * len(doc_chat):
+                raise ValueError("vector file is incomplete")
+            chats, chat_names, dropped = header["chats"], header["chat_names"], set(header["dropped"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Rebuilding recall index: {e}")
+            self._reset()
+            return
+        self.chats = chats
+        self.chat_names = chat_names
+        self.doc_chat = doc_chat
+        self.doc_message = doc_message
+        self.dropped = dropped
+        self._map_vectors()
+
+    def _row_bytes(self):
+        return self.embedder.dimensions * 4
+
+    def _map_vectors(self):
+        rows = len(self.doc_chat)
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                 shape=(rows, self.embedder.dimensions)) if rows else None
+
+    def _truncate(self, rows):
+        """Cuts the vector file to rows (dropping any written by a pass whose index wasn't saved)."""
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(rows * self._row_bytes())
+
+    def _save(self):
+        header = {
+            "version": INDEX_VERSION,
+            "dimensions": self.embedder.dimensions,
+            "chats": self.chats,
+            "chat_names": self.chat_names,
+            "dropped": sorted(self.dropped),
+        }
+        write_index_file(self.index_path, self.folder, header, [self.doc_chat, self.doc_message])
+
+    def refresh(self):
+        """
+        Brings the index up to date with the chat folder: messages of new and
+        grown chats are embedded and appended to the vector file, deleted
+        chats are dropped. Only what is already on disk is indexed.
+        """
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            dropped = len(self.dropped)
+            self._refresh()
+
+            # Rebuild once dropped chats make up a quarter of the rows
+            if len(self.dropped) > dropped and len(self.doc_chat) > 1000 and self._dropped_rows() > len(self.doc_chat) // 4:
+                self._pending = []
+                self._reset()
+                self._refresh()
+            if self._changed:
+                self._append()
+            self.built = True
+
+    def _append(self):
+        """Embeds the pending messages, appends their vectors to the file and saves the index."""
+        pending, self._pending = self._pending, []
+        self.vectors = None  # release the map before the file changes
+        self._truncate(len(self.doc_chat))
+        with open(self.vectors_path, "ab") as f:
+            for start in range(0, len(pending), 1000):
+                batch = pending[start:start + 1000]
+                f.write(self.embedder.embed([text for _, _, text in batch]).tobytes())
+                for chat_id, position, _ in batch:
+                    self.doc_chat.append(chat_id)
+                    self.doc_message.append(position)
+            f.flush()
+            os.fsync(f.fileno())
+        self._save()
+        self._changed = False
+        self._map_vectors()
+
+    def _dropped_rows(self):
+        return int(np.isin(np.frombuffer(self.doc_chat, dtype=np.uint32), list(self.dropped)).sum())
+
+    def _refresh(self):
+        seen = set()
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError:
+            entries = []
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            archived = entry.name.endswith(ARCHIVE_SUFFIX)
+            name = entry.name[:-len(ARCHIVE_SUFFIX)] if archived else entry.name
+            if not name.endswith(CHAT_EXTENSION) or (archived and name in names):
+                continue
+            seen.add(name)
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if archived:
+                self._update_archive(name, os.path.join(self.folder, name), st)
+            else:
+                self._update(name, entry.path, st)
+
+        for name in [name for name in self.chats if name not in seen]:
+            self._drop(name)
+
+    def _new_chat(self, name):
+        chat = self.chats[name] = [len(self.chat_names), 0, 0, 0, 0]
+        self.chat_names.append(name)
+        return chat
+
+    def _update(self, name, path, st):
+        chat = self.chats.get(name)
+        if chat is not None:
+            if (chat[1], chat[2], chat[4]) == (st.st_mtime_ns, st.st_size, st.st_ino):
+                return
+            if st.st_size < chat[2] or chat[2] == ARCHIVED or chat[4] != st.st_ino:
+                # Rewritten rather than appended to (rewrites replace the file, so its inode changes)
+                self._drop(name)
+                chat = None
+        if chat is None:
+            chat = self._new_chat(name)
+
+        try:
+            with open(path, "rb") as f:
+                f.seek(chat[2])
+                data = f.read()
+        except OSError:
+            return
+        complete = data.rfind(b"\n") + 1  # a torn last line is indexed once it's finished
+        for line in data[:complete].splitlines():
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                msg = None
+            self._add(chat, msg)
+        chat[1] = st.st_mtime_ns
+        chat[2] += complete
+        chat[4] = st.st_ino
+        self._changed = True
+
+    def _update_archive(self, name, path, st):
+        """Embeds an archived chat, unless it was embedded before being archived (same messages)."""
+        chat = self.chats.get(name)
+        if chat is not None and (chat[1], chat[2]) == (st.st_mtime_ns, ARCHIVED):
+            return
+        try:
+            count = self.store.stored_count(path)
+            if chat is None or chat[3] != count:
+                if chat is not None:
+                    self._drop(name)
+                chat = self._new_chat(name)
+                for msg in self.store.read(path):
+                    self._add(chat, msg)
+        except (OSError, ValueError):
+            return
+        chat[1] = st.st_mtime_ns
+        chat[2] = ARCHIVED
+        self._changed = True
+
+    def _add(self, chat, msg):
+        """Queues a message for embedding; msg is None (or not a message) for a line that didn't parse."""
+        if isinstance(msg, dict) and isinstance(msg.get("content"), str) and msg["content"].strip():
+            self._pending.append((chat[0], chat[3], msg["content"]))
+        chat[3] += 1
+
+    def _drop(self, name):
+        """Forgets a chat. Its rows stay behind, masked by dropped, until the next rebuild."""
+        chat = self.chats.pop(name)
+        self.dropped.add(chat[0])
+        self._pending = [item for item in self._pending if item[0] != chat[0]]
+        self._changed = True
+
+    ############################
+    # Queries
+    ############################
+
+    def search(self, text, limit=5, exclude=(), min_score=0.0, wait=True):
+        """
+        Returns up to limit SearchHits for the messages most similar to
+        text, best first, scored by cosine similarity. Messages of the chats
+        named in exclude are skipped. The index is searched as it stands;
+        keeping it up to date is left to refresh(). Nothing is found before
+        the first refresh() has finished, nor with wait=False while another
+        thread is refreshing the index.
+        """
+        if not self.built or not self._lock.acquire(blocking=wait):
+            return []
+        try:
+            return self._search(text, limit, exclude, min_score)
+        finally:
+            self._lock.release()
+
+    def _search(self, text, limit, exclude, min_score):
+        if self.vectors is None or limit <= 0:
+            return []
+        query = self.embedder.embed([text])[0]
+        if not query.any():
+            return []
+        scores = self.vectors @ query
+
+        masked = set(self.dropped)
+        masked.update(self.chats[name][0] for name in exclude if name in self.chats)
+        if masked:
+            doc_chat = np.frombuffer(self.doc_chat, dtype=np.uint32)
+            scores[np.isin(doc_chat, list(masked))] = -1.0
+            del doc_chat  # doc_chat can't grow while a view of it exists
+
+        if limit < len(scores):
+            best = np.argpartition(scores, -limit)[-limit:]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(scores[best])[::-1]]
+
+        hits = []
+        for row in best:
+            score = float(scores[row])
+            if score <= min_score:
+                break
+            name = self.chat_names[self.doc_chat[row]]
+            position = self.doc_message[row]
+            messages = self.store.read_range(os.path.join(self.folder, name), position, position + 1)
+            if messages:
+                hits.append(SearchHit(name, position, score, messages[0]["content"]))
+        return hits
+
+
+def main():
+    from chat_core import CHAT_FOLDER
+    from chat_storage import ChatStore
+
+    parser = argparse.ArgumentParser(description="Find the saved messages most similar to some text")
+    parser.add_argument("query")
+    parser.add_argument("--folder", default=CHAT_FOLDER, help="folder of the saved chats")
+    parser.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args()
+
+    store = ChatStore(args.folder)
+    recall = ChatRecall(store, args.folder)
+    try:
+        start = time.perf_counter()
+        recall.refresh()
+        print(f"Indexed {len(recall.doc_chat)} messages in {time.perf_counter() - start:.1f}s")
+        start = time.perf_counter()
+        hits = recall.search(args.query, args.limit)
+        print(f"Searched in {(time.perf_counter() - start) * 1000:.1f} ms")
+        for hit in hits:
+            print(f"{hit.score:.3f}  {hit.chat} #{hit.message}: {hit.snippet(tokenize(args.query))}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
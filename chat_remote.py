@@ -0,0 +1,348 @@
+"""
+A ChatEngine stand-in that talks to chat_server.py instead of owning the chats.
+
+The pygame window uses it as a thin client when CHATBOT_SERVER is set: it
+keeps only the open chat's loaded window of messages, and everything else
+(saving, the API key, the search index) lives on the server. Replies are
+streamed from the server on background threads and delivered through
+poll() as the same ChatDelta and ChatResult objects the local worker
+produces. A background thread also watches the chat list and the open chat
+so messages other people send show up.
+"""
+
+import itertools
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+
+from chat_core import DEFAULT_MODEL, MAX_LOADED_MESSAGES, PAGE_SIZE, PENDING_TEXT
+from chat_search import SearchHit
+from chat_worker import ChatDelta, ChatResult
+
+
+class ChatUpdate:
+    """Messages someone else added to a chat, starting at message number start."""
+
+    __slots__ = ("chat_path", "start", "messages", "total")
+
+    def __init__(self, chat_path, start, messages, total):
+        self.chat_path = chat_path
+        self.start = start
+        self.messages = messages
+        self.total = total
+
+
+class RemoteChat:
+    """The part of chat_index.ChatInfo the window uses."""
+
+    __slots__ = ("name", "title", "modified")
+
+    def __init__(self, name, title, modified):
+        self.name = name
+        self.title = title
+        self.modified = modified
+
+
+class RemoteChatIndex:
+    """The chat list, as last fetched by the watcher thread."""
+
+    def __init__(self):
+        self.chats = []
+        self._latest = None
+        self._lock = threading.Lock()
+
+    def names(self):
+        return [chat.name for chat in self.chats]
+
+    def get(self, name):
+        return next((chat for chat in self.chats if chat.name == name), None)
+
+    def set(self, chats):
+        with self._lock:
+            self._latest = chats
+
+    def refresh(self):
+        """Takes over the list the watcher fetched last. Returns True if it changed."""
+        with self._lock:
+            latest, self._latest = self._latest, None
+        if latest is None:
+            return False
+        if [(c.name, c.modified) for c in latest] == [(c.name, c.modified) for c in self.chats]:
+            return False
+        self.chats = latest
+        return True
+
+
+class RemoteChatEngine:
+    def __init__(self, url, stream=True, timeout=30, watch_interval=1.0):
+        self.url = url.rstrip("/")
+        self.stream = stream
+        self.timeout = timeout
+        self.watch_interval = watch_interval
+        self._local = threading.local()  # a requests session per thread
+
+        settings = self._get("/settings")
+        self.model = settings.get("model", DEFAULT_MODEL)
+        self.system_instructions = settings.get("system_instructions", "")
+
+        self.index = RemoteChatIndex()
+        self.index.set(self._fetch_chats())
+        self.index.refresh()
+
+        # The open chat: chat_history is the loaded part, starting at message
+        # history_start; total is how many messages the server last said it has
+        self.active_chat_path = None
+        self.chat_history = []
+        self.history_start = 0
+        self.total = 0
+
+        self._ids = itertools.count(1)
+        self._results = queue.Queue()
+        self._positions = {}  # request id -> (server position of the user message, total after the reply)
+        self._out_of_order = False  # someone else's message landed between ours; reload once settled
+        self._senders = ThreadPoolExecutor(max_workers=8, thread_name_prefix="chat-remote")
+        self._stopped = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, name="chat-remote-watch", daemon=True)
+        self._watcher.start()
+
+    ############################
+    # HTTP
+    ############################
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _get(self, path, **params):
+        response = self.session.get(self.url + path, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def _post(self, path, payload, **kwargs):
+        return self.session.post(self.url + path, json=payload, timeout=self.timeout, **kwargs)
+
+    def _fetch_chats(self):
+        return [RemoteChat(c["name"], c["title"], c["modified"]) for c in self._get("/chats")["chats"]]
+
+    def _read(self, name, **params):
+        data = self._get("/chats/" + quote(name), **params)
+        return data["start"], data["messages"], data["total"]
+
+    ############################
+    # Saved chats
+    ############################
+
+    def chats(self):
+        return self.index.names()
+
+    def chat_path(self, file_name):
+        return file_name
+
+    def create_chat(self, chat_name):
+        response = self._post("/chats", {"name": chat_name})
+        if response.status_code == 409:
+            raise ValueError(response.json().get("error"))
+        response.raise_for_status()
+        name = response.json()["name"]
+        self.index.set(self._fetch_chats())
+        return name
+
+    def search_chats(self, query, limit=20):
+        response = self._get("/search", q=query, limit=limit)
+        if response.get("indexing"):
+            return None
+        hits = response["hits"]
+        return [SearchHit(hit["chat"], hit["message"], hit["score"], hit["text"]) for hit in hits]
+
+    ############################
+    # The open chat
+    ############################
+
+    def open_chat(self, file_name):
+        self.history_start, self.chat_history, self.total = self._read(file_name, tail=PAGE_SIZE)
+        self.active_chat_path = file_name
+
+    def open_chat_at(self, file_name, position):
+        start = max(0, position - PAGE_SIZE // 2)
+        self.history_start, self.chat_history, self.total = self._read(file_name, start=start, end=start + PAGE_SIZE)
+        self.active_chat_path = file_name
+
+    def open_latest_chat(self):
+        all_chats = self.chats()
+        if not all_chats:
+            self.new_chat("New Chat")
+        else:
+            self.open_chat(all_chats[-1])
+
+    def new_chat(self, chat_name):
+        name = self.create_chat(chat_name)
+        self.active_chat_path = name
+        self.chat_history = []
+        self.history_start = 0
+        self.total = 0
+        return name
+
+    def is_at_latest(self):
+        return self.history_start + len(self.chat_history) >= self.total
+
+    def load_older_messages(self):
+        """Same as ChatEngine.load_older_messages(), read from the server."""
+        new_start = max(0, self.history_start - PAGE_SIZE)
+        _, older, self.total = self._read(self.active_chat_path, start=new_start, end=self.history_start)
+        history = older + self.chat_history
+        excess = len(history) - MAX_LOADED_MESSAGES
+        if excess > 0 and not any("pending" in msg for msg in history[-excess:]):
+            history = history[:-excess]
+        self.chat_history, self.history_start = history, new_start
+        return len(older)
+
+    def load_newer_messages(self):
+        """Same as ChatEngine.load_newer_messages(), read from the server."""
+        end = self.history_start + len(self.chat_history)
+        _, newer, self.total = self._read(self.active_chat_path, start=end, end=end + PAGE_SIZE)
+        excess = max(0, len(self.chat_history) + len(newer) - MAX_LOADED_MESSAGES)
+        self.chat_history = self.chat_history[excess:] + newer
+        self.history_start += excess
+        return excess
+
+    def leave_active_chat(self):
+        """Nothing to save; replies still in flight are saved by the server."""
+
+    ############################
+    # Requests
+    ############################
+
+    def send_message(self, text):
+        """
+        Appends the user's message and a placeholder reply to the active chat
+        and sends it to the server on a background thread. Returns the request id.
+        """
+        if not self.is_at_latest():
+            self.open_chat(self.active_chat_path)
+        request_id = next(self._ids)
+        self.chat_history.append({"role": "user", "content": text})
+        self.chat_history.append({"role": "assistant", "content": PENDING_TEXT, "pending": request_id})
+        payload = {"content": text, "model": self.model, "system_instructions": self.system_instructions,
+                   "stream": self.stream}
+        self._senders.submit(self._send, request_id, self.active_chat_path, payload)
+        return request_id
+
+    def _send(self, request_id, name, payload):
+        try:
+            response = self._post(f"/chats/{quote(name)}/messages", payload, stream=payload["stream"])
+            with response:
+                if response.status_code >= 400:
+                    raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+                if payload["stream"]:
+                    result = None
+                    for line in response.iter_lines():
+                        if not line.startswith(b"data: "):
+                            continue
+                        event = json.loads(line[6:])
+                        if "delta" in event:
+                            self._results.put(ChatDelta(request_id, name, event["delta"]))
+                        elif event.get("done"):
+                            result = event
+                    if result is None:
+                        raise RuntimeError("The server closed the stream before the reply was complete")
+                else:
+                    result = response.json()
+            self._positions[request_id] = (result["start"], result["total"])
+            if "error" in result:
+                self._results.put(ChatResult(request_id, name, error=result["error"]))
+            else:
+                self._results.put(ChatResult(request_id, name, content=result["reply"]["content"]))
+        except Exception as e:
+            self._results.put(ChatResult(request_id, name, error=e))
+
+    def poll(self):
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def find_pending(self, request_id):
+        for i in range(len(self.chat_history) - 1, -1, -1):
+            if self.chat_history[i].get("pending") == request_id:
+                return i
+        return None
+
+    def apply_delta(self, delta):
+        """Same as ChatEngine.apply_delta()."""
+        if delta.chat_path != self.active_chat_path:
+            return None
+        i = self.find_pending(delta.request_id)
+        if i is None:
+            return None
+        msg = self.chat_history[i]
+        if msg["content"] == PENDING_TEXT:
+            msg["content"] = delta.text
+            return i, True
+        msg["content"] += delta.text
+        return i, False
+
+    def apply_result(self, result):
+        """
+        Like ChatEngine.apply_result(); the server has already saved the
+        reply. If someone else's messages landed between this message and
+        the one before it, the chat is reloaded to match the server's order.
+        Returns the position of a message replaced in place, or None.
+        """
+        if isinstance(result, ChatUpdate):
+            return self._apply_update(result)
+        start, total = self._positions.pop(result.request_id, (None, None))
+        if result.error is not None:
+            print(f"API Error: {result.error}")
+        if result.chat_path != self.active_chat_path:
+            return None
+        i = self.find_pending(result.request_id)
+        if i is None:
+            return None
+        self.chat_history[i] = {"role": "assistant",
+                                "content": result.content if result.content is not None else "Error getting response"}
+        if total is not None:
+            self.total = max(self.total, total)
+            self._out_of_order |= start != self.history_start + i - 1
+        if self._out_of_order and not self._has_pending():
+            self._out_of_order = False
+            self.open_chat(self.active_chat_path)
+            return None
+        return i
+
+    def _apply_update(self, update):
+        """Appends messages from other clients if they follow on from the loaded window."""
+        if update.chat_path != self.active_chat_path or self._has_pending():
+            return None
+        if update.start == self.history_start + len(self.chat_history):
+            self.chat_history.extend(update.messages)
+            self.total = max(self.total, update.total)
+        return None
+
+    def _has_pending(self):
+        return any("pending" in msg for msg in self.chat_history)
+
+    def _watch(self):
+        """Fetches the chat list and any new messages of the open chat every watch_interval."""
+        while not self._stopped.wait(self.watch_interval):
+            try:
+                self.index.set(self._fetch_chats())
+                name, end = self.active_chat_path, self.history_start + len(self.chat_history)
+                if name is not None and end >= self.total and not self._has_pending():
+                    start, messages, total = self._read(name, start=end, end=end + PAGE_SIZE)
+                    if messages:
+                        self._results.put(ChatUpdate(name, start, messages, total))
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print(f"Error contacting the chat server: {e}")
+
+    def close(self):
+        self._stopped.set()
+        self._senders.shutdown(wait=False, cancel_futures=True)
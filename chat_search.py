@@ -0,0 +1,452 @@
+"""
+Full-text search over every saved chat.
+
+An inverted index maps each word to the messages containing it (and how
+often), plus each pair of adjacent words to the messages containing that
+pair, so phrase queries only look at messages that contain all of the
+phrase's word pairs. Messages are numbered in the order they were indexed
+and postings are kept sorted by that number, so intersections bisect
+instead of building sets and the newest matches come first.
+
+Chats are append-only, so a chat whose file grew is indexed from where the
+last pass stopped; one whose mtime and size are unchanged is skipped, and
+one that shrank (compacted or replaced) is indexed again from scratch. The
+index is kept in a single file next to the chats and loaded on first use:
+a line of JSON followed by the raw postings arrays, so opening an index
+someone else wrote into a shared chat folder can't run any code (as
+unpickling it could).
+Queries never refresh the index; that is left to a background thread
+(ChatEngine.start_index_refresh), so typing a query never waits on the
+chat folder.
+"""
+
+import bisect
+import heapq
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+from array import array
+
+from chat_archive import ARCHIVE_SUFFIX
+from chat_storage import CHAT_EXTENSION
+
+INDEX_VERSION = 3
+ARCHIVED = -1  # "bytes indexed" of a chat indexed from its archive
+WORD_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+# At most this many of the newest matching messages are ranked, so very common words stay fast
+MAX_CANDIDATES = 5000
+# Phrase matches are confirmed against the message text; give up after this many reads per hit wanted
+VERIFY_READS_PER_HIT = 10
+
+
+def write_index_file(path, folder, header, arrays):
+    """
+    Atomically replaces path with header (a JSON object) on the first line,
+    followed by the raw bytes of each array.array in arrays.
+    """
+    header = dict(header, byteorder=sys.byteorder, arrays=[[a.typecode, len(a)] for a in arrays])
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps(header, separators=(",", ":")).encode("utf-8") + b"\n")
+            for a in arrays:
+                a.tofile(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_index_file(path):
+    """Returns (header, arrays) of a file written by write_index_file(); ValueError if it's malformed."""
+    with open(path, "rb") as f:
+        header = json.loads(f.readline())
+        if not isinstance(header, dict) or header.get("byteorder") != sys.byteorder:
+            raise ValueError("index was written on another platform")
+        arrays = []
+        for typecode, length in header["arrays"]:
+            if typecode not in ("I", "H"):
+                raise ValueError(f"unexpected array type {typecode!r}")
+            a = array(typecode)
+            data = f.read(length * a.itemsize)
+            if len(data) != length * a.itemsize:
+                raise ValueError("index file is incomplete")
+            a.frombytes(data)
+            arrays.append(a)
+    return header, arrays
+
+
+def split_postings(flat, lengths):
+    """Cuts one array into consecutive arrays of the given lengths."""
+    if sum(lengths) != len(flat):
+        raise ValueError("index file is inconsistent")
+    parts = []
+    start = 0
+    for length in lengths:
+        parts.append(flat[start:start + length])
+        start += length
+    return parts
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+def parse_query(query):
+    """Splits a query into phrases (lists of words). Quoted text is one phrase, other words are phrases of one."""
+    phrases = []
+    for quoted, word in QUERY_RE.findall(query):
+        words = tokenize(quoted if quoted else word)
+        if words:
+            phrases.append(words)
+    return phrases
+
+
+class SearchHit:
+    __slots__ = ("chat", "message", "score", "text")
+
+    def __init__(self, chat, message, score, text):
+        self.chat = chat        # file name of the chat
+        self.message = message  # position of the message in the chat
+        self.score = score
+        self.text = text
+
+    def snippet(self, words, width=80):
+        """A single line of the message around the first of words it contains."""
+        text = " ".join(self.text.split())
+        lowered = text.lower()
+        first = min((i for i in (lowered.find(w) for w in words) if i >= 0), default=0)
+        start = max(0, first - width // 4)
+        snippet = text[start:start + width]
+        if start > 0:
+            snippet = "..." + snippet
+        if start + width < len(text):
+            snippet += "..."
+        return snippet
+
+
+class ChatSearch:
+    def __init__(self, store, folder, index_path=None):
+        """store is the ChatStore the chats are read through."""
+        self.store = store
+        self.folder = folder
+        self.index_path = index_path or os.path.join(folder, ".search_index")
+        self.built = False  # set once the first refresh() has finished
+        self._loaded = False
+        self._changed = False
+        self._lock = threading.RLock()  # refresh() may run on a background thread
+
+    ############################
+    # Index maintenance
+    ############################
+
+    def _reset(self):
+        self.chats = {}            # file name -> [chat id, mtime_ns, bytes indexed, messages indexed, inode]
+        self.chat_names = []       # chat id -> file name
+        self.doc_chat = array("I")     # message number -> chat id
+        self.doc_message = array("I")  # message number -> position in its chat
+        self.words = {}            # word -> (array of message numbers, array of counts)
+        self.pairs = {}            # "word word" -> array of message numbers
+        self.deleted = set()       # message numbers of chats that were indexed again
+        self._changed = True
+
+    def load(self):
+        """Loads the saved index, or starts an empty one if there is none (or it's unreadable)."""
+        self._loaded = True
+        try:
+            header, (doc_chat, doc_message, word_docs, word_counts, pair_docs) = read_index_file(self.index_path)
+            if header.get("version") != INDEX_VERSION:
+                raise ValueError("old index version")
+            words = dict(zip(header["words"], zip(split_postings(word_docs, header["word_lengths"]),
+                                                  split_postings(word_counts, header["word_lengths"]))))
+            pairs = dict(zip(header["pairs"], split_postings(pair_docs, header["pair_lengths"])))
+            chats, chat_names, deleted = header["chats"], header["chat_names"], set(header["deleted"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Rebuilding search index: {e}")
+            self._reset()
+            return
+        self.chats = chats
+        self.chat_names = chat_names
+        self.doc_chat = doc_chat
+        self.doc_message = doc_message
+        self.words = words
+        self.pairs = pairs
+        self.deleted = deleted
+        self._changed = False
+
+    def save(self, wait=True):
+        """
+        Writes the index to disk if it changed since it was loaded or last
+        saved. With wait=False nothing is written while a refresh is running.
+        """
+        if not self._lock.acquire(blocking=wait):
+            return
+        try:
+            if self._loaded and self._changed:
+                self._save()
+        finally:
+            self._lock.release()
+
+    def _save(self):
+        # The postings of every word (and pair) are written as one array, cut up again on load
+        word_docs, word_counts, pair_docs = array("I"), array("H"), array("I")
+        for docs, counts in self.words.values():
+            word_docs.extend(docs)
+            word_counts.extend(counts)
+        for docs in self.pairs.values():
+            pair_docs.extend(docs)
+        header = {
+            "version": INDEX_VERSION,
+            "chats": self.chats,
+            "chat_names": self.chat_names,
+            "deleted": sorted(self.deleted),
+            "words": list(self.words),
+            "word_lengths": [len(docs) for docs, _ in self.words.values()],
+            "pairs": list(self.pairs),
+            "pair_lengths": [len(docs) for docs in self.pairs.values()],
+        }
+        write_index_file(self.index_path, self.folder, header,
+                         [self.doc_chat, self.doc_message, word_docs, word_counts, pair_docs])
+        self._changed = False
+
+    def refresh(self):
+        """
+        Brings the index up to date with the chat folder: new and grown chats
+        are indexed, deleted ones dropped. Queued messages are written first.
+        The folder is scanned before taking the lock, so searches are only
+        held up while changed chats are being indexed.
+        """
+        with self._lock:
+            if not self._loaded:
+                self.load()
+        self.store.flush()
+        chats = self._scan()
+        with self._lock:
+            self._refresh(chats)
+            self.built = True
+
+    def _scan(self):
+        """(name, path, stat, archived) of every chat in the folder."""
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError:
+            entries = []
+        names = {entry.name for entry in entries}
+        chats = []
+        for entry in entries:
+            archived = entry.name.endswith(ARCHIVE_SUFFIX)
+            name = entry.name[:-len(ARCHIVE_SUFFIX)] if archived else entry.name
+            if not name.endswith(CHAT_EXTENSION) or (archived and name in names):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            chats.append((name, os.path.join(self.folder, name) if archived else entry.path, st, archived))
+        return chats
+
+    def _refresh(self, chats):
+        for name, path, st, archived in chats:
+            if archived:
+                self._update_archive(name, path, st)
+            else:
+                self._update(name, path, st)
+
+        seen = {name for name, _, _, _ in chats}
+        for name in [name for name in self.chats if name not in seen]:
+            self._drop(name)
+
+        # Rebuild once stale postings of re-indexed chats make up a quarter of the index
+        if len(self.deleted) > len(self.doc_chat) // 4 and len(self.deleted) > 1000:
+            self._reset()
+            self._refresh(chats)
+
+    def _update(self, name, path, st):
+        chat = self.chats.get(name)
+        if chat is not None:
+            if (chat[1], chat[2], chat[4]) == (st.st_mtime_ns, st.st_size, st.st_ino):
+                return
+            if st.st_size < chat[2] or chat[2] == ARCHIVED or chat[4] != st.st_ino:
+                # Rewritten rather than appended to (rewrites replace the file, so its inode changes)
+                self._drop(name)
+                chat = None
+        if chat is None:
+            chat = self.chats[name] = [len(self.chat_names), 0, 0, 0, 0]
+            self.chat_names.append(name)
+
+        try:
+            with open(path, "rb") as f:
+                f.seek(chat[2])
+                data = f.read()
+        except OSError:
+            return
+        complete = data.rfind(b"\n") + 1  # a torn last line is indexed once it's finished
+        for line in data[:complete].splitlines():
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                msg = None
+            if isinstance(msg, dict) and isinstance(msg.get("content"), str):
+                self._add(chat[0], chat[3], msg["content"])
+            chat[3] += 1
+        chat[1] = st.st_mtime_ns
+        chat[2] += complete
+        chat[4] = st.st_ino
+        self._changed = True
+
+    def _update_archive(self, name, path, st):
+        """
+        Indexes an archived chat, read through the store. A chat that was
+        archived after being indexed has the same messages and is left alone.
+        """
+        chat = self.chats.get(name)
+        if chat is not None and (chat[1], chat[2]) == (st.st_mtime_ns, ARCHIVED):
+            return
+        try:
+            count = self.store.stored_count(path)
+            if chat is None or chat[3] != count:
+                if chat is not None:
+                    self._drop(name)
+                chat = self.chats[name] = [len(self.chat_names), 0, 0, 0, 0]
+                self.chat_names.append(name)
+                for msg in self.store.read(path):
+                    if isinstance(msg.get("content"), str):
+                        self._add(chat[0], chat[3], msg["content"])
+                    chat[3] += 1
+        except (OSError, ValueError):
+            return
+        chat[1] = st.st_mtime_ns
+        chat[2] = ARCHIVED
+        self._changed = True
+
+    def _add(self, chat_id, position, text):
+        doc = len(self.doc_chat)
+        self.doc_chat.append(chat_id)
+        self.doc_message.append(position)
+
+        words = tokenize(text)
+        counts = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        for word, count in counts.items():
+            postings = self.words.get(word)
+            if postings is None:
+                postings = self.words[word] = (array("I"), array("H"))
+            postings[0].append(doc)
+            postings[1].append(min(count, 65535))
+        for pair in {f"{a} {b}" for a, b in zip(words, words[1:])}:
+            postings = self.pairs.get(pair)
+            if postings is None:
+                postings = self.pairs[pair] = array("I")
+            postings.append(doc)
+
+    def _drop(self, name):
+        """Forgets a chat. Its postings stay behind, masked by deleted, until the next rebuild."""
+        chat = self.chats.pop(name)
+        chat_id = chat[0]
+        self.deleted.update(doc for doc, owner in enumerate(self.doc_chat) if owner == chat_id)
+        self._changed = True
+
+    ############################
+    # Queries
+    ############################
+
+    def search(self, query, limit=20):
+        """
+        Returns up to limit SearchHits for the messages containing every
+        word and quoted phrase of query, best first. Scores add up the
+        inverse document frequency of each word, weighted by how often it
+        occurs; ties go to the newer message.
+
+        The index is searched as it stands. Returns None instead while it
+        is being built, or while another thread is indexing changed chats,
+        rather than waiting.
+        """
+        if not self.built or not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return self._search(parse_query(query), limit)
+        finally:
+            self._lock.release()
+
+    def _search(self, phrases, limit):
+        if not phrases:
+            return []
+
+        words = sorted({word for phrase in phrases for word in phrase})
+        pairs = sorted({f"{a} {b}" for phrase in phrases for a, b in zip(phrase, phrase[1:])})
+        lists = []
+        for word in words:
+            postings = self.words.get(word)
+            if postings is None:
+                return []
+            lists.append(postings[0])
+        for pair in pairs:
+            postings = self.pairs.get(pair)
+            if postings is None:
+                return []
+            lists.append(postings)
+
+        # Walk the shortest list from the newest message back, bisecting into the others
+        lists.sort(key=len)
+        shortest, others = lists[0], lists[1:]
+        candidates = []
+        for i in range(len(shortest) - 1, -1, -1):
+            doc = shortest[i]
+            if doc in self.deleted:
+                continue
+            for other in others:
+                j = bisect.bisect_left(other, doc)
+                if j == len(other) or other[j] != doc:
+                    break
+            else:
+                candidates.append(doc)
+                if len(candidates) >= MAX_CANDIDATES:
+                    break
+
+        total = len(self.doc_chat) - len(self.deleted)
+        weights = []
+        for word in words:
+            docs, counts = self.words[word]
+            weights.append((docs, counts, math.log(1 + total / len(docs))))
+        scored = []
+        for doc in candidates:
+            score = 0.0
+            for docs, counts, idf in weights:
+                j = bisect.bisect_left(docs, doc)
+                score += idf * (1 + math.log(counts[j]))
+            scored.append((score, doc))
+
+        hits = []
+        reads = 0
+        for score, doc in heapq.nlargest(len(scored), scored):
+            if len(hits) >= limit or reads >= limit * VERIFY_READS_PER_HIT:
+                break
+            name = self.chat_names[self.doc_chat[doc]]
+            position = self.doc_message[doc]
+            messages = self.store.read_range(os.path.join(self.folder, name), position, position + 1)
+            reads += 1
+            if not messages:
+                continue
+            text = messages[0]["content"]
+            if pairs and not self._has_phrases(text, phrases):
+                continue
+            hits.append(SearchHit(name, position, score, text))
+        return hits
+
+    @staticmethod
+    def _has_phrases(text, phrases):
+        """True if text contains every phrase as consecutive words."""
+        words = tokenize(text)
+        for phrase in phrases:
+            n = len(phrase)
+            if n > 1 and not any(words[i:i + n] == phrase for i in range(len(words) - n + 1)):
+                return False
+        return True
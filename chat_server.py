@@ -0,0 +1,382 @@
+"""
+Serves one ChatEngine to many clients over a local HTTP API.
+
+Everyone connected shares the chats folder, the configured model and
+system instructions, and one pooled API client. Requests are handled on an
+asyncio event loop; calls to the API and disk reads run on a thread pool,
+so dozens of conversations can be waiting on replies at once. Messages
+sent to the same chat are handled one at a time (a lock per chat), so each
+user message is followed by its own reply in the file.
+
+    python chat_server.py --port 8700
+    CHATBOT_SERVER=http://127.0.0.1:8700 python AI-Chatbot.py
+
+Endpoints (JSON in and out):
+
+    GET  /chats                      the saved chats
+    POST /chats                      {"name"} creates a chat
+    GET  /chats/<name>               messages: ?tail=N, or ?start=&end=
+    POST /chats/<name>/messages      {"content", "model"?, "system_instructions"?, "stream"?}
+    GET  /search?q=&limit=           full-text search over every chat
+    GET  /settings, PUT /settings    {"model", "system_instructions"}
+
+With "stream": true a reply is sent as server-sent events: {"delta": text}
+for each piece, then {"done": true, "reply", "start", "total"}.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from chat_core import CHAT_FOLDER, MODELS, PAGE_SIZE, ChatEngine
+
+MAX_BODY_BYTES = 1024 * 1024
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found",
+           409: "Conflict", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_request(reader):
+    """Returns (method, target, headers, body) of the next request, or None once the client hangs up."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(400, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, headers, body
+
+
+def response_head(status, content_type, length=None, keep_alive=True):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Content-Type: {content_type}"]
+    if length is not None:
+        lines.append(f"Content-Length: {length}")
+    if not keep_alive:
+        lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def json_response(status, payload, keep_alive=True):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    return response_head(status, "application/json", len(data), keep_alive) + data
+
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class ChatServer:
+    def __init__(self, engine, max_workers=64):
+        """engine supplies the chats, settings and API client; max_workers bounds the threads doing blocking work."""
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-server")
+        self._locks = {}  # chat name -> asyncio.Lock, so replies land right after their message
+        self._index_lock = threading.Lock()    # the chat index is used from the executor's threads
+        self._context_lock = threading.Lock()  # so is the ContextManager, whose token cache isn't thread-safe
+
+    async def run_blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as e:
+                    writer.write(json_response(e.status, {"error": str(e)}, keep_alive=False))
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if not await self.dispatch(method, target, body, writer, keep_alive) or not keep_alive:
+                    break
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body, writer, keep_alive):
+        """Handles one request. Returns False if the connection has to be closed afterwards."""
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            payload = json.loads(body) if body else {}
+            if not isinstance(payload, dict):
+                raise HTTPError(400, "Expected a JSON object")
+            if parts == ["chats"] and method == "GET":
+                result = await self.list_chats()
+            elif parts == ["chats"] and method == "POST":
+                result = await self.create_chat(payload)
+            elif len(parts) == 2 and parts[0] == "chats" and method == "GET":
+                result = await self.read_chat(parts[1], query)
+            elif len(parts) == 3 and parts[0] == "chats" and parts[2] == "messages" and method == "POST":
+                if payload.get("stream"):
+                    await self.send_message(parts[1], payload, writer)
+                    return False  # the event stream ends when the connection closes
+                result = await self.send_message(parts[1], payload)
+            elif parts == ["search"] and method == "GET":
+                result = await self.search(query)
+            elif parts == ["settings"] and method == "GET":
+                result = self.settings()
+            elif parts == ["settings"] and method == "PUT":
+                result = self.update_settings(payload)
+            else:
+                raise HTTPError(404, f"No such endpoint: {method} {url.path}")
+            status = 201 if method == "POST" and parts == ["chats"] else 200
+            writer.write(json_response(status, result, keep_alive))
+        except HTTPError as e:
+            writer.write(json_response(e.status, {"error": str(e)}, keep_alive))
+        except ValueError as e:
+            writer.write(json_response(400, {"error": str(e)}, keep_alive))
+        except Exception as e:
+            print(f"Error handling {method} {target}: {e}")
+            writer.write(json_response(500, {"error": "Internal error"}, keep_alive))
+        return True
+
+    ############################
+    # Chats
+    ############################
+
+    async def chat_path(self, name):
+        """The path of an existing chat. Raises HTTPError(404) for names that aren't one."""
+        if os.path.basename(name) != name or await self.run_blocking(self.find_chat, name) is None:
+            raise HTTPError(404, f"No chat named '{name}'")
+        return self.engine.chat_path(name)
+
+    def find_chat(self, name):
+        """The ChatInfo of a chat, or None; re-lists the folder if it changed."""
+        with self._index_lock:
+            return self.engine.index.get(name)
+
+    def indexed_chats(self):
+        with self._index_lock:
+            self.engine.index.refresh()
+            return list(self.engine.index.chats)
+
+    def update_index(self, name):
+        with self._index_lock:
+            self.engine.index.update(name)
+
+    def chat_lock(self, name):
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        return lock
+
+    async def list_chats(self):
+        chats = await self.run_blocking(self.indexed_chats)
+        return {"chats": [{"name": chat.name, "title": chat.title, "modified": chat.modified}
+                          for chat in chats]}
+
+    async def create_chat(self, payload):
+        name = payload.get("name")
+        if not isinstance(name, str) or not name.strip():
+            raise HTTPError(400, "A chat needs a name")
+        try:
+            path = await self.run_blocking(self.engine.create_chat, name.strip())
+        except ValueError as e:
+            raise HTTPError(409, str(e))
+        return {"name": os.path.basename(path)}
+
+    async def read_chat(self, name, query):
+        path = await self.chat_path(name)
+        store = self.engine.store
+        total = await self.run_blocking(store.stored_count, path)
+        if "start" in query:
+            start = max(0, int(query["start"]))
+            end = min(total, int(query.get("end", start + PAGE_SIZE)))
+        else:
+            end = total
+            start = max(0, total - int(query.get("tail", PAGE_SIZE)))
+        messages = await self.run_blocking(store.read_range, path, start, end)
+        return {"start": start, "total": total, "messages": messages}
+
+    ############################
+    # Messages
+    ############################
+
+    async def send_message(self, name, payload, writer=None):
+        """
+        Appends a user message to a chat and its reply once the API answers.
+        With a writer the reply is streamed to it as server-sent events;
+        otherwise it is returned.
+        """
+        content = payload.get("content")
+        if not isinstance(content, str) or not content.strip():
+            raise HTTPError(400, "A message needs content")
+        model = payload.get("model") or self.engine.model
+        if model not in MODELS:
+            raise HTTPError(400, f"Unknown model '{model}'")
+        system_instructions = payload.get("system_instructions", self.engine.system_instructions)
+        path = await self.chat_path(name)
+        engine = self.engine
+
+        async with self.chat_lock(name):
+            history = await self.run_blocking(engine.store.read_tail, path, PAGE_SIZE)
+            start = await self.run_blocking(engine.store.stored_count, path)
+            user_message = {"role": "user", "content": content}
+            await self.run_blocking(engine.store.append, path, [user_message])
+            engine.mark_indexes_stale()
+            recalled = await self.run_blocking(engine.recall_messages, content, path)
+            messages = await self.run_blocking(self.build_context, model, history + [user_message],
+                                               system_instructions, recalled)
+
+            try:
+                if writer is None:
+                    text = await self.run_blocking(engine.client.complete, model, messages)
+                else:
+                    writer.write(response_head(200, "text/event-stream", keep_alive=False))
+                    text = await self.stream_reply(model, messages, writer)
+                reply, error = {"role": "assistant", "content": text}, None
+            except Exception as e:
+                print(f"API Error: {e}")
+                reply, error = {"role": "assistant", "content": "Error getting response"}, str(e)
+            await self.run_blocking(engine.store.append, path, [reply])
+            engine.mark_indexes_stale()
+            await self.run_blocking(self.update_index, name)
+
+        result = {"reply": reply, "start": start, "total": start + 2}
+        if error is not None:
+            result["error"] = error
+        if writer is None:
+            return result
+        result["done"] = True
+        writer.write(sse_event(result))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def build_context(self, model, history, system_instructions, recalled):
+        with self._context_lock:
+            return self.engine.context.build(model, history, system_instructions, recalled)
+
+    async def stream_reply(self, model, messages, writer):
+        """
+        Forwards each piece of a streamed reply to writer as it arrives and
+        returns the full text. The reply is still read to the end (and
+        saved) if the client goes away.
+        """
+        loop = asyncio.get_running_loop()
+        pieces = asyncio.Queue()
+
+        def produce():
+            try:
+                for text in self.engine.client.stream(model, messages):
+                    loop.call_soon_threadsafe(pieces.put_nowait, text)
+                loop.call_soon_threadsafe(pieces.put_nowait, None)
+            except Exception as e:
+                loop.call_soon_threadsafe(pieces.put_nowait, e)
+
+        producer = loop.run_in_executor(self.executor, produce)
+        parts = []
+        connected = True
+        while True:
+            piece = await pieces.get()
+            if piece is None:
+                break
+            if isinstance(piece, Exception):
+                await producer
+                raise piece
+            parts.append(piece)
+            if connected:
+                try:
+                    writer.write(sse_event({"delta": piece}))
+                    await writer.drain()
+                except ConnectionError:
+                    connected = False
+        await producer
+        return "".join(parts)
+
+    ############################
+    # Search and settings
+    ############################
+
+    async def search(self, query):
+        limit = int(query.get("limit", 20))
+        hits = await self.run_blocking(self.engine.search_chats, query.get("q", ""), limit)
+        if hits is None:
+            return {"hits": [], "indexing": True}
+        return {"hits": [{"chat": hit.chat, "message": hit.message, "score": hit.score, "text": hit.text}
+                         for hit in hits]}
+
+    def settings(self):
+        return {"model": self.engine.model, "system_instructions": self.engine.system_instructions,
+                "models": MODELS}
+
+    def update_settings(self, payload):
+        model = payload.get("model", self.engine.model)
+        if model not in MODELS:
+            raise HTTPError(400, f"Unknown model '{model}'")
+        system_instructions = payload.get("system_instructions", self.engine.system_instructions)
+        if not isinstance(system_instructions, str):
+            raise HTTPError(400, "system_instructions must be a string")
+        self.engine.model = model
+        self.engine.system_instructions = system_instructions
+        return self.settings()
+
+    ############################
+    # Running
+    ############################
+
+    async def serve(self, host="127.0.0.1", port=8700):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"Chat server listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.engine.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the chats and the configured assistant over local HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--folder", default=CHAT_FOLDER, help="folder of the saved chats")
+    parser.add_argument("--model", default=None, choices=MODELS)
+    parser.add_argument("--system", default="", help="system instructions sent with every message")
+    parser.add_argument("--max-workers", type=int, default=64, help="threads for API calls and disk reads")
+    parser.add_argument("--recall", choices=["off", "on"], help="send similar messages from other chats along"
+                        " with each request (default: CHATBOT_RECALL)")
+    args = parser.parse_args()
+
+    engine = ChatEngine(args.folder, stream=False, pool_size=args.max_workers, recall=args.recall)
+    if args.model:
+        engine.model = args.model
+    engine.system_instructions = args.system
+    engine.start_index_refresh()
+    server = ChatServer(engine, args.max_workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+"""
+Append-only chat storage.
+
+Each chat is a JSONL file with one message per line. New messages are
+queued and written by a background thread that batches everything that
+arrived during a flush window into one write + fsync per file, so saving
+costs O(new messages) rather than rewriting the whole history. Rewrites
+(compaction, migration) go through a temp file and an atomic rename.
+
+Next to each chat is an offset index (<chat>.jsonl.idx): the byte offset
+at which every message starts. With it any page of messages, such as the
+most recent ones when a chat is opened, is read with a single seek instead
+of parsing the whole file.
+
+Chats that are rarely opened can be archived (see chat_archive): the file
+is replaced by a compressed <chat>.jsonl.z that reads the same way through
+this class, under the same path, and is turned back into JSONL the first
+time a message is appended to it.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from array import array
+
+from chat_archive import ARCHIVE_SUFFIX, ChatArchive, write_archive
+from profiler import profiler
+
+CHAT_EXTENSION = ".jsonl"
+LEGACY_EXTENSION = ".json"
+INDEX_SUFFIX = ".idx"
+
+
+def is_valid_message(msg):
+    return isinstance(msg, dict) and 'role' in msg and 'content' in msg
+
+
+def encode_message(msg):
+    return (json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def line_offsets(data, base=0):
+    """Returns the offset (plus base) at which each newline-terminated line of data starts."""
+    offsets = array("Q")
+    pos = 0
+    while True:
+        end = data.find(b"\n", pos)
+        if end < 0:
+            return offsets
+        offsets.append(base + pos)
+        pos = end + 1
+
+
+def parse_messages(lines):
+    """The valid messages among encoded lines; anything else is skipped."""
+    messages = []
+    for line in lines:
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            continue
+        if is_valid_message(msg):
+            messages.append(msg)
+    return messages
+
+
+class ChatStore:
+    def __init__(self, folder, flush_interval=1.0):
+        self.folder = folder
+        self.flush_interval = flush_interval
+        # path -> [size covered, array of line offsets] for the data on disk
+        self._indexes = {}
+        self._archives = {}    # path -> open ChatArchive of an archived chat
+        self._pending = {}     # path -> encoded lines waiting for the writer
+        self._in_flight = {}   # the batch the writer is currently writing
+        self._flush_requested = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._file_lock = threading.RLock()  # taken before _cond when both are needed
+        self._writer = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+        self._writer.start()
+
+    ############################
+    # Reading and writing chats
+    ############################
+
+    def create(self, path):
+        """Creates an empty chat file. Raises FileExistsError if it exists."""
+        if os.path.exists(path + ARCHIVE_SUFFIX):
+            raise FileExistsError(f"{path} exists as an archive")
+        with open(path, "x"):
+            pass
+        with self._file_lock:
+            self._write_index(path, 0, array("Q"))
+
+    def stored_count(self, path):
+        """Returns how many messages of the chat at path are stored (or queued)."""
+        # Once the index is loaded this never waits for the writer's disk I/O
+        with self._cond:
+            index = self._indexes.get(path)
+            if index is not None:
+                return len(index[1]) + len(self._pending.get(path, ())) + len(self._in_flight.get(path, ()))
+        with self._file_lock:
+            archive = self._archive(path)
+            if archive is not None:
+                return archive.count
+            self._index(path)
+        return self.stored_count(path)
+
+    def read(self, path):
+        """Returns all the valid messages of a chat."""
+        return self.read_range(path, 0, self.stored_count(path))
+
+    def read_tail(self, path, count):
+        """Returns the last count messages of a chat."""
+        total = self.stored_count(path)
+        return self.read_range(path, max(0, total - count), total)
+
+    def read_range(self, path, start, end):
+        """
+        Returns messages start..end (exclusive) of a chat, reading only the
+        bytes they occupy. Lines that are not valid messages are skipped.
+        """
+        self.flush()
+        with self._file_lock:
+            archive = self._archive(path)
+            if archive is not None:
+                return parse_messages(archive.read_lines(start, end))
+            size, offsets = self._index(path)
+            end = min(end, len(offsets))
+            if start >= end:
+                return []
+            stop = offsets[end] if end < len(offsets) else size
+            with open(path, "rb") as f:
+                f.seek(offsets[start])
+                data = f.read(stop - offsets[start])
+        return parse_messages(data.splitlines())
+
+    def save(self, path, messages, start=0):
+        """
+        Persists messages, the part of the chat at path that begins with
+        message number start. Only the messages past the ones already
+        stored are queued for appending; nothing stored is ever rewritten.
+        """
+        count = self.stored_count(path)
+        if start + len(messages) > count:
+            self.append(path, messages[max(0, count - start):])
+
+    def append(self, path, messages):
+        """Queues messages to be appended to the chat at path, restoring it first if it's archived."""
+        lines = [encode_message(msg) for msg in messages]
+        with self._cond:
+            if path in self._indexes or not self.is_archived(path):
+                self._pending.setdefault(path, []).extend(lines)
+                self._cond.notify_all()
+                return
+        self.unarchive(path)
+        self.append(path, messages)
+
+    def insert(self, path, position, messages):
+        """
+        Puts messages before message number position of the chat at path.
+        At the end of the chat this is an append; otherwise the file (and its
+        index) is atomically replaced, so it is only for the odd late message.
+        The replaced file has a new inode, which tells the search and recall
+        indexes to index the whole chat again.
+        """
+        if position >= self.stored_count(path):
+            self.append(path, messages)
+            return
+        self.unarchive(path)
+        self.flush()
+        with self._file_lock:
+            size, offsets = self._index(path)
+            with open(path, "rb") as f:
+                data = f.read(size)
+            at = offsets[position] if position < len(offsets) else size
+            data = data[:at] + b"".join(encode_message(msg) for msg in messages) + data[at:]
+            self._replace(path, data)
+            self._write_index(path, len(data), line_offsets(data))
+
+    def compact(self, path, messages):
+        """Atomically replaces the chat at path (and its index) with exactly messages."""
+        self.flush()
+        data = b"".join(encode_message(msg) for msg in messages)
+        with self._file_lock:
+            self._replace(path, data)
+            self._write_index(path, len(data), line_offsets(data))
+            self._drop_archive(path)
+
+    def flush(self):
+        """Blocks until every queued message is written and fsynced."""
+        with self._cond:
+            if not self._pending and not self._in_flight:
+                return
+            self._flush_requested = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: not self._pending and not self._in_flight)
+
+    def close(self):
+        """Flushes and stops the writer thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        with self._file_lock:
+            for archive in self._archives.values():
+                archive.close()
+            self._archives.clear()
+
+    ############################
+    # Archives
+    ############################
+
+    def is_archived(self, path):
+        """True if the chat at path is stored as an archive rather than JSONL."""
+        return path in self._archives or (not os.path.exists(path) and os.path.exists(path + ARCHIVE_SUFFIX))
+
+    def archive(self, path):
+        """
+        Replaces the JSONL chat at path (and its offset index) with a
+        compressed archive. Returns False, changing nothing, if the chat has
+        messages waiting to be written or is already archived.
+        """
+        self.flush()
+        with self._file_lock:
+            if self.is_archived(path):
+                return False
+            size, offsets = self._index(path)
+            with open(path, "rb") as f:
+                data = f.read(size)
+            write_archive(path + ARCHIVE_SUFFIX, data.splitlines(keepends=True))
+            # Checked again with appends locked out, since one may have come in meanwhile
+            with self._cond:
+                if path in self._pending or path in self._in_flight:
+                    os.unlink(path + ARCHIVE_SUFFIX)
+                    return False
+                del self._indexes[path]
+                os.unlink(path)
+            try:
+                os.unlink(path + INDEX_SUFFIX)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def unarchive(self, path):
+        """Turns an archived chat back into JSONL so it can be appended to."""
+        with self._file_lock:
+            archive = self._archive(path)
+            if archive is None:
+                return
+            data = b"".join(line + b"\n" for line in archive.read_lines(0, archive.count))
+            self._replace(path, data)
+            self._write_index(path, len(data), line_offsets(data))
+            self._drop_archive(path)
+
+    def archive_cold_chats(self, max_age, exclude=()):
+        """
+        Archives the JSONL chats in the folder not modified for max_age
+        seconds, except the paths in exclude. Returns (bytes before, bytes
+        after, names archived).
+        """
+        cutoff = time.time() - max_age
+        before = after = 0
+        archived = []
+        for entry in sorted(os.scandir(self.folder), key=lambda entry: entry.name):
+            if not entry.name.endswith(CHAT_EXTENSION) or entry.path in exclude:
+                continue
+            try:
+                st = entry.stat()
+                if st.st_mtime > cutoff or not self.archive(entry.path):
+                    continue
+                before += st.st_size
+                after += os.path.getsize(entry.path + ARCHIVE_SUFFIX)
+                archived.append(entry.name)
+            except (OSError, ValueError) as e:
+                print(f"Error archiving chat '{entry.name}': {e}")
+        return before, after, archived
+
+    def _archive(self, path):
+        """The open ChatArchive for path, or None if the chat isn't archived. Call with _file_lock held."""
+        archive = self._archives.get(path)
+        if archive is None and path not in self._indexes and self.is_archived(path):
+            archive = self._archives[path] = ChatArchive(path + ARCHIVE_SUFFIX)
+        return archive
+
+    def _drop_archive(self, path):
+        """Closes and deletes the archive of a chat that is now JSONL. Call with _file_lock held."""
+        archive = self._archives.pop(path, None)
+        if archive is not None:
+            archive.close()
+        try:
+            os.unlink(path + ARCHIVE_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    ############################
+    # Offset index
+    ############################
+
+    def _index(self, path):
+        """
+        Returns [size, offsets] for path, loading the .idx file the first time.
+        An index that covers less than the whole file (e.g. the app quit
+        between writing a chat and its index) is extended by scanning only
+        the rest, and a torn last line left by a crash mid-write is cut off.
+        Call with _file_lock held.
+        """
+        index = self._indexes.get(path)
+        if index is not None:
+            return index
+
+        file_size = os.path.getsize(path)
+        size, offsets = 0, array("Q")
+        try:
+            with open(path + INDEX_SUFFIX, "rb") as f:
+                raw = array("Q")
+                raw.frombytes(f.read())
+            if raw and raw[0] <= file_size and (len(raw) == 1 or raw[-1] < raw[0]):
+                size, offsets = raw[0], raw[1:]
+        except (OSError, ValueError):
+            pass
+
+        if size == file_size:
+            with self._cond:
+                self._indexes[path] = [size, offsets]
+            return self._indexes[path]
+
+        with open(path, "rb") as f:
+            f.seek(size)
+            rest = f.read()
+        offsets.extend(line_offsets(rest, size))
+        complete = rest.rfind(b"\n") + 1
+        if complete < len(rest):
+            os.truncate(path, size + complete)
+        self._write_index(path, size + complete, offsets)
+        return self._indexes[path]
+
+    def _write_index(self, path, size, offsets):
+        tmp_path = path + INDEX_SUFFIX + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(array("Q", [size]).tobytes())
+            f.write(offsets.tobytes())
+        os.replace(tmp_path, path + INDEX_SUFFIX)
+        with self._cond:
+            self._indexes[path] = [size, offsets]
+
+    def _append_index(self, path, size, new_offsets):
+        """Records lines appended to path. The index file is only ever extended."""
+        with open(path + INDEX_SUFFIX, "r+b") as f:
+            f.write(array("Q", [size]).tobytes())
+            f.seek(0, os.SEEK_END)
+            f.write(new_offsets.tobytes())
+        # The lines move from in flight to indexed in one step, so counts never double up
+        with self._cond:
+            index = self._indexes[path]
+            index[0] = size
+            index[1].extend(new_offsets)
+            del self._in_flight[path]
+
+    def _replace(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    ############################
+    # Migration
+    ############################
+
+    def migrate_legacy_chats(self):
+        """
+        Converts the pretty-printed .json chats in the folder to JSONL. The
+        original file is kept next to the new one as <name>.json.bak.
+        Returns the names of the chats that were migrated.
+        """
+        migrated = []
+        for name in sorted(os.listdir(self.folder)):
+            if not name.endswith(LEGACY_EXTENSION):
+                continue
+            legacy_path = os.path.join(self.folder, name)
+            new_path = os.path.splitext(legacy_path)[0] + CHAT_EXTENSION
+            if os.path.exists(new_path) or os.path.exists(new_path + ARCHIVE_SUFFIX):
+                continue
+            try:
+                with open(legacy_path, "r") as f:
+                    history = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error migrating chat '{name}': {e}")
+                continue
+            if not isinstance(history, list):
+                history = []
+            self.compact(new_path, [msg for msg in history if is_valid_message(msg)])
+            os.replace(legacy_path, legacy_path + ".bak")
+            migrated.append(name)
+        return migrated
+
+    ############################
+    # Writer thread
+    ############################
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # Let a flush window's worth of messages collect into one write
+                self._cond.wait_for(lambda: self._flush_requested or self._closed, timeout=self.flush_interval)
+                self._in_flight, self._pending = self._pending, {}
+                self._flush_requested = False
+
+            try:
+                with self._file_lock, profiler.span("write chats"):
+                    for path, lines in list(self._in_flight.items()):
+                        size = self._index(path)[0]
+                        data = b"".join(lines)
+                        # Written at the end of the indexed data, over any torn line
+                        with open(path, "r+b") as f:
+                            f.seek(size)
+                            f.write(data)
+                            f.truncate()
+                            f.flush()
+                            os.fsync(f.fileno())
+                        self._append_index(path, size + len(data), line_offsets(data, size))
+            except OSError as e:
+                print(f"Error writing chat: {e}")
+            finally:
+                with self._cond:
+                    self._in_flight = {}
+                    self._cond.notify_all()
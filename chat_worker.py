@@ -0,0 +1,138 @@
+"""
+Background worker for chat completion requests.
+
+Requests are handed to worker threads so the pygame loop never blocks on
+the network. Finished requests (and, for streamed requests, each piece of
+the reply as it arrives) are put on a thread-safe result queue that the
+main loop drains once per frame with poll().
+"""
+
+import itertools
+import queue
+import threading
+import time
+
+from profiler import profiler
+
+
+class ChatRequest:
+    __slots__ = ("id", "chat_path", "model", "messages", "stream", "cancelled")
+
+    def __init__(self, request_id, chat_path, model, messages, stream=False):
+        self.id = request_id
+        self.chat_path = chat_path
+        self.model = model
+        self.messages = messages
+        self.stream = stream
+        self.cancelled = False
+
+
+class ChatDelta:
+    """A piece of a streamed reply. The request's ChatResult still follows with the full text."""
+
+    __slots__ = ("request_id", "chat_path", "text")
+
+    def __init__(self, request_id, chat_path, text):
+        self.request_id = request_id
+        self.chat_path = chat_path
+        self.text = text
+
+
+class ChatResult:
+    """The outcome of a request. Exactly one of content or error is set."""
+
+    __slots__ = ("request_id", "chat_path", "content", "error")
+
+    def __init__(self, request_id, chat_path, content=None, error=None):
+        self.request_id = request_id
+        self.chat_path = chat_path
+        self.content = content
+        self.error = error
+
+
+class RequestWorker:
+    def __init__(self, client, num_threads=2):
+        self.client = client
+        self._ids = itertools.count(1)
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._requests = {}  # request id -> ChatRequest, until its result is queued
+        self._threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self._run, name=f"chat-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, chat_path, model, messages, stream=False):
+        """
+        Queues a request and returns its id. messages is copied, so the caller
+        may keep editing its history. With stream=True a ChatDelta is queued
+        for every piece of the reply before the final ChatResult.
+        """
+        request = ChatRequest(next(self._ids), chat_path, model, list(messages), stream)
+        with self._lock:
+            self._requests[request.id] = request
+        self._jobs.put(request)
+        return request.id
+
+    def cancel_queued(self, chat_path):
+        """
+        Cancels the requests of a chat that have not been sent yet and returns
+        their ids. Requests already in flight are left alone so their replies
+        can still be routed back to that chat.
+        """
+        with self._lock:
+            cancelled = [r for r in self._requests.values() if r.chat_path == chat_path and r.messages is not None]
+            for request in cancelled:
+                request.cancelled = True
+                del self._requests[request.id]
+        return [request.id for request in cancelled]
+
+    def poll(self):
+        """Returns every ChatDelta and ChatResult that arrived since the last call (never blocks)."""
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def stop(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+
+    def _run(self):
+        while True:
+            request = self._jobs.get()
+            if request is None:
+                return
+            with self._lock:
+                if request.cancelled:
+                    continue
+                messages, request.messages = request.messages, None  # marks it as in flight
+
+            try:
+                with profiler.span(f"request {request.model}"):
+                    if request.stream:
+                        content = self._stream(request, messages)
+                    else:
+                        content = self.client.complete(request.model, messages)
+                result = ChatResult(request.id, request.chat_path, content=content)
+            except Exception as e:
+                result = ChatResult(request.id, request.chat_path, error=e)
+
+            with self._lock:
+                del self._requests[request.id]
+            self._results.put(result)
+
+    def _stream(self, request, messages):
+        """Forwards each piece of a streamed reply; returns the full text."""
+        parts = []
+        start = time.perf_counter_ns()
+        for text in self.client.stream(request.model, messages):
+            if not parts:
+                profiler.record(f"first token {request.model}", start, time.perf_counter_ns())
+            parts.append(text)
+            self._results.put(ChatDelta(request.id, request.chat_path, text))
+        return "".join(parts)
@@ -0,0 +1,186 @@
+"""
+Fits the messages sent with each request into a per-model token budget.
+
+The system instructions and the most recent turns are always sent; older
+turns that don't fit are folded into a short summary message instead of
+being sent in full. Messages recalled from other chats, if any, get a
+share of the budget of their own. Token counts are cached per message, so
+building a request only counts the turns it looks at.
+"""
+
+from collections import OrderedDict
+
+# Rough overhead of the role and separators around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_SNIPPET_CHARS = 160
+RECALL_SNIPPET_CHARS = 600
+
+
+def load_encoder():
+    """Returns a tiktoken-based token counter, or None if tiktoken isn't installed."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text))
+
+
+def estimate_tokens(text):
+    """About four characters per token for English text."""
+    return (len(text) + 3) // 4
+
+
+class ContextStats:
+    """Token totals of the last request that was built."""
+
+    __slots__ = ("model", "budget", "sent_tokens", "sent_messages", "summarized_messages", "summary_tokens",
+                 "recalled_messages", "recall_tokens")
+
+    def __init__(self, model, budget):
+        self.model = model
+        self.budget = budget
+        self.sent_tokens = 0
+        self.sent_messages = 0
+        self.summarized_messages = 0
+        self.summary_tokens = 0
+        self.recalled_messages = 0
+        self.recall_tokens = 0
+
+    def __repr__(self):
+        text = (f"{self.model}: {self.sent_tokens}/{self.budget} tokens in {self.sent_messages} messages"
+                f" ({self.summarized_messages} older messages replaced by a {self.summary_tokens}-token summary)")
+        if self.recalled_messages:
+            text += f", {self.recalled_messages} recalled messages in {self.recall_tokens} tokens"
+        return text
+
+
+class ContextManager:
+    def __init__(self, budgets, default_budget=16000, min_recent=2, summary_share=0.1, recall_share=0.1,
+                 max_cached=50000):
+        """
+        budgets maps model names to the number of prompt tokens a request
+        may use. min_recent turns are always sent, even over budget, up to
+        summary_share of the budget goes to the summary of older turns and
+        up to recall_share to messages recalled from other chats.
+        """
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self.min_recent = min_recent
+        self.summary_share = summary_share
+        self.recall_share = recall_share
+        self.max_cached = max_cached
+        self.last_stats = None
+        self._counts = OrderedDict()
+        self._count_text = None
+
+    @property
+    def count_text(self):
+        """Token counter for a string; tiktoken is loaded the first time it's needed."""
+        if self._count_text is None:
+            self._count_text = load_encoder() or estimate_tokens
+        return self._count_text
+
+    def count(self, msg):
+        """Token count of one message, cached by its content."""
+        content = msg["content"]
+        tokens = self._counts.get(content)
+        if tokens is None:
+            tokens = self.count_text(content) + MESSAGE_OVERHEAD_TOKENS
+            self._counts[content] = tokens
+            if len(self._counts) > self.max_cached:
+                self._counts.popitem(last=False)
+        else:
+            self._counts.move_to_end(content)
+        return tokens
+
+    def build(self, model, history, system_instructions="", recalled=()):
+        """
+        Returns the messages to send for history (oldest first) and records
+        their token totals in last_stats. recalled lists (role, text) of
+        messages from other chats that may help, best first.
+        """
+        budget = self.budgets.get(model, self.default_budget)
+        stats = ContextStats(model, budget)
+
+        system = []
+        if system_instructions.strip():
+            system.append({"role": "system", "content": system_instructions})
+            stats.sent_tokens += self.count(system[0])
+        system += self.recall(recalled, int(budget * self.recall_share), stats)
+
+        # Newest turns first, while they fit (leaving room for a summary)
+        turn_budget = budget - stats.sent_tokens - int(budget * self.summary_share)
+        recent = []
+        i = len(history) - 1
+        while i >= 0:
+            tokens = self.count(history[i])
+            if len(recent) >= self.min_recent and stats.sent_tokens + tokens > turn_budget:
+                break
+            recent.append(history[i])
+            stats.sent_tokens += tokens
+            i -= 1
+        recent.reverse()
+
+        summary = self.summarize(history, i, budget - stats.sent_tokens, stats)
+        messages = system + summary + recent
+        stats.sent_messages = len(messages)
+        self.last_stats = stats
+        return messages
+
+    def recall(self, recalled, token_budget, stats):
+        """Puts as many of the recalled messages as fit in token_budget into one system message."""
+        if not recalled:
+            return []
+        header = "Possibly relevant messages from the user's other chats:"
+        used = self.count_text(header) + MESSAGE_OVERHEAD_TOKENS
+        lines = []
+        for role, text in recalled:
+            snippet = text[:RECALL_SNIPPET_CHARS].strip()
+            if len(text) > RECALL_SNIPPET_CHARS:
+                snippet += "..."
+            line = f"- {role}: {snippet}"
+            tokens = self.count_text(line)
+            if used + tokens > token_budget:
+                break
+            lines.append(line)
+            used += tokens
+        if not lines:
+            return []
+        stats.sent_tokens += used
+        stats.recalled_messages = len(lines)
+        stats.recall_tokens = used
+        return [{"role": "system", "content": "\n".join([header] + lines)}]
+
+    def summarize(self, history, last, token_budget, stats):
+        """
+        Folds history[:last + 1] into at most one system message of snippets,
+        newest first until token_budget is used up. Turns that don't fit are
+        dropped entirely.
+        """
+        if last < 0 or token_budget <= MESSAGE_OVERHEAD_TOKENS:
+            stats.summarized_messages = last + 1
+            return []
+
+        header = "Summary of the earlier conversation:"
+        used = self.count_text(header) + MESSAGE_OVERHEAD_TOKENS
+        lines = []
+        for i in range(last, -1, -1):
+            msg = history[i]
+            snippet = " ".join(msg["content"][:SUMMARY_SNIPPET_CHARS].split())
+            if len(msg["content"]) > SUMMARY_SNIPPET_CHARS:
+                snippet += "..."
+            line = f"- {msg['role']}: {snippet}"
+            tokens = self.count_text(line)
+            if used + tokens > token_budget:
+                break
+            lines.append(line)
+            used += tokens
+
+        stats.summarized_messages = last + 1
+        if not lines:
+            return []
+        lines.reverse()
+        stats.sent_tokens += used
+        stats.summary_tokens = used
+        return [{"role": "system", "content": "\n".join([header] + lines)}]
@@ -0,0 +1,130 @@
+"""
+A local stand-in for the chat completions endpoint.
+
+Answers every request with a canned reply after a configurable delay,
+streamed as server-sent events when the request asks for it, so the batch
+runner, the server and the GUI can be exercised without an API key:
+
+    python mock_api.py --port 8765 --delay 0.2
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python batch_runner.py prompts.jsonl out.jsonl
+
+--fail-every N answers every Nth request with a 429 or 503 (alternating)
+to exercise the client's retries. --model-delay MODEL=SECONDS overrides the
+delay for one model, to give model comparisons something to compare:
+
+    python mock_api.py --model-delay gpt-4o=0.6 --model-delay o1=1.5
+"""
+
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def reply_text(model, messages):
+    last = messages[-1]["content"] if messages else ""
+    return f"Mock reply from {model} to {len(messages)} messages. You said: {last[:200]}"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.2
+    fail_every = 0
+    model_delays = {}
+    counter = itertools.count(1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        number = next(self.counter)
+        if self.fail_every and number % self.fail_every == 0:
+            status = 429 if (number // self.fail_every) % 2 else 503
+            self._send_json(status, {"error": {"message": "injected failure"}}, {"Retry-After": "0.1"})
+            return
+
+        model = body.get("model", "")
+        time.sleep(self.model_delays.get(model, self.delay))
+        messages = body.get("messages", [])
+        text = reply_text(model, messages)
+        usage = {
+            "prompt_tokens": sum(len(msg.get("content", "")) // 4 + 4 for msg in messages),
+            "completion_tokens": len(text) // 4,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if not body.get("stream"):
+            self._send_json(200, {"choices": [{"message": {"role": "assistant", "content": text}}],
+                                  "usage": usage})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, word in enumerate(text.split(" ")):
+            piece = word if i == 0 else " " + word
+            self._send_chunk(f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]})}\n\n")
+            time.sleep(0.005)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._send_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+        self._send_chunk("data: [DONE]\n\n")
+        self._send_chunk("")
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def start(port=0, delay=0.2, fail_every=0, model_delays=None):
+    """Starts the mock server on a background thread and returns it (see server_address)."""
+    handler = type("Handler", (MockHandler,), {"delay": delay, "fail_every": fail_every,
+                                               "model_delays": dict(model_delays or {}),
+                                               "counter": itertools.count(1)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, name="mock-api", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the chat completions endpoint")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.2, help="seconds before each reply")
+    parser.add_argument("--fail-every", type=int, default=0, help="fail every Nth request with 429/503")
+    parser.add_argument("--model-delay", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="delay for one model instead of --delay (repeatable)")
+    args = parser.parse_args()
+
+    model_delays = {}
+    for spec in args.model_delay:
+        model, _, seconds = spec.partition("=")
+        try:
+            model_delays[model] = float(seconds)
+        except ValueError:
+            parser.error(f"bad --model-delay {spec!r}, expected MODEL=SECONDS")
+
+    server = start(args.port, args.delay, args.fail_every, model_delays)
+    host, port = server.server_address
+    print(f"Mock API listening on http://{host}:{port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
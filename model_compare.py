@@ -0,0 +1,320 @@
+"""
+Sends one prompt to several models at once and compares their replies.
+
+Each model's reply is streamed on its own thread, measuring the time to
+the first token and the total latency (both include any wait for the
+model's rate limit in MODEL_RATE_LIMITS). Every finished request is
+appended to a metrics log, one JSON line per request:
+
+    {"time": ..., "model": ..., "ttft_ms": ..., "latency_ms": ...,
+     "prompt_tokens": ..., "completion_tokens": ...}
+
+Failed requests get an "error" instead. Comparisons bypass the response
+cache, so every logged time is that of a real request. ModelMetrics
+summarizes the log per model with latency percentiles and the estimated
+cost from MODEL_PRICES, and picks the cheapest model whose latency meets a
+target. In the window, tick models under Compare in the settings and press
+Ctrl+Enter to compare them on the message being typed. From the command
+line:
+
+    python mock_api.py --model-delay gpt-4o=0.6 --model-delay o1=1.5
+    python model_compare.py "Explain mmap" --runs 20 --base-url http://127.0.0.1:8765/v1
+    python model_compare.py --summary --slo 2.0
+"""
+
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_runner import percentile
+from chat_core import MODEL_PRICES, MODEL_TOKEN_BUDGETS, MODELS, make_client
+from context_window import ContextManager, estimate_tokens
+from response_cache import CachedChatClient
+
+METRICS_LOG = "model_metrics.jsonl"
+
+
+class ModelMetrics:
+    """The metrics log: one JSON line per request, summarized per model."""
+
+    def __init__(self, path=METRICS_LOG):
+        self.path = path
+        self._records = None  # read from the log the first time they're needed
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            if self._records is not None:
+                self._records.append(record)
+
+    def records(self):
+        with self._lock:
+            if self._records is None:
+                self._records = []
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        for line in f:
+                            try:
+                                record = json.loads(line)
+                            except ValueError:
+                                continue  # a line cut short by a crash
+                            if isinstance(record, dict) and "model" in record:
+                                self._records.append(record)
+                except FileNotFoundError:
+                    pass
+            return list(self._records)
+
+    def summary(self):
+        """
+        Returns model -> stats over the whole log: requests, errors, TTFT and
+        latency p50/p95/p99 in ms, mean prompt and completion tokens, and the
+        mean estimated cost per request in USD (None for unpriced models).
+        """
+        by_model = {}
+        for record in self.records():
+            by_model.setdefault(record["model"], []).append(record)
+
+        stats = {}
+        for model, records in by_model.items():
+            ok = [record for record in records if "error" not in record]
+            entry = {"requests": len(records), "errors": len(records) - len(ok)}
+            for name in ("ttft", "latency"):
+                values = [record[f"{name}_ms"] for record in ok if record.get(f"{name}_ms") is not None]
+                for fraction in (0.5, 0.95, 0.99):
+                    key = f"{name}_p{round(fraction * 100)}"
+                    entry[key] = percentile(values, fraction) if values else None
+            counted = [record for record in ok if record.get("completion_tokens") is not None]
+            prompt = sum(record.get("prompt_tokens") or 0 for record in counted) / len(counted) if counted else None
+            completion = sum(record["completion_tokens"] for record in counted) / len(counted) if counted else None
+            entry["prompt_tokens"] = prompt
+            entry["completion_tokens"] = completion
+            price = MODEL_PRICES.get(model)
+            entry["cost"] = (prompt * price[0] + completion * price[1]) / 1e6 if price and counted else None
+            stats[model] = entry
+        return stats
+
+    def cheapest_within(self, slo_ms, fraction=0.95, summary=None):
+        """
+        The model with the lowest mean cost whose latency percentile at
+        fraction is at most slo_ms, or None if no priced model meets it.
+        """
+        latencies = {}
+        for record in self.records():
+            if "error" not in record and record.get("latency_ms") is not None:
+                latencies.setdefault(record["model"], []).append(record["latency_ms"])
+        candidates = []
+        for model, entry in (summary or self.summary()).items():
+            values = latencies.get(model)
+            if values and percentile(values, fraction) <= slo_ms and entry["cost"] is not None:
+                candidates.append((entry["cost"], model))
+        return min(candidates)[1] if candidates else None
+
+
+def uncached_client(client):
+    """
+    The client to compare models with: a CachedChatClient's own client,
+    since a reply from the cache would be logged as a request taking ~0 ms.
+    Raises ValueError for an offline cache, which must not call the API.
+    """
+    if not isinstance(client, CachedChatClient):
+        return client
+    if client.offline:
+        raise ValueError("comparing models calls the API, so it is not available offline")
+    return client.client
+
+
+class ModelReply:
+    """One model's side of a comparison, as far as it has got."""
+
+    __slots__ = ("model", "text", "ttft", "latency", "usage", "error", "done")
+
+    def __init__(self, model):
+        self.model = model
+        self.text = ""
+        self.ttft = None     # seconds
+        self.latency = None  # seconds
+        self.usage = None
+        self.error = None
+        self.done = False
+
+
+class Comparison:
+    """
+    Streams the replies of several models to the same prompt concurrently.
+
+    requests maps each model to the messages to send it. The worker threads
+    only queue their progress; poll() applies it to replies, so the replies
+    are only ever touched by the thread that calls poll() (the GUI's main
+    loop, or wait()).
+    """
+
+    def __init__(self, client, requests, metrics=None, prompt=""):
+        self.client = client
+        self.metrics = metrics
+        self.prompt = prompt
+        self.replies = [ModelReply(model) for model in requests]
+        self._updates = queue.Queue()
+        pool = ThreadPoolExecutor(max_workers=len(requests) or 1, thread_name_prefix="compare")
+        for model, messages in requests.items():
+            pool.submit(self._run, model, messages)
+        pool.shutdown(wait=False)
+
+    @property
+    def done(self):
+        return all(reply.done for reply in self.replies)
+
+    def poll(self, timeout=None):
+        """
+        Applies the progress queued since the last call and returns whether
+        there was any. With a timeout, waits up to that long for some.
+        """
+        changed = False
+        replies = {reply.model: reply for reply in self.replies}
+        while True:
+            try:
+                if changed or timeout is None:
+                    model, field, value = self._updates.get_nowait()
+                else:
+                    model, field, value = self._updates.get(timeout=timeout)
+            except queue.Empty:
+                return changed
+            reply = replies[model]
+            if field == "text":
+                reply.text += value
+            else:
+                setattr(reply, field, value)
+            changed = True
+
+    def wait(self, on_done=None):
+        """Blocks until every reply is done, calling on_done(reply) as each one finishes."""
+        reported = set()
+        while not self.done:
+            self.poll(timeout=0.1)
+            for reply in self.replies:
+                if reply.done and reply.model not in reported:
+                    reported.add(reply.model)
+                    if on_done:
+                        on_done(reply)
+
+    def _run(self, model, messages):
+        record = {"time": round(time.time(), 3), "model": model}
+        usage = {}
+        received = []
+        ttft = None
+        start = time.perf_counter()
+        try:
+            if hasattr(self.client, "stream_with_usage"):
+                pieces = self.client.stream_with_usage(model, messages, usage)
+            else:
+                pieces = self.client.stream(model, messages)
+            for text in pieces:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    self._updates.put((model, "ttft", ttft))
+                received.append(text)
+                self._updates.put((model, "text", text))
+            latency = time.perf_counter() - start
+        except Exception as e:
+            record["error"] = str(e)
+            self._updates.put((model, "error", str(e)))
+        else:
+            record["ttft_ms"] = round((ttft if ttft is not None else latency) * 1000, 1)
+            record["latency_ms"] = round(latency * 1000, 1)
+            if usage:
+                record["prompt_tokens"] = usage.get("prompt_tokens")
+                record["completion_tokens"] = usage.get("completion_tokens")
+            else:
+                # Estimated when the server (or a cached reply) doesn't report usage
+                record["prompt_tokens"] = sum(estimate_tokens(msg["content"]) for msg in messages)
+                record["completion_tokens"] = estimate_tokens("".join(received))
+            self._updates.put((model, "latency", latency))
+            self._updates.put((model, "usage", usage or None))
+        if self.metrics is not None:
+            try:
+                self.metrics.record(record)
+            except OSError as e:
+                print(f"Error writing model metrics: {e}")
+        self._updates.put((model, "done", True))
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value:.0f}"
+
+
+def print_summary(metrics, slo=None, fraction=0.95):
+    summary = metrics.summary()
+    if not summary:
+        print(f"No requests in {metrics.path} yet.")
+        return
+    print(f"{'model':<14}{'requests':>9}{'errors':>7}{'ttft p50':>10}{'ttft p95':>10}"
+          f"{'lat p50':>10}{'lat p95':>10}{'lat p99':>10}{'tokens':>8}{'$/1k req':>10}")
+    for model in sorted(summary):
+        entry = summary[model]
+        tokens = "-" if entry["completion_tokens"] is None else f"{entry['completion_tokens']:.0f}"
+        cost = "-" if entry["cost"] is None else f"{entry['cost'] * 1000:.3f}"
+        print(f"{model:<14}{entry['requests']:>9}{entry['errors']:>7}"
+              f"{format_ms(entry['ttft_p50']):>10}{format_ms(entry['ttft_p95']):>10}"
+              f"{format_ms(entry['latency_p50']):>10}{format_ms(entry['latency_p95']):>10}"
+              f"{format_ms(entry['latency_p99']):>10}{tokens:>8}{cost:>10}")
+    if slo is not None:
+        model = metrics.cheapest_within(slo * 1000, fraction, summary)
+        target = f"p{round(fraction * 100)} latency <= {slo:g}s"
+        print(f"Cheapest model with {target}: {model}" if model else f"No priced model has {target}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the chat models on the same prompt")
+    parser.add_argument("prompt", nargs="?", help="prompt to send (omit with --summary)")
+    parser.add_argument("--models", nargs="+", default=MODELS, choices=MODELS)
+    parser.add_argument("--system", default="", help="system instructions sent with the prompt")
+    parser.add_argument("--runs", type=int, default=1, help="times to send the prompt to each model")
+    parser.add_argument("--base-url", help="API base URL (default: OPENAI_BASE_URL or the OpenAI API)")
+    parser.add_argument("--log", default=METRICS_LOG, help="metrics log the results are appended to")
+    parser.add_argument("--summary", action="store_true", help="print the per-model summary of the log")
+    parser.add_argument("--slo", type=float, help="latency target in seconds to pick the cheapest model for")
+    parser.add_argument("--percentile", type=float, default=0.95, help="latency percentile the target applies to")
+    args = parser.parse_args()
+    if not args.prompt and not args.summary:
+        parser.error("give a prompt, or --summary")
+
+    metrics = ModelMetrics(args.log)
+    if args.prompt:
+        client, _ = make_client(base_url=args.base_url, pool_size=len(args.models))
+        try:
+            client = uncached_client(client)
+        except ValueError as e:
+            parser.error(str(e))
+        context = ContextManager(MODEL_TOKEN_BUDGETS)
+        history = [{"role": "user", "content": args.prompt}]
+        requests = {model: context.build(model, history, args.system) for model in args.models}
+
+        def report(reply):
+            if reply.error:
+                print(f"{reply.model:<14}error: {reply.error}")
+                return
+            tokens = (reply.usage or {}).get("completion_tokens")
+            print(f"{reply.model:<14}ttft {reply.ttft * 1000 if reply.ttft else 0:7.0f} ms"
+                  f"   total {reply.latency * 1000:7.0f} ms   {tokens if tokens is not None else '-'} tokens")
+            if args.runs == 1:
+                print(f"    {reply.text}")
+
+        try:
+            for run in range(args.runs):
+                if args.runs > 1:
+                    print(f"Run {run + 1}/{args.runs}")
+                Comparison(client, requests, metrics, args.prompt).wait(report)
+        except KeyboardInterrupt:
+            sys.exit(130)
+        print()
+    print_summary(metrics, args.slo, args.percentile)
+
+
+if __name__ == "__main__":
+    main()
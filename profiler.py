@@ -0,0 +1,129 @@
+"""
+Timing spans for the main loop and the request path.
+
+Code under measurement is wrapped in `with profiler.span("name"):`. While
+the profiler is disabled span() hands back a shared no-op context, so the
+instrumentation can stay in place at almost no cost. When enabled, every
+span is recorded (from any thread) for export as a Chrome trace-event file
+(load it in chrome://tracing or https://ui.perfetto.dev), and the spans of
+the main thread are summed per frame for the on-screen HUD.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter_ns())
+        return False
+
+
+class Profiler:
+    def __init__(self, max_events=200000, window=120):
+        """
+        Keeps the last max_events spans for export and the per-frame totals
+        of the last window frames for stats().
+        """
+        self.enabled = False
+        self.events = deque(maxlen=max_events)  # (name, thread id, start ns, end ns)
+        self.frame_times = deque(maxlen=window)  # seconds of work per frame
+        self.frame_spans = deque(maxlen=window)  # per frame: span name -> ns
+        self._frame_ends = deque(maxlen=window)  # perf_counter() at the end of each frame
+        self._current = {}
+        self._frame_start = None
+        self._main_thread = threading.get_ident()
+        self._thread_names = {}
+
+    def span(self, name):
+        """Context manager timing the block it wraps as name."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name, start_ns, end_ns):
+        """Records a span that was timed by the caller (perf_counter_ns values)."""
+        if not self.enabled:
+            return
+        thread = threading.get_ident()
+        self.events.append((name, thread, start_ns, end_ns))
+        if thread == self._main_thread:
+            self._current[name] = self._current.get(name, 0) + end_ns - start_ns
+        elif thread not in self._thread_names:
+            self._thread_names[thread] = threading.current_thread().name
+
+    def frame_start(self):
+        self._frame_start = time.perf_counter()
+        self._current = {}
+
+    def frame_end(self):
+        """Closes the frame begun by frame_start(). Time spent outside the two isn't counted."""
+        if not self.enabled or self._frame_start is None:
+            return
+        now = time.perf_counter()
+        self.frame_times.append(now - self._frame_start)
+        self.frame_spans.append(self._current)
+        self._frame_ends.append(now)
+        self._frame_start = None
+
+    def stats(self, top=5):
+        """
+        Returns (fps, p50 ms, p99 ms, [(span name, mean ms per frame), ...])
+        over the recorded frames, with the top spans by time.
+        """
+        frames = sorted(self.frame_times)
+        if not frames:
+            return 0.0, 0.0, 0.0, []
+        ends = self._frame_ends
+        fps = (len(ends) - 1) / (ends[-1] - ends[0]) if len(ends) > 1 and ends[-1] > ends[0] else 0.0
+        p50 = frames[len(frames) // 2] * 1000
+        p99 = frames[min(len(frames) - 1, int(len(frames) * 0.99))] * 1000
+
+        totals = {}
+        for spans in self.frame_spans:
+            for name, ns in spans.items():
+                totals[name] = totals.get(name, 0) + ns
+        ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+        return fps, p50, p99, [(name, ns / len(frames) / 1e6) for name, ns in ranked]
+
+    def clear(self):
+        self.events.clear()
+        self.frame_times.clear()
+        self.frame_spans.clear()
+        self._frame_ends.clear()
+
+    def export_chrome_trace(self, path):
+        """Writes the recorded spans to path in Chrome's trace-event JSON format."""
+        pid = os.getpid()
+        names = dict(self._thread_names)
+        names[self._main_thread] = "main"
+        trace = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": thread, "args": {"name": name}}
+            for thread, name in names.items()
+        ]
+        for name, thread, start, end in list(self.events):
+            trace.append({"name": name, "ph": "X", "pid": pid, "tid": thread,
+                          "ts": start / 1000, "dur": (end - start) / 1000})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        return len(trace) - len(names)
+
+
+# Shared by the window and the background threads
+profiler = Profiler()
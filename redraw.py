@@ -0,0 +1,65 @@
+"""
+Dirty-region tracking for the main loop.
+
+Event handlers mark the parts of the window they change; the loop then
+repaints only those rects and passes them to pygame.display.update. While
+nothing is dirty and nothing is animating the loop can sleep in
+pygame.event.wait instead of repainting at full frame rate.
+"""
+
+import pygame
+
+
+class RedrawScheduler:
+    def __init__(self, screen_rect, active_fps=30, idle_wait_ms=100):
+        self.screen_rect = pygame.Rect(screen_rect)
+        self.active_fps = active_fps
+        self.idle_wait_ms = idle_wait_ms
+        self._dirty = [self.screen_rect.copy()]  # the first frame paints everything
+        self._animating = False
+        self._busy = True  # whether the last frame painted or animated anything
+
+    @property
+    def idle(self):
+        """True if the last frame had nothing to do and nothing was marked since."""
+        return not self._dirty and not self._busy
+
+    def mark(self, rect=None):
+        """Marks rect (or the whole window) as needing a repaint."""
+        rect = self.screen_rect if rect is None else pygame.Rect(rect).clip(self.screen_rect)
+        if rect.width and rect.height:
+            self._dirty.append(rect)
+
+    def animate(self, rect=None):
+        """Marks rect dirty and keeps the loop at full frame rate for this frame."""
+        self._animating = True
+        self.mark(rect)
+
+    def take(self):
+        """
+        Returns the rects to repaint this frame and clears them. Rects that
+        overlap are merged so no area is painted twice.
+        """
+        rects = []
+        for rect in self._dirty:
+            i = rect.collidelist(rects)
+            while i >= 0:
+                rect = rect.union(rects.pop(i))
+                i = rect.collidelist(rects)
+            rects.append(rect)
+        self._busy = bool(rects) or self._animating
+        self._dirty = []
+        self._animating = False
+        return rects
+
+    def wait_events(self, clock):
+        """
+        Returns this frame's events. At full frame rate the clock is ticked;
+        when idle the call blocks until an event arrives or idle_wait_ms passes.
+        """
+        if self.idle:
+            first = pygame.event.wait(self.idle_wait_ms)
+            events = [] if first.type == pygame.NOEVENT else [first]
+            return events + pygame.event.get()
+        clock.tick(self.active_fps)
+        return pygame.event.get()
@@ -0,0 +1,175 @@
+"""
+Caches of pre-rendered pygame surfaces.
+
+Surfaces are kept in least-recently-used order and evicted once the sum of
+their pixel buffers goes over a byte budget, so very long chats cannot grow
+the cache without bound. A surface bigger than the whole budget is never
+kept, and message bubbles are rendered in fixed-height tiles, so a huge
+message costs no more than the part of it that is on screen. Each cache
+counts its hits and misses so the profiler HUD can show how much
+rendering it saves.
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+from operator import itemgetter
+
+import pygame
+
+from chat_markdown import SYNTAX_COLORS
+
+TILE_HEIGHT = 256  # height of the pieces bubbles are rendered and cached in
+TALLEST_LINE = 64  # taller than any line of text, for finding the runs that reach into a tile
+
+
+def surface_bytes(surface):
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+class SurfaceCache:
+    """LRU cache of surfaces bounded by the total size of their pixel data."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._surfaces = OrderedDict()
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    def get(self, key):
+        surface = self._surfaces.get(key)
+        if surface is not None:
+            self._surfaces.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return surface
+
+    def put(self, key, surface):
+        old = self._surfaces.pop(key, None)
+        if old is not None:
+            self.used_bytes -= surface_bytes(old)
+        if surface_bytes(surface) > self.max_bytes:
+            return  # would evict everything else and still be over budget
+        self._surfaces[key] = surface
+        self.used_bytes += surface_bytes(surface)
+        while self.used_bytes > self.max_bytes:
+            _, evicted = self._surfaces.popitem(last=False)
+            self.used_bytes -= surface_bytes(evicted)
+
+    def clear(self):
+        self._surfaces.clear()
+        self.used_bytes = 0
+
+    def hit_rate(self):
+        """Fraction of lookups since the last reset_stats() that found a surface."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def describe(self):
+        return (f"{self.hit_rate():.0%} hits, {len(self)} surfaces,"
+                f" {self.used_bytes / (1024 * 1024):.1f}/{self.max_bytes / (1024 * 1024):.0f} MB")
+
+
+class BubbleCache(SurfaceCache):
+    """
+    Message bubbles (rounded rect plus laid out text and code) rendered off-screen once.
+
+    Each bubble is rendered in tiles TILE_HEIGHT pixels high, and only the
+    tiles that are on screen are rendered and kept, so the memory and time a
+    message takes don't grow with its length. Tiles are keyed by the message
+    content, the bubble size, the colors used and their position, so a theme
+    switch simply stops hitting the old entries and they age out of the LRU
+    instead of being cleared eagerly.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, radius=10):
+        super().__init__(max_bytes)
+        self.radius = radius
+
+    def draw_bubble(self, target, pos, content, layout, fonts, bubble_color, text_color, streaming=False,
+                    text_cache=None):
+        """
+        Draws the bubble of layout with its top left at pos, as far as it is
+        inside target's clip rect. The tiles of a streaming message change
+        with every piece that arrives, so they are rendered each time instead
+        of cached; passing a text_cache still reuses its unchanged runs of text.
+        """
+        for index, top in self.visible_tiles(target, pos, layout):
+            if streaming:
+                tile = self.render_tile(layout, top, bubble_color, text_color, text_cache)
+            else:
+                key = (content, layout.bubble_width, layout.bubble_height, fonts, bubble_color, text_color, index)
+                tile = self.get(key)
+                if tile is None:
+                    tile = self.render_tile(layout, top, bubble_color, text_color)
+                    self.put(key, tile)
+            target.blit(tile, (pos[0], pos[1] + top))
+
+    @staticmethod
+    def visible_tiles(target, pos, layout):
+        """(index, top) of the tiles of a bubble at pos that intersect target's clip rect."""
+        clip = target.get_clip()
+        if pos[0] >= clip.right or pos[0] + layout.bubble_width <= clip.left:
+            return []
+        first = max(0, (clip.top - pos[1]) // TILE_HEIGHT)
+        last = min((layout.bubble_height - 1) // TILE_HEIGHT, (clip.bottom - 1 - pos[1]) // TILE_HEIGHT)
+        return [(index, index * TILE_HEIGHT) for index in range(first, last + 1)]
+
+    def render_tile(self, layout, tile_top, bubble_color, text_color, text_cache=None):
+        """Renders the TILE_HEIGHT pixels of a bubble from tile_top down (less at the bottom)."""
+        height = min(TILE_HEIGHT, layout.bubble_height - tile_top)
+        surface = pygame.Surface((layout.bubble_width, height), pygame.SRCALPHA)
+        # The rounded rect, cut down to the tile (plus the radius, so only the real corners are rounded)
+        top = max(-tile_top, -self.radius)
+        bottom = min(layout.bubble_height - tile_top, height + self.radius)
+        pygame.draw.rect(surface, bubble_color, (0, top, layout.bubble_width, bottom - top), border_radius=self.radius)
+        code_color = tuple(c * 2 // 3 for c in bubble_color[:3])
+        # Only the blocks, and the runs within them, that reach into the tile
+        first = max(0, bisect_left(layout.tops, tile_top - 10) - 1)
+        for part, top in zip(layout.parts[first:], layout.tops[first:]):
+            top += 10 - tile_top  # block top in tile coordinates
+            if top >= height:
+                break
+            if top + part.height <= 0:
+                continue
+            for x, y, w, h in part.boxes:
+                pygame.draw.rect(surface, code_color, (10 + x, top + y, w, h), border_radius=6)
+            start = bisect_left(part.runs, -top - TALLEST_LINE, key=itemgetter(1))
+            for x, y, text, font, style in part.runs[start:]:
+                if top + y >= height:
+                    break
+                if not text:
+                    continue
+                color = SYNTAX_COLORS[style] if style else text_color
+                if text_cache is not None:
+                    text_surface = text_cache.render(font, text, color)
+                else:
+                    text_surface = font.render(text, True, color)
+                surface.blit(text_surface, (10 + x, top + y))
+        return surface
+
+
+class TextCache(SurfaceCache):
+    """
+    Rendered text surfaces keyed by (font, text, color), shared by every
+    label, button and chat name on screen.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        super().__init__(max_bytes)
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.get(key)
+        if surface is None:
+            surface = font.render(text, True, color)
+            self.put(key, surface)
+        return surface
@@ -0,0 +1,155 @@
+"""
+On-disk cache of chat completion responses.
+
+Responses are stored under a hash of the model and the full message list,
+so replaying the same conversation returns the recorded reply instead of
+making a new API call. Entries expire after a TTL and the least recently
+used ones are evicted once the cache grows over its byte budget.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class CacheMiss(Exception):
+    """Raised in offline mode when a request has no recorded response."""
+
+
+def request_key(model, messages):
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, folder, ttl=7 * 24 * 3600, max_bytes=256 * 1024 * 1024):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.used_bytes = sum(size for _, _, size in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key + ".json")
+
+    def get(self, model, messages):
+        """Returns the cached reply for the request, or None."""
+        path = self._path(request_key(model, messages))
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        with self._lock:
+            if entry is not None and time.time() - entry.get("created", 0) > self.ttl:
+                self._remove(path)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # The mtime doubles as the last-used time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["content"]
+
+    def put(self, model, messages, content):
+        path = self._path(request_key(model, messages))
+        data = json.dumps({"created": time.time(), "model": model, "content": content}, ensure_ascii=False).encode("utf-8")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        with self._lock:
+            try:
+                self.used_bytes -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+            self.used_bytes += len(data)
+            if self.used_bytes > self.max_bytes:
+                self._evict()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "bytes": self.used_bytes,
+        }
+
+    def _entries(self):
+        """Yields (mtime, path, size) for every cached response."""
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, path, st.st_size
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache is at 90% of its budget."""
+        target = self.max_bytes * 0.9
+        for _, path, _ in sorted(self._entries()):
+            if self.used_bytes <= target:
+                return
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.used_bytes -= size
+
+
+class CachedChatClient:
+    """
+    Wraps a chat client so identical requests are answered from a ResponseCache.
+    With offline=True a request that isn't cached raises CacheMiss instead of
+    reaching the wrapped client.
+    """
+
+    def __init__(self, client, cache, offline=False):
+        self.client = client
+        self.cache = cache
+        self.offline = offline
+
+    def complete(self, model, messages):
+        content = self.cache.get(model, messages)
+        if content is not None:
+            return content
+        if self.offline:
+            raise CacheMiss(f"No recorded response for this {model} request")
+        content = self.client.complete(model, messages)
+        self.cache.put(model, messages, content)
+        return content
+
+    def stream(self, model, messages):
+        content = self.cache.get(model, messages)
+        if content is not None:
+            yield content
+            return
+        if self.offline:
+            raise CacheMiss(f"No recorded response for this {model} request")
+        parts = []
+        for text in self.client.stream(model, messages):
+            parts.append(text)
+            yield text
+        # Only reached if the whole reply was read
+        self.cache.put(model, messages, "".join(parts))
@@ -0,0 +1,143 @@
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+# The modules live side by side at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock_api  # noqa: E402
+from chat_client import HTTPChatClient  # noqa: E402
+
+
+class StubClient:
+    """
+    A chat client that answers "re: <last message>" without a network.
+    Requests whose last message or model is in fail raise instead.
+    """
+
+    def __init__(self):
+        self.fail = set()
+        self.requests = []  # (model, last message) of every request
+        self._gates = None  # last message -> Event, while requests are held
+
+    def hold(self):
+        """Makes each request wait (up to 5 s) until release() is called with its last message."""
+        self._gates = {}
+
+    def release(self, prompt):
+        self._gates.setdefault(prompt, threading.Event()).set()
+
+    def complete(self, model, messages):
+        prompt = messages[-1]["content"]
+        self.requests.append((model, prompt))
+        if self._gates is not None and not self._gates.setdefault(prompt, threading.Event()).wait(5):
+            raise TimeoutError(prompt)
+        if prompt in self.fail or model in self.fail:
+            raise RuntimeError(f"failed {prompt}")
+        return f"re: {prompt}"
+
+    def stream(self, model, messages):
+        reply = self.complete(model, messages)
+        yield reply[:3]
+        yield reply[3:]
+
+
+@pytest.fixture
+def stub_client():
+    return StubClient()
+
+
+def sse_lines(pieces):
+    """The raw lines of a streamed reply made of pieces, ending with [DONE]."""
+    lines = []
+    for piece in pieces:
+        lines += [f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]})}".encode("utf-8"), b""]
+    return lines + [b"data: [DONE]", b""]
+
+
+class FakeResponse:
+    """Just enough of a requests.Response for HTTPChatClient."""
+
+    def __init__(self, status_code, body=None, lines=(), headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = json.dumps(body)
+        self._body = body
+        self._lines = lines
+
+    def json(self):
+        return self._body
+
+    def iter_lines(self):
+        return iter(self._lines)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakeSession:
+    """
+    Answers a post with an error for each status in failures, in order, and
+    then with the reply "hello world" (as server-sent events if streamed, or
+    lines if given).
+    """
+
+    def __init__(self, failures=(), lines=None):
+        self.failures = list(failures)
+        self.lines = lines
+        self.payloads = []
+
+    def post(self, url, json=None, headers=None, timeout=None, stream=False):
+        self.payloads.append(json)
+        if self.failures:
+            error = {"error": {"message": "injected failure"}}
+            return FakeResponse(self.failures.pop(0), error, headers={"Retry-After": "0"})
+        if stream:
+            return FakeResponse(200, lines=self.lines if self.lines is not None else sse_lines(["hello", " world"]))
+        return FakeResponse(200, {"choices": [{"message": {"role": "assistant", "content": "hello world"}}]})
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_api():
+    """
+    Returns a function making an HTTPChatClient whose requests fail with
+    the given statuses and then succeed, without a network.
+    """
+    def make(*failures, lines=None, max_retries=2):
+        client = HTTPChatClient("test-key", "http://api.invalid/v1", default_rate_limit=6000, max_retries=max_retries)
+        client.session = FakeSession(failures, lines)
+        return client
+
+    return make
+
+
+@pytest.fixture
+def api_client():
+    """
+    Returns a function that starts mock_api with the given options and
+    returns an HTTPChatClient pointed at it. The servers stop after the test.
+    """
+    servers = []
+
+    def start(**options):
+        server = mock_api.start(**{"delay": 0, **options})
+        servers.append(server)
+        host, port = server.server_address
+        return HTTPChatClient("test-key", f"http://{host}:{port}/v1", default_rate_limit=6000, max_retries=2)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,48 @@
+import json
+
+from batch_runner import BatchRunner, read_items
+
+
+def write_items(path, prompts):
+    path.write_text("".join(json.dumps({"id": prompt, "prompt": prompt}) + "\n" for prompt in prompts))
+    return str(path)
+
+
+def read_records(path):
+    return [json.loads(line) for line in path.read_text().splitlines() if line]
+
+
+def test_one_record_per_item(tmp_path, stub_client):
+    prompts = [f"prompt {i}" for i in range(20)]
+    items = write_items(tmp_path / "in.jsonl", prompts)
+    BatchRunner(stub_client, concurrency=4).run(read_items(items), str(tmp_path / "out.jsonl"))
+    records = read_records(tmp_path / "out.jsonl")
+    assert sorted(record["id"] for record in records) == sorted(prompts)
+    assert all(record["reply"] == f"re: {record['id']}" for record in records)
+
+
+def test_resume_runs_only_unfinished_items(tmp_path, stub_client):
+    items = write_items(tmp_path / "in.jsonl", ["a", "b", "c"])
+    output = tmp_path / "out.jsonl"
+    stub_client.fail.add("b")
+    BatchRunner(stub_client).run(read_items(items), str(output))
+    assert [record.get("error") for record in read_records(output) if record["id"] == "b"] == ["failed b"]
+
+    stub_client.fail.clear()
+    stub_client.requests.clear()
+    runner = BatchRunner(stub_client)
+    runner.run(read_items(items), str(output))
+    assert stub_client.requests == [(runner.model, "b")]
+    assert runner.skipped == 2
+    # The failed record stays; the new one follows it
+    assert [record.get("reply") for record in read_records(output) if record["id"] == "b"] == [None, "re: b"]
+
+
+def test_against_the_mock_api_with_failures(tmp_path, api_client):
+    client = api_client(fail_every=3)
+    items = write_items(tmp_path / "in.jsonl", [f"prompt {i}" for i in range(10)])
+    records = BatchRunner(client, concurrency=4).run(read_items(items), str(tmp_path / "out.jsonl"))
+    assert len(records) == 10
+    assert not [record for record in records if "error" in record]
+    assert all(record["completion_tokens"] > 0 for record in records)
+    assert client.retries > 0
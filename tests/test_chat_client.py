@@ -0,0 +1,54 @@
+import pytest
+
+from chat_client import APIError, iter_sse_deltas
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def test_retries_after_429_and_503(fake_api):
+    client = fake_api(429, 503)
+    assert client.complete("gpt-4o-mini", MESSAGES) == "hello world"
+    assert client.retries == 2
+    assert len(client.session.payloads) == 3
+
+
+def test_retries_a_streamed_request(fake_api):
+    client = fake_api(503)
+    assert list(client.stream("gpt-4o-mini", MESSAGES)) == ["hello", " world"]
+    assert client.retries == 1
+
+
+def test_gives_up_after_max_retries(fake_api):
+    client = fake_api(429, 503, 429)
+    with pytest.raises(APIError) as error:
+        client.complete("gpt-4o-mini", MESSAGES)
+    assert error.value.status == 429
+    assert client.retries == 2
+
+
+def test_other_errors_are_not_retried(fake_api):
+    client = fake_api(400)
+    with pytest.raises(APIError) as error:
+        client.complete("gpt-4o-mini", MESSAGES)
+    assert error.value.status == 400
+    assert client.retries == 0
+
+
+def test_sse_deltas_stop_at_done():
+    lines = [
+        b": keep-alive",
+        b'data: {"choices": [{"delta": {"role": "assistant"}}]}',
+        b"",
+        'data: {"choices": [{"delta": {"content": "hi"}}]}',
+        b"data: [DONE]",
+        b'data: {"choices": [{"delta": {"content": "after the end"}}]}',
+    ]
+    assert list(iter_sse_deltas(lines)) == ["hi"]
+
+
+def test_stream_with_usage_reads_the_usage_chunk(api_client):
+    client = api_client()
+    usage = {}
+    text = "".join(client.stream_with_usage("gpt-4o-mini", MESSAGES, usage))
+    assert text.endswith("You said: hello")
+    assert usage["completion_tokens"] > 0
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from chat_search import ChatSearch
+from chat_storage import ChatStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ChatStore(str(tmp_path))
+    yield store
+    store.close()
+
+
+def make_chat(store, name, count):
+    path = os.path.join(store.folder, name)
+    store.create(path)
+    store.append(path, [{"role": "user" if i % 2 == 0 else "assistant", "content": f"alpha message {i}"}
+                        for i in range(count)])
+    store.flush()
+    return path
+
+
+def assert_hits_match_store(store, hits):
+    for hit in hits:
+        msg = store.read_range(os.path.join(store.folder, hit.chat), hit.message, hit.message + 1)[0]
+        assert msg["content"] == hit.text
+
+
+def test_search_finds_appended_messages(store):
+    path = make_chat(store, "chat.jsonl", 5)
+    search = ChatSearch(store, store.folder)
+    search.refresh()
+    store.append(path, [{"role": "user", "content": "bravo appended"}])
+    search.refresh()
+    assert [(hit.chat, hit.message) for hit in search.search("bravo")] == [("chat.jsonl", 5)]
+    assert search.chats["chat.jsonl"][3] == 6
+
+
+def test_search_reindexes_a_chat_after_an_insert(store):
+    path = make_chat(store, "chat.jsonl", 5)
+    search = ChatSearch(store, store.folder)
+    search.refresh()
+    store.insert(path, 2, [{"role": "assistant", "content": "bravo inserted reply"}])
+    search.refresh()
+
+    assert [(hit.message, hit.text) for hit in search.search("bravo")] == [(2, "bravo inserted reply")]
+    assert search.chats["chat.jsonl"][3] == 6
+    hits = search.search("message 4")
+    assert [hit.text for hit in hits] == ["alpha message 4"]
+    assert_hits_match_store(store, hits + search.search("alpha"))
+
+
+def test_saved_search_index_notices_an_insert(store):
+    path = make_chat(store, "chat.jsonl", 5)
+    search = ChatSearch(store, store.folder)
+    search.refresh()
+    search.save()
+    store.insert(path, 2, [{"role": "assistant", "content": "bravo inserted reply"}])
+
+    search = ChatSearch(store, store.folder)
+    search.refresh()
+    assert [(hit.message, hit.text) for hit in search.search("bravo")] == [(2, "bravo inserted reply")]
+
+
+def test_recall_reindexes_a_chat_after_an_insert(store):
+    pytest.importorskip("numpy")
+    from chat_recall import ChatRecall
+
+    path = make_chat(store, "chat.jsonl", 5)
+    recall = ChatRecall(store, store.folder)
+    recall.refresh()
+    store.insert(path, 2, [{"role": "assistant", "content": "bravo inserted reply"}])
+    recall.refresh()
+
+    hits = recall.search("bravo inserted reply", limit=10)
+    assert (hits[0].message, hits[0].text) == (2, "bravo inserted reply")
+    assert_hits_match_store(store, hits)
@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from chat_core import ChatEngine
+
+
+@pytest.fixture
+def engine(tmp_path, stub_client):
+    stub_client.hold()
+    engine = ChatEngine(str(tmp_path), stream=False, client=stub_client)
+    engine.open_latest_chat()
+    yield engine
+    engine.close()
+
+
+def wait_for_started(engine, count):
+    deadline = time.monotonic() + 5
+    while len(engine.client.requests) < count:
+        assert time.monotonic() < deadline, "requests never reached the client"
+        time.sleep(0.01)
+
+
+def apply_results(engine, count):
+    deadline = time.monotonic() + 5
+    while count > 0:
+        assert time.monotonic() < deadline, "replies never arrived"
+        for result in engine.poll():
+            engine.apply_result(result)
+            count -= 1
+        time.sleep(0.01)
+
+
+def contents(engine, chat):
+    engine.store.flush()
+    return [msg["content"] for msg in engine.store.read(engine.chat_path(chat))]
+
+
+def test_replies_fill_their_placeholders(engine):
+    engine.send_message("one")
+    engine.send_message("two")
+    wait_for_started(engine, 2)
+    engine.client.release("two")
+    apply_results(engine, 1)
+    engine.client.release("one")
+    apply_results(engine, 1)
+    assert [msg["content"] for msg in engine.chat_history] == ["one", "re: one", "two", "re: two"]
+    assert contents(engine, "New Chat.jsonl") == ["one", "re: one", "two", "re: two"]
+
+
+@pytest.mark.parametrize("order", [("one", "two"), ("two", "one")])
+def test_late_replies_follow_their_messages_after_switching_chat(engine, order):
+    engine.send_message("one")
+    engine.send_message("two")
+    wait_for_started(engine, 2)
+    engine.new_chat("Other")
+    engine.send_message("elsewhere")
+
+    for text in order + ("elsewhere",):
+        engine.client.release(text)
+        apply_results(engine, 1)
+
+    assert contents(engine, "New Chat.jsonl") == ["one", "re: one", "two", "re: two"]
+    assert contents(engine, "Other.jsonl") == ["elsewhere", "re: elsewhere"]
+
+
+def test_late_reply_is_inserted_into_the_reopened_chat(engine):
+    engine.send_message("one")
+    engine.send_message("two")
+    wait_for_started(engine, 2)
+    engine.leave_active_chat()
+    engine.open_chat("New Chat.jsonl")
+
+    engine.client.release("one")
+    apply_results(engine, 1)
+    assert [msg["content"] for msg in engine.chat_history] == ["one", "re: one", "two"]
+    engine.client.release("two")
+    apply_results(engine, 1)
+    assert [msg["content"] for msg in engine.chat_history] == ["one", "re: one", "two", "re: two"]
+    assert contents(engine, "New Chat.jsonl") == ["one", "re: one", "two", "re: two"]
+
+
+def test_inserted_reply_is_searchable(engine):
+    engine.send_message("first question")
+    engine.send_message("second question")
+    wait_for_started(engine, 2)
+    engine.new_chat("Other")
+    engine.refresh_indexes()
+
+    engine.client.release("first question")
+    apply_results(engine, 1)
+    engine.refresh_indexes()
+    hits = engine.search_chats("re first question")
+    assert [(hit.chat, hit.message, hit.text) for hit in hits] == [("New Chat.jsonl", 1, "re: first question")]
+    engine.client.release("second question")
+    apply_results(engine, 1)
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+import mock_api
+from model_compare import Comparison, ModelMetrics, uncached_client
+from response_cache import CachedChatClient, ResponseCache
+
+MESSAGES = [{"role": "user", "content": "Explain mmap"}]
+
+
+def read_log(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_one_log_record_per_request(tmp_path, api_client):
+    client = api_client(model_delays={"o1": 0.2})
+    log = tmp_path / "metrics.jsonl"
+    metrics = ModelMetrics(str(log))
+    comparison = Comparison(client, {"gpt-4o-mini": MESSAGES, "o1": MESSAGES}, metrics)
+    comparison.wait()
+
+    records = read_log(log)
+    assert sorted(record["model"] for record in records) == ["gpt-4o-mini", "o1"]
+    for record in records:
+        assert 0 < record["ttft_ms"] <= record["latency_ms"]
+        assert record["completion_tokens"] > 0  # reported by the server
+    slow = next(record for record in records if record["model"] == "o1")
+    assert slow["latency_ms"] >= 200
+    assert [reply.text for reply in comparison.replies] == [mock_api.reply_text(reply.model, MESSAGES)
+                                                           for reply in comparison.replies]
+
+    Comparison(client, {"gpt-4o-mini": MESSAGES}, metrics).wait()
+    assert len(read_log(log)) == 3
+    assert ModelMetrics(str(log)).summary()["gpt-4o-mini"]["requests"] == 2
+
+
+def test_failures_are_logged_and_counted(tmp_path, stub_client):
+    stub_client.fail.add("o1")
+    metrics = ModelMetrics(str(tmp_path / "metrics.jsonl"))
+    Comparison(stub_client, {"gpt-4o": MESSAGES, "o1": MESSAGES}, metrics).wait()
+    summary = metrics.summary()
+    assert summary["o1"]["requests"] == summary["o1"]["errors"] == 1
+    assert summary["gpt-4o"]["errors"] == 0
+    assert summary["gpt-4o"]["completion_tokens"] > 0  # estimated without usage
+    assert summary["gpt-4o"]["cost"] > 0
+
+
+def test_cheapest_within_slo(tmp_path):
+    metrics = ModelMetrics(str(tmp_path / "metrics.jsonl"))
+    for model, latency in [("gpt-4o", 500), ("gpt-4o-mini", 300), ("o1", 900)]:
+        metrics.record({"model": model, "ttft_ms": 100, "latency_ms": latency,
+                        "prompt_tokens": 100, "completion_tokens": 100})
+    assert metrics.cheapest_within(1000) == "gpt-4o-mini"
+    assert metrics.cheapest_within(200) is None
+
+
+def test_comparisons_bypass_the_response_cache(tmp_path, stub_client):
+    cache = ResponseCache(str(tmp_path / "cache"))
+    cache.put("gpt-4o", MESSAGES, "cached reply")
+    client = uncached_client(CachedChatClient(stub_client, cache))
+    comparison = Comparison(client, {"gpt-4o": MESSAGES}, ModelMetrics(str(tmp_path / "metrics.jsonl")))
+    comparison.wait()
+    assert comparison.replies[0].text == "re: Explain mmap"
+    assert stub_client.requests == [("gpt-4o", "Explain mmap")]
+    with pytest.raises(ValueError):
+        uncached_client(CachedChatClient(stub_client, cache, offline=True))
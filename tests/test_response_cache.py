@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from response_cache import CacheMiss, CachedChatClient, ResponseCache, request_key
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def test_miss_then_hit(tmp_path, stub_client):
+    client = CachedChatClient(stub_client, ResponseCache(str(tmp_path)))
+    assert client.complete("gpt-4o", MESSAGES) == "re: hello"
+    assert client.complete("gpt-4o", MESSAGES) == "re: hello"
+    assert len(stub_client.requests) == 1
+    assert client.cache.stats()["hits"] == 1
+    assert client.cache.stats()["misses"] == 1
+
+
+def test_key_covers_model_and_messages(tmp_path, stub_client):
+    client = CachedChatClient(stub_client, ResponseCache(str(tmp_path)))
+    client.complete("gpt-4o", MESSAGES)
+    client.complete("gpt-4o-mini", MESSAGES)
+    client.complete("gpt-4o", MESSAGES + [{"role": "user", "content": "again"}])
+    assert len(stub_client.requests) == 3
+    assert client.cache.stats()["hits"] == 0
+
+
+def test_streamed_reply_is_cached_whole(tmp_path, stub_client):
+    client = CachedChatClient(stub_client, ResponseCache(str(tmp_path)))
+    assert list(client.stream("gpt-4o", MESSAGES)) == ["re:", " hello"]
+    assert list(client.stream("gpt-4o", MESSAGES)) == ["re: hello"]
+    assert len(stub_client.requests) == 1
+
+
+def test_expired_entry_is_a_miss(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=-1)
+    cache.put("gpt-4o", MESSAGES, "old")
+    assert cache.get("gpt-4o", MESSAGES) is None
+    assert cache.used_bytes == 0
+
+
+def test_offline_miss_raises(tmp_path, stub_client):
+    cache = ResponseCache(str(tmp_path))
+    cache.put("gpt-4o", MESSAGES, "recorded")
+    client = CachedChatClient(stub_client, cache, offline=True)
+    assert client.complete("gpt-4o", MESSAGES) == "recorded"
+    with pytest.raises(CacheMiss):
+        client.complete("o1", MESSAGES)
+    assert stub_client.requests == []
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=1000)
+    for i in range(20):
+        messages = [{"role": "user", "content": str(i)}]
+        cache.put("gpt-4o", messages, "x" * 100)
+        os.utime(cache._path(request_key("gpt-4o", messages)), (i, i))  # entry i was last used at time i
+    assert cache.used_bytes <= 1000
+    assert cache.get("gpt-4o", [{"role": "user", "content": "19"}]) == "x" * 100
+    assert cache.get("gpt-4o", [{"role": "user", "content": "0"}]) is None
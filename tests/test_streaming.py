@@ -0,0 +1,83 @@
+import json
+import time
+
+import pytest
+
+from chat_client import iter_sse_deltas
+from chat_core import PENDING_TEXT, ChatEngine
+from chat_worker import ChatDelta, ChatResult, RequestWorker
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+USAGE = {"prompt_tokens": 9, "completion_tokens": 3, "total_tokens": 12}
+
+
+def canned_stream(pieces):
+    """The raw lines of a streamed reply: a role chunk, the pieces, a usage chunk and [DONE]."""
+    chunks = [{"choices": [{"delta": {"role": "assistant"}}]}]
+    chunks += [{"choices": [{"delta": {"content": piece}}]} for piece in pieces]
+    chunks.append({"choices": [], "usage": USAGE})
+    lines = []
+    for chunk in chunks:
+        lines += [f"data: {json.dumps(chunk)}".encode("utf-8"), b""]
+    return lines + [b"data: [DONE]", b"", b'data: {"choices": [{"delta": {"content": "after the end"}}]}']
+
+
+def poll_until_result(poll):
+    """Everything poll() returns up to and including the first ChatResult."""
+    items = []
+    deadline = time.monotonic() + 5
+    while not items or not isinstance(items[-1], ChatResult):
+        assert time.monotonic() < deadline, "no result arrived"
+        items += poll()
+        time.sleep(0.01)
+    return items
+
+
+def test_sse_deltas_with_usage():
+    usage = {}
+    assert list(iter_sse_deltas(canned_stream(["Hel", "lo", "!"]), usage)) == ["Hel", "lo", "!"]
+    assert usage == USAGE
+
+
+def test_stream_with_usage_over_a_fake_response(fake_api):
+    client = fake_api(lines=canned_stream(["Hel", "lo"]))
+    usage = {}
+    assert list(client.stream_with_usage("gpt-4o-mini", MESSAGES, usage)) == ["Hel", "lo"]
+    assert usage == USAGE
+    assert client.session.payloads[0]["stream_options"] == {"include_usage": True}
+
+
+def test_worker_sends_deltas_then_the_result(fake_api):
+    worker = RequestWorker(fake_api(lines=canned_stream(["Hel", "lo", "!"])), num_threads=1)
+    try:
+        request_id = worker.submit("chat.jsonl", "gpt-4o-mini", MESSAGES, stream=True)
+        items = poll_until_result(worker.poll)
+    finally:
+        worker.stop()
+    assert [(type(item), item.request_id) for item in items] == [(ChatDelta, request_id)] * 3 + [(ChatResult, request_id)]
+    assert [item.text for item in items[:-1]] == ["Hel", "lo", "!"]
+    assert (items[-1].content, items[-1].error) == ("Hello!", None)
+
+
+@pytest.fixture
+def engine(tmp_path, fake_api):
+    engine = ChatEngine(str(tmp_path), stream=True, client=fake_api(lines=canned_stream(["Hel", "lo", "!"])))
+    engine.open_latest_chat()
+    yield engine
+    engine.close()
+
+
+def test_engine_fills_the_placeholder_as_pieces_arrive(engine):
+    engine.send_message("hello")
+    assert engine.chat_history[-1]["content"] == PENDING_TEXT
+
+    changes = []
+    for item in poll_until_result(engine.poll):
+        if isinstance(item, ChatDelta):
+            changes.append((engine.apply_delta(item), engine.chat_history[-1]["content"]))
+        else:
+            assert engine.apply_result(item) == 1
+    assert changes == [((1, True), "Hel"), ((1, False), "Hello"), ((1, False), "Hello!")]
+    assert engine.chat_history == [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "Hello!"}]
+    engine.store.flush()
+    assert engine.store.read(engine.active_chat_path) == engine.chat_history
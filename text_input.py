@@ -0,0 +1,340 @@
+"""
+Editable multi-line text for the chat input and the system instructions box.
+
+TextBuffer holds the text as a list of lines with a cursor. Typing a
+character rebuilds only the cursor's line and a paste is spliced in as one
+operation, so edits cost the size of the line touched (plus the paste)
+rather than the whole text, however large it gets.
+
+TextView wraps the buffer to a width for display. It keeps the wrap of
+every line, so after an edit only the lines that changed are re-wrapped,
+and it keeps the cursor's row scrolled into view.
+"""
+
+from bisect import bisect_right
+from itertools import accumulate
+
+import pygame
+
+TAB_TEXT = "    "  # the fonts have no glyph for tabs
+
+
+def clean_text(text):
+    """Normalizes pasted or typed text: one kind of newline, tabs as spaces, no other control characters."""
+    text = text.replace("\r\n", "\n").replace("\r", "\n").replace("\t", TAB_TEXT)
+    return "".join(ch for ch in text if ch == "\n" or ch.isprintable())
+
+
+def clipboard_text():
+    """The text on the system clipboard, or "" if there is none (or no clipboard support)."""
+    try:
+        if not pygame.scrap.get_init():
+            pygame.scrap.init()
+        data = pygame.scrap.get(pygame.SCRAP_TEXT)
+    except (pygame.error, AttributeError):
+        return ""
+    if not data:
+        return ""
+    return data.decode("utf-8", "ignore").rstrip("\0")
+
+
+class TextBuffer:
+    def __init__(self, text=""):
+        self.version = 0  # bumped by every change, so views know when to re-wrap
+        self.set_text(text)
+
+    @property
+    def text(self):
+        return "\n".join(self.lines)
+
+    def __bool__(self):
+        return len(self.lines) > 1 or bool(self.lines[0])
+
+    def set_text(self, text):
+        self.lines = clean_text(text).split("\n")
+        self.row = len(self.lines) - 1
+        self.col = len(self.lines[-1])
+        self.version += 1
+
+    def clear(self):
+        self.set_text("")
+
+    ############################
+    # Editing
+    ############################
+
+    def insert(self, text):
+        """Inserts text at the cursor and moves the cursor past it."""
+        text = clean_text(text)
+        if not text:
+            return
+        line = self.lines[self.row]
+        before, after = line[:self.col], line[self.col:]
+        pieces = text.split("\n")
+        if len(pieces) == 1:
+            self.lines[self.row] = before + text + after
+            self.col += len(text)
+        else:
+            pieces[0] = before + pieces[0]
+            self.col = len(pieces[-1])
+            pieces[-1] += after
+            self.lines[self.row:self.row + 1] = pieces
+            self.row += len(pieces) - 1
+        self.version += 1
+
+    def backspace(self):
+        if self.col > 0:
+            line = self.lines[self.row]
+            self.lines[self.row] = line[:self.col - 1] + line[self.col:]
+            self.col -= 1
+        elif self.row > 0:
+            self.col = len(self.lines[self.row - 1])
+            self.lines[self.row - 1] += self.lines.pop(self.row)
+            self.row -= 1
+        else:
+            return
+        self.version += 1
+
+    def delete(self):
+        line = self.lines[self.row]
+        if self.col < len(line):
+            self.lines[self.row] = line[:self.col] + line[self.col + 1:]
+        elif self.row < len(self.lines) - 1:
+            self.lines[self.row] += self.lines.pop(self.row + 1)
+        else:
+            return
+        self.version += 1
+
+    ############################
+    # Cursor
+    ############################
+
+    def move_left(self):
+        if self.col > 0:
+            self.col -= 1
+        elif self.row > 0:
+            self.row -= 1
+            self.col = len(self.lines[self.row])
+
+    def move_right(self):
+        if self.col < len(self.lines[self.row]):
+            self.col += 1
+        elif self.row < len(self.lines) - 1:
+            self.row += 1
+            self.col = 0
+
+    def move_to(self, row, col):
+        self.row = max(0, min(row, len(self.lines) - 1))
+        self.col = max(0, min(col, len(self.lines[self.row])))
+
+
+class TextView:
+    """The wrapped rows of a TextBuffer in a box of a given size, scrolled to keep the cursor visible."""
+
+    def __init__(self, buffer, font, width, max_rows):
+        self.buffer = buffer
+        self.font = font
+        self.width = width
+        self.max_rows = max_rows
+        self.scroll = 0  # first row shown
+        self.row_count = 0
+        self._lines = []      # the buffer's lines as of the last layout
+        self._breaks = []     # line number -> offsets its rows start at
+        self._line_rows = []  # line number -> index of its first row
+        self._char_widths = {}
+        self._version = None
+
+    ############################
+    # Wrapping
+    ############################
+
+    def wrap(self, line):
+        """
+        Offsets at which line breaks into rows no wider than the view. Breaks
+        go after the last space that fits, or mid-word for words too long
+        for a row. Widths are estimated from per-character widths and the
+        chosen break confirmed with one measurement of the row.
+        """
+        widths = self._char_widths
+        for ch in set(line).difference(widths):
+            widths[ch] = self.font.size(ch)[0]
+        prefix = list(accumulate(map(widths.__getitem__, line), initial=0))
+
+        breaks = [0]
+        start = 0
+        while prefix[-1] - prefix[start] > self.width:
+            end = max(start + 1, bisect_right(prefix, prefix[start] + self.width) - 1)
+            while end > start + 1 and self.font.size(line[start:end])[0] > self.width:
+                end -= 1
+            space = line.rfind(" ", start, end)
+            if space > start and end < len(line):
+                end = space + 1
+            breaks.append(end)
+            start = end
+        return breaks
+
+    def update(self):
+        """
+        Re-lays out the rows if the buffer changed since the last call. Only
+        the lines between the first and last one that changed are re-wrapped;
+        edits replace line strings, so unchanged lines are the same objects.
+        """
+        if self._version == self.buffer.version:
+            return
+        self._version = self.buffer.version
+        old, new = self._lines, self.buffer.lines
+        first = 0
+        limit = min(len(old), len(new))
+        while first < limit and old[first] is new[first]:
+            first += 1
+        tail = 0
+        limit -= first
+        while tail < limit and old[-1 - tail] is new[-1 - tail]:
+            tail += 1
+
+        self._breaks[first:len(old) - tail] = [self.wrap(line) for line in new[first:len(new) - tail]]
+        row = self._line_rows[first] if first < len(self._line_rows) else self.row_count
+        self._line_rows[first:] = accumulate((len(breaks) for breaks in self._breaks[first:]), initial=row)
+        self.row_count = self._line_rows.pop()
+        self._lines = new[:]
+        self.scroll_to_cursor()
+
+    def set_width(self, width):
+        if width != self.width:
+            self.width = width
+            self._lines = []
+            self._breaks = []
+            self._line_rows = []
+            self.row_count = 0
+            self._version = None
+
+    def row(self, index):
+        """(line number, start, end) of the row at index."""
+        number = bisect_right(self._line_rows, index) - 1
+        breaks = self._breaks[number]
+        k = index - self._line_rows[number]
+        end = breaks[k + 1] if k + 1 < len(breaks) else len(self._lines[number])
+        return number, breaks[k], end
+
+    def _continues(self, index):
+        """Whether the row after index is the same line wrapped."""
+        number = bisect_right(self._line_rows, index) - 1
+        return index + 1 - self._line_rows[number] < len(self._breaks[number])
+
+    ############################
+    # Cursor and scrolling
+    ############################
+
+    def cursor_row(self):
+        """Index of the row the cursor is on. At a break, the cursor shows at the start of the next row."""
+        breaks = self._breaks[self.buffer.row]
+        return self._line_rows[self.buffer.row] + bisect_right(breaks, self.buffer.col) - 1
+
+    def cursor_x(self):
+        number, start, _ = self.row(self.cursor_row())
+        return self.font.size(self.buffer.lines[number][start:self.buffer.col])[0]
+
+    def visible_rows(self):
+        return min(self.row_count, self.max_rows)
+
+    def scroll_to_cursor(self):
+        row = self.cursor_row()
+        if row < self.scroll:
+            self.scroll = row
+        elif row >= self.scroll + self.max_rows:
+            self.scroll = row - self.max_rows + 1
+        self.scroll = max(0, min(self.scroll, self.row_count - self.visible_rows()))
+
+    def scroll_by(self, rows):
+        self.scroll = max(0, min(self.scroll + rows, self.row_count - self.visible_rows()))
+
+    def move_vertical(self, delta):
+        """Moves the cursor delta rows up (negative) or down, keeping its x position."""
+        self.update()
+        x = self.cursor_x()
+        target = self.cursor_row() + delta
+        if target < 0 or target >= self.row_count:
+            self.buffer.move_to(self.buffer.row, 0 if target < 0 else len(self.buffer.lines[self.buffer.row]))
+        else:
+            self.buffer.move_to(*self.position_at(target, x))
+        self.scroll_to_cursor()
+
+    def position_at(self, row, x):
+        """The (line, column) in row closest to x pixels from the left edge."""
+        number, start, end = self.row(row)
+        line = self.buffer.lines[number]
+        col = start
+        # Stop before the break offset so the cursor stays on this row
+        last = end - 1 if self._continues(row) else end
+        while col < last and self.font.size(line[start:col + 1])[0] <= x:
+            col += 1
+        return number, col
+
+    def click(self, x, y):
+        """Puts the cursor at a point given relative to the top left of the first visible row."""
+        self.update()
+        row = min(self.row_count - 1, self.scroll + max(0, y) // self.font.get_linesize())
+        self.buffer.move_to(*self.position_at(row, x))
+
+    def move_home(self):
+        self.update()
+        _, start, _ = self.row(self.cursor_row())
+        self.buffer.move_to(self.buffer.row, start)
+
+    def move_end(self):
+        self.update()
+        row = self.cursor_row()
+        number, _, end = self.row(row)
+        if self._continues(row):
+            end -= 1
+        self.buffer.move_to(number, end)
+
+    ############################
+    # Keys
+    ############################
+
+    def handle_key(self, event, multiline_key=pygame.KMOD_SHIFT):
+        """
+        Applies an editing key: text, Backspace/Delete, arrows, Home/End,
+        Ctrl+Home/End, Ctrl+V (paste) and, with multiline_key held, Enter
+        as a newline. Returns True if the key was used.
+        """
+        buffer = self.buffer
+        ctrl = event.mod & (pygame.KMOD_CTRL | pygame.KMOD_META)
+        if event.key == pygame.K_v and ctrl:
+            buffer.insert(clipboard_text())
+        elif event.key == pygame.K_RETURN and event.mod & multiline_key:
+            buffer.insert("\n")
+        elif event.key == pygame.K_BACKSPACE:
+            buffer.backspace()
+        elif event.key == pygame.K_DELETE:
+            buffer.delete()
+        elif event.key == pygame.K_LEFT:
+            buffer.move_left()
+        elif event.key == pygame.K_RIGHT:
+            buffer.move_right()
+        elif event.key == pygame.K_UP:
+            self.move_vertical(-1)
+        elif event.key == pygame.K_DOWN:
+            self.move_vertical(1)
+        elif event.key == pygame.K_PAGEUP:
+            self.move_vertical(-self.max_rows)
+        elif event.key == pygame.K_PAGEDOWN:
+            self.move_vertical(self.max_rows)
+        elif event.key == pygame.K_HOME:
+            if ctrl:
+                buffer.move_to(0, 0)
+            else:
+                self.move_home()
+        elif event.key == pygame.K_END:
+            if ctrl:
+                buffer.move_to(len(buffer.lines) - 1, len(buffer.lines[-1]))
+            else:
+                self.move_end()
+        elif event.unicode and event.unicode.isprintable() and not ctrl:
+            buffer.insert(event.unicode)
+        else:
+            return False
+        self.update()
+        self.scroll_to_cursor()
+        return True